@@ -6,12 +6,15 @@ import uuid
 from typing import Any
 
 import streamlit as st
-from openai import OpenAI
 
 from nunbot_core import (
     check_runtime_health,
+    get_openai_circuit_breaker,
+    get_nun_index,
+    get_search_cache,
     load_nun_data as core_load_nun_data,
     normalize_search_query,
+    procedure_records_by_code,
     search_nun_codes,
     validate_search_query,
 )
@@ -40,12 +43,14 @@ def init_openai_client():
     if not api_key:
         st.error("⚠️ API Key de OpenAI no encontrada. Verifique la variable de entorno OPENAI_API_KEY")
         st.stop()
+    from openai import OpenAI
+
     return OpenAI(api_key=api_key)
 
 
-@st.cache_data(show_spinner=False)
+@st.cache_resource(show_spinner=False)
 def load_nun_data():
-    """Load and cache the NUN dataset."""
+    """Load and cache the NUN dataset together with its search index."""
     try:
         df = core_load_nun_data()
         logger.info("Loaded %s procedures from CSV", len(df))
@@ -58,16 +63,10 @@ def load_nun_data():
         st.stop()
 
 
-def _get_search_cache() -> dict[tuple[Any, ...], tuple[str, float, str, list[dict[str, Any]], list[dict[str, Any]], bool]]:
-    if "nunbot_search_cache" not in st.session_state:
-        st.session_state["nunbot_search_cache"] = {}
-    return st.session_state["nunbot_search_cache"]
-
-
-def _build_search_cache_key(user_input: str, procedures_data) -> tuple[Any, ...]:
-    normalized_input = normalize_search_query(user_input)
-    code_signature = hash(tuple(procedures_data["Código"].astype(str).tolist())) if "Código" in procedures_data.columns else 0
-    return (normalized_input, os.getenv("NUNBOT_MODEL", "gpt-4o"), len(procedures_data), code_signature)
+@st.cache_resource
+def init_search_cache():
+    """Shared on-disk search cache, reused across sessions and restarts."""
+    return get_search_cache()
 
 
 def _preview_query(text: str, limit: int = 120) -> str:
@@ -136,68 +135,95 @@ def _resolve_helper_pricing(row) -> tuple[int, float, float]:
     return helper_count, per_helper_amount, total_helpers_amount
 
 
-def display_results(suggested_codes, procedures_data):
-    """Display the search results in a formatted way."""
-    if not suggested_codes:
-        st.warning("⚠️ No se encontraron códigos sugeridos. Intente con una descripción más específica.")
+def render_suggestion(i, suggestion, records_by_code, index):
+    """Render one suggested code with its description and fees."""
+    codigo = suggestion.get("codigo", "")
+    motivo = suggestion.get("motivo", "")
+    confianza = float(suggestion.get("confianza", 0) or 0)
+
+    row = records_by_code.get(str(codigo))
+    if row is None:
+        st.error(f"❌ Código {codigo} no encontrado en la base de datos")
         return
 
-    st.subheader("📋 Códigos NUN Sugeridos")
+    if i > 1:
+        st.divider()
+    with st.expander(f"🔍 **{i}. {codigo}** - Confianza: {confianza:.0%}", expanded=(i <= 2)):
+        col1, col2 = st.columns([2, 1])
 
-    for i, suggestion in enumerate(suggested_codes, 1):
-        codigo = suggestion.get("codigo", "")
-        motivo = suggestion.get("motivo", "")
-        confianza = float(suggestion.get("confianza", 0) or 0)
+        with col1:
+            st.markdown("**📄 Descripción:**")
+            st.write(row["Descripción"])
 
-        procedure_row = procedures_data[procedures_data["Código"].astype(str) == str(codigo)]
+            st.markdown("**🎯 Motivo de sugerencia:**")
+            st.write(motivo)
 
-        if not procedure_row.empty:
-            row = procedure_row.iloc[0]
+            for alternative in index.records_for_code(str(codigo))[1:]:
+                st.caption(f"⚠️ El nomenclador repite este código para: {alternative['Descripción']}")
 
-            with st.expander(f"🔍 **{i}. {codigo}** - Confianza: {confianza:.0%}", expanded=(i <= 2)):
-                col1, col2 = st.columns([2, 1])
+            if "Región" in row:
+                st.markdown(f"**🗺️ Región:** {row['Región']}")
+            if "Complejidad" in row:
+                st.markdown(f"**⚙️ Complejidad:** {row['Complejidad']}")
 
-                with col1:
-                    st.markdown("**📄 Descripción:**")
-                    st.write(row["Descripción"])
+        with col2:
+            st.markdown("**💰 Honorarios**")
 
-                    st.markdown("**🎯 Motivo de sugerencia:**")
-                    st.write(motivo)
+            cirujano = row.get("Cirujano", 0)
+            total = row.get("Total", 0)
+            helper_count, per_helper_amount, total_helpers_amount = _resolve_helper_pricing(row)
 
-                    if "Región" in row:
-                        st.markdown(f"**🗺️ Región:** {row['Región']}")
-                    if "Complejidad" in row:
-                        st.markdown(f"**⚙️ Complejidad:** {row['Complejidad']}")
+            if cirujano > 0:
+                st.metric("👨‍⚕️ Cirujano", _format_currency(cirujano))
 
-                with col2:
-                    st.markdown("**💰 Honorarios**")
+            if helper_count == 0:
+                st.info("Sin ayudantes")
+            elif helper_count == 1:
+                st.metric("🤝 Ayudante", _format_currency(per_helper_amount))
+            else:
+                st.caption(f"{helper_count} ayudantes — cada uno cobra {_format_currency(per_helper_amount)}")
+                helper_cols = st.columns(helper_count)
+                for idx in range(helper_count):
+                    with helper_cols[idx]:
+                        st.metric(f"🤝 Ayudante {idx + 1}", _format_currency(per_helper_amount))
+                st.caption(f"Total ayudantes: {_format_currency(total_helpers_amount)}")
 
-                    cirujano = row.get("Cirujano", 0)
-                    total = row.get("Total", 0)
-                    helper_count, per_helper_amount, total_helpers_amount = _resolve_helper_pricing(row)
+            if total > 0:
+                st.metric("💎 Total", _format_currency(total))
 
-                    if cirujano > 0:
-                        st.metric("👨‍⚕️ Cirujano", _format_currency(cirujano))
 
-                    if helper_count == 0:
-                        st.info("Sin ayudantes")
-                    elif helper_count == 1:
-                        st.metric("🤝 Ayudante", _format_currency(per_helper_amount))
-                    else:
-                        st.caption(f"{helper_count} ayudantes — cada uno cobra {_format_currency(per_helper_amount)}")
-                        helper_cols = st.columns(helper_count)
-                        for idx in range(helper_count):
-                            with helper_cols[idx]:
-                                st.metric(f"🤝 Ayudante {idx + 1}", _format_currency(per_helper_amount))
-                        st.caption(f"Total ayudantes: {_format_currency(total_helpers_amount)}")
+class SuggestionStream:
+    """Renders suggestions into a container as ``search_nun_codes`` streams them."""
 
-                    if total > 0:
-                        st.metric("💎 Total", _format_currency(total))
+    def __init__(self, container, procedures_data):
+        self.container = container
+        self.records_by_code = procedure_records_by_code(procedures_data)
+        self.index, _ = get_nun_index(procedures_data)
+        self.rendered = []
+        self.started_at = time.perf_counter()
+        self.first_suggestion_seconds = None
 
-                if i < len(suggested_codes):
-                    st.divider()
-        else:
-            st.error(f"❌ Código {codigo} no encontrado en la base de datos")
+    def __call__(self, suggestion):
+        with self.container:
+            if not self.rendered:
+                self.first_suggestion_seconds = time.perf_counter() - self.started_at
+                st.subheader("📋 Códigos NUN Sugeridos")
+            self.rendered.append(suggestion)
+            render_suggestion(len(self.rendered), suggestion, self.records_by_code, self.index)
+
+
+def display_results(suggested_codes, procedures_data):
+    """Display the search results in a formatted way."""
+    if not suggested_codes:
+        st.warning("⚠️ No se encontraron códigos sugeridos. Intente con una descripción más específica.")
+        return
+
+    st.subheader("📋 Códigos NUN Sugeridos")
+    records_by_code = procedure_records_by_code(procedures_data)
+    index, _ = get_nun_index(procedures_data)
+
+    for i, suggestion in enumerate(suggested_codes, 1):
+        render_suggestion(i, suggestion, records_by_code, index)
 
 
 def main():
@@ -244,62 +270,90 @@ def main():
 
         client = init_openai_client()
         procedures_data = load_nun_data()
-        cache_key = _build_search_cache_key(user_input, procedures_data)
-        search_cache = _get_search_cache()
-        cached_result = search_cache.get(cache_key)
+        search_cache = init_search_cache()
 
+        # Region details go above the suggestions, which appear while the model is still writing.
+        summary_area = st.container()
+        stream = SuggestionStream(st.container(), procedures_data)
         try:
-            if cached_result is not None:
-                region, confidence, reason, suggested_codes, local_candidates, used_fallback = cached_result
+            with st.spinner("🤖 Analizando descripción y buscando códigos relevantes..."):
+                start = time.perf_counter()
+                search_result = search_nun_codes(
+                    client,
+                    user_input,
+                    procedures_data,
+                    cache=search_cache,
+                    on_suggestion=stream,
+                )
+                elapsed = time.perf_counter() - start
+            region, confidence, reason, suggested_codes, local_candidates, used_fallback = search_result
+            if search_result.cached:
                 logger.info(
-                    "search_cache_hit id=%s query=%r region=%s suggestions=%s fallback=%s",
+                    "search_cache_hit id=%s query=%r similarity=%s region=%s suggestions=%s fallback=%s",
                     search_id,
                     query_preview,
+                    search_result.similarity,
                     region or "",
                     len(suggested_codes),
                     used_fallback,
                 )
-                st.caption("Resultados reutilizados desde la caché de la sesión.")
-            else:
-                with st.spinner("🤖 Analizando descripción y buscando códigos relevantes..."):
-                    start = time.perf_counter()
-                    cached_result = search_nun_codes(
-                        client,
-                        user_input,
-                        procedures_data,
+                if search_result.similarity is not None:
+                    st.caption(
+                        f"Resultados reutilizados desde la caché compartida para una descripción similar ({search_result.similarity:.0%})."
                     )
-                    elapsed = time.perf_counter() - start
-                search_cache[cache_key] = cached_result
-                region, confidence, reason, suggested_codes, local_candidates, used_fallback = cached_result
+                else:
+                    st.caption("Resultados reutilizados desde la caché compartida.")
+            else:
                 logger.info(
-                    "search_completed id=%s query=%r elapsed=%.2fs region=%s confidence=%.2f suggestions=%s local_candidates=%s fallback=%s",
+                    "search_completed id=%s query=%r elapsed=%.2fs first_suggestion=%s path=%s region=%s confidence=%.2f suggestions=%s local_candidates=%s prompt_candidates=%s/%s fallback=%s partial=%s circuit=%s stages=%s",
                     search_id,
                     query_preview,
                     elapsed,
+                    f"{stream.first_suggestion_seconds:.2f}s" if stream.first_suggestion_seconds is not None else "-",
+                    search_result.path,
                     region or "",
                     confidence,
                     len(suggested_codes),
                     len(local_candidates),
+                    search_result.prompt_count,
+                    search_result.prompt_reason or "-",
                     used_fallback,
+                    search_result.partial,
+                    get_openai_circuit_breaker().state,
+                    ",".join(f"{name}={ms:.1f}ms" for name, ms in search_result.trace.summary().items())
+                    if search_result.trace is not None
+                    else "-",
                 )
         except Exception:
             logger.exception("search_failed id=%s query=%r", search_id, query_preview)
             st.error("❌ Ocurrió un error interno durante la búsqueda. Revisá los logs del contenedor.")
             return
 
-        if region:
-            st.info(f"🎯 **Región identificada:** {region} (Confianza: {confidence:.0%})")
-            if reason:
-                st.write(f"**Motivo:** {reason}")
-
-        if local_candidates:
-            st.caption(f"Se prepararon {len(local_candidates)} candidatos locales antes de consultar al modelo.")
-
-        if used_fallback:
-            st.warning("⚠️ Se usó un respaldo determinístico porque la respuesta del modelo fue incompleta o inválida.")
+        with summary_area:
+            if region:
+                st.info(f"🎯 **Región identificada:** {region} (Confianza: {confidence:.0%})")
+                if reason:
+                    st.write(f"**Motivo:** {reason}")
+
+            if search_result.path == "local_bypass":
+                st.caption("La búsqueda local encontró una coincidencia decisiva; no fue necesario consultar al modelo.")
+            elif local_candidates:
+                st.caption(f"Se prepararon {len(local_candidates)} candidatos locales antes de consultar al modelo.")
+
+            circuit_state = get_openai_circuit_breaker().state
+            if used_fallback and circuit_state != "closed":
+                st.warning(
+                    "⚠️ OpenAI no responde: las sugerencias provienen de la búsqueda local determinística "
+                    "hasta que el servicio se recupere."
+                )
+            elif search_result.partial:
+                st.warning("⏱️ Se alcanzó el tiempo máximo de búsqueda: se muestran los mejores resultados obtenidos hasta ese momento.")
+            elif used_fallback:
+                st.warning("⚠️ Se usó un respaldo determinístico porque la respuesta del modelo fue incompleta o inválida.")
 
         if suggested_codes:
-            display_results(suggested_codes, procedures_data)
+            if not stream.rendered:
+                display_results(suggested_codes, procedures_data)
         else:
             logger.warning("search_empty_results query=%r region=%s fallback=%s", query_preview, region or "", used_fallback)
             st.error("❌ Error al procesar la búsqueda. Verifique su conexión a internet y la configuración de la API.")
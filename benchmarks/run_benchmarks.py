@@ -0,0 +1,279 @@
+"""Reproducible benchmarks for the NUNBot search hot path.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output benchmarks/results/$(git rev-parse --short HEAD).json
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/abc1234.json
+
+End-to-end cases use ``FakeOpenAIClient`` so no API key or network is needed;
+its latency and failure rate are configurable to model slow or flaky providers.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+# Measure the pipeline, not the production OpenAI rate limits (override to benchmark the limiter).
+os.environ.setdefault("NUNBOT_OPENAI_RPM", "0")
+os.environ.setdefault("NUNBOT_OPENAI_TPM", "0")
+
+import nunbot_core  # noqa: E402
+
+QUERIES = [
+    "fractura de cadera con reducción abierta y osteosíntesis",
+    "artroscopia de rodilla con meniscectomía parcial",
+    "fractura desplazada de cúbito y radio con reducción y osteosíntesis con placa",
+    "forage de cadera",
+    "artrodesis lumbar con instrumentación",
+    "osteotomía de tibia proximal",
+    "reparación de manguito rotador por vía artroscópica",
+    "amputación de dedo del pie",
+]
+TYPO_QUERIES = [
+    "atroscopia de rodilla con menisectomia",
+    "osteosinteis de fractura de femur",
+    "artrodesis lumbar con instrumentacon",
+]
+# Catalogue phrases with a locally detected region: the local ranking is decisive and OpenAI is skipped.
+BYPASS_QUERIES = [
+    "reducción de luxación de rótula",
+    "cura oclusiva en pie neuropático",
+    "tenotomías percutáneas en pie",
+]
+UNANCHORED_QUERIES = [
+    "reducción abierta con placa y tornillos",
+    "toilette quirúrgica y desbridamiento",
+    "extracción de material de osteosíntesis",
+]
+
+
+class FakeOpenAIClient:
+    """Stand-in for ``OpenAI`` that answers region and ranking prompts after a configurable delay.
+
+    ``failure_rate`` is the probability that a call raises, which exercises the
+    retry and fallback paths. A seeded RNG keeps runs comparable. Streamed
+    calls spread the latency evenly over small content chunks, like tokens.
+    """
+
+    def __init__(self, *, latency_seconds: float = 0.0, failure_rate: float = 0.0, seed: int = 7):
+        self.latency_seconds = latency_seconds
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def with_options(self, **kwargs: Any) -> FakeOpenAIClient:
+        return self
+
+    def _create(self, **kwargs: Any) -> Any:
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.failure_rate
+        if kwargs.get("stream"):
+            return self._stream(self._content(kwargs), fail)
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        if fail:
+            raise RuntimeError("injected OpenAI failure")
+        message = SimpleNamespace(content=self._content(kwargs))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    def _stream(self, content: str, fail: bool):
+        chunks = [content[start : start + 4] for start in range(0, len(content), 4)]
+        for chunk in chunks:
+            if self.latency_seconds:
+                time.sleep(self.latency_seconds / len(chunks))
+            if fail:
+                raise RuntimeError("injected OpenAI failure")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))])
+
+    def _content(self, kwargs: dict[str, Any]) -> str:
+
+        prompt = kwargs["messages"][-1]["content"]
+        if "codigos_sugeridos" in prompt or "LISTA DE PROCEDIMIENTOS" in prompt:
+            codes = [line.split(" | ", 1)[0] for line in prompt.splitlines() if " | " in line][:3]
+            content = {"codigos_sugeridos": [{"codigo": code, "confianza": 0.8, "motivo": "benchmark"} for code in codes]}
+        else:
+            content = {"region": "PC", "confianza": 0.7, "motivo": "benchmark"}
+        return json.dumps(content)
+
+
+def measure(function: Callable[[], Any], *, iterations: int, warmup: int = 3) -> dict[str, float]:
+    for _ in range(warmup):
+        function()
+    samples: list[float] = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1_000_000)
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "mean_us": round(statistics.fmean(samples), 2),
+        "median_us": round(statistics.median(samples), 2),
+        "p95_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+        "min_us": round(samples[0], 2),
+        "max_us": round(samples[-1], 2),
+    }
+
+
+def measure_first_suggestion(search: Callable[[Callable[[dict[str, Any]], None]], Any], *, iterations: int) -> dict[str, float]:
+    """Like ``measure`` but times the first streamed suggestion instead of the whole call."""
+    samples: list[float] = []
+    for _ in range(iterations):
+        first: list[float] = []
+        start = time.perf_counter()
+        search(lambda suggestion: first or first.append(time.perf_counter() - start))
+        if first:
+            samples.append(first[0] * 1_000_000)
+    if not samples:
+        return {"iterations": 0}
+    samples.sort()
+    return {
+        "iterations": len(samples),
+        "mean_us": round(statistics.fmean(samples), 2),
+        "median_us": round(statistics.median(samples), 2),
+        "p95_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+        "min_us": round(samples[0], 2),
+        "max_us": round(samples[-1], 2),
+    }
+
+
+def cycle(values: list[str]) -> Callable[[], str]:
+    position = -1
+
+    def next_value() -> str:
+        nonlocal position
+        position = (position + 1) % len(values)
+        return values[position]
+
+    return next_value
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    df = nunbot_core.load_nun_data()
+    query = cycle(QUERIES)
+    unanchored = cycle(UNANCHORED_QUERIES)
+    typo = cycle(TYPO_QUERIES)
+    bypass = cycle(BYPASS_QUERIES)
+    candidates = nunbot_core.rank_local_candidates(QUERIES[0], df, region="PC", limit=nunbot_core.DEFAULT_PROMPT_CANDIDATES)
+    scale = args.iterations
+    cache_dir = Path(args.cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    cases: dict[str, Callable[[], Any]] = {
+        "normalize_search_query": lambda: nunbot_core.normalize_search_query(query()),
+        "tokenize_query": lambda: nunbot_core.tokenize_query(query()),
+        "determine_region_locally": lambda: nunbot_core.determine_region_locally(query()),
+        "rank_local_candidates[heuristic,region]": lambda: nunbot_core.rank_local_candidates(query(), df, region="PC"),
+        "rank_local_candidates[heuristic,all]": lambda: nunbot_core.rank_local_candidates(query(), df),
+        "rank_local_candidates[heuristic,typo]": lambda: nunbot_core.rank_local_candidates(typo(), df),
+        "rank_local_candidates[bm25,all]": lambda: nunbot_core.rank_local_candidates(query(), df, scoring="bm25"),
+        "build_search_prompt": lambda: nunbot_core.build_search_prompt(query(), candidates),
+    }
+    results: dict[str, Any] = {}
+    for name, function in cases.items():
+        results[name] = measure(function, iterations=scale)
+
+    cold_import = [sys.executable, "-c", "import nunbot_core"]
+    results["cold_import[nunbot_core]"] = measure(
+        lambda: subprocess.run(cold_import, cwd=ROOT, check=True), iterations=max(5, scale // 50), warmup=1
+    )
+    results["load_nun_data"] = measure(nunbot_core.load_nun_data, iterations=max(5, scale // 50), warmup=1)
+    results["load_procedures"] = measure(nunbot_core.load_procedures, iterations=max(5, scale // 50), warmup=1)
+
+    client = FakeOpenAIClient(latency_seconds=args.latency_ms / 1000, failure_rate=args.failure_rate, seed=args.seed)
+    e2e_iterations = max(5, scale // 20)
+    # The OpenAI-path cases stay comparable across runs however the bypass gate evolves.
+    results["search_nun_codes[local_region]"] = measure(
+        lambda: nunbot_core.search_nun_codes(client, query(), df, local_bypass=False), iterations=e2e_iterations
+    )
+    results["search_nun_codes[openai_region]"] = measure(
+        lambda: nunbot_core.search_nun_codes(client, unanchored(), df, local_bypass=False), iterations=e2e_iterations
+    )
+    results["search_nun_codes[streaming,first_suggestion]"] = measure_first_suggestion(
+        lambda on_suggestion: nunbot_core.search_nun_codes(client, query(), df, on_suggestion=on_suggestion, local_bypass=False),
+        iterations=e2e_iterations,
+    )
+    results["search_nun_codes[local_bypass]"] = measure(
+        lambda: nunbot_core.search_nun_codes(client, bypass(), df, local_bypass=True), iterations=e2e_iterations
+    )
+    cache = nunbot_core.SearchResultCache(cache_dir / "bench_cache.sqlite3")
+    cache.clear()
+    results["search_nun_codes[cache_hit]"] = measure(
+        lambda: nunbot_core.search_nun_codes(client, query(), df, cache=cache), iterations=e2e_iterations, warmup=len(QUERIES)
+    )
+    results["fake_client_calls"] = client.calls
+    results["local_bypass"] = nunbot_core.get_local_bypass_monitor().stats()
+    results["prompt_tokens"] = nunbot_core.get_prompt_token_meter().stats()
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current: dict[str, Any], baseline_path: Path) -> None:
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+    print(f"\nComparación contra {baseline_path} ({baseline.get('revision', '?')}):")
+    for name, stats in current["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if not isinstance(stats, dict) or not isinstance(previous, dict) or "median_us" not in stats or "median_us" not in previous:
+            continue
+        ratio = stats["median_us"] / previous["median_us"] if previous["median_us"] else float("inf")
+        print(f"  {name:45s} {previous['median_us']:>12.1f}µs -> {stats['median_us']:>12.1f}µs  x{ratio:.2f}")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks del camino de búsqueda de NUNBot.")
+    parser.add_argument("--iterations", type=int, default=500, help="Iteraciones por caso micro (los casos end-to-end usan menos).")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latencia simulada del cliente OpenAI falso.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probabilidad de fallo por llamada al cliente falso.")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="benchmarks/results/latest.json", help="Archivo JSON de salida.")
+    parser.add_argument("--cache-dir", default="benchmarks/results", help="Directorio para la caché SQLite del caso cache_hit.")
+    parser.add_argument("--compare", type=Path, help="JSON de una corrida anterior para comparar medianas.")
+    args = parser.parse_args(argv)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"iterations": args.iterations, "latency_ms": args.latency_ms, "failure_rate": args.failure_rate, "seed": args.seed},
+        "results": run(args),
+    }
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+    for name, stats in report["results"].items():
+        if isinstance(stats, dict) and "median_us" in stats:
+            print(f"{name:45s} median={stats['median_us']:>12.1f}µs p95={stats['p95_us']:>12.1f}µs")
+    print(f"\nResultados escritos en {output}")
+    if args.compare:
+        compare(report, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
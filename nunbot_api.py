@@ -0,0 +1,243 @@
+"""Headless JSON API for NUNBot, meant to run next to the Streamlit app.
+
+Endpoints:
+- ``GET /health`` → runtime checks
+- ``POST /validate`` with ``{"descripcion": "..."}`` → query validation
+- ``POST /search`` with ``{"descripcion": "..."}`` → suggested NUN codes with fees
+- ``GET /codes/<codigo>`` → catalogue row for a code, with any other rows sharing it in ``alternativas``
+- ``GET /metrics`` → process-wide search counters
+
+Run with ``python -m nunbot_api --host 0.0.0.0 --port 8000``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Any, Sequence
+from urllib.parse import unquote, urlsplit
+
+from nunbot_core import (
+    DEFAULT_MODEL,
+    SearchResultCache,
+    check_runtime_health,
+    get_env_int,
+    get_nun_index,
+    get_local_bypass_monitor,
+    get_openai_circuit_breaker,
+    get_openai_rate_limiter,
+    get_prompt_token_meter,
+    get_search_cache,
+    get_search_single_flight,
+    load_procedures,
+    procedure_records_by_code,
+    search_nun_codes,
+    search_result_payload,
+    validate_search_query,
+)
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+    from nunbot_core import ProcedureData
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_HOST = os.getenv("NUNBOT_API_HOST", "127.0.0.1")
+DEFAULT_API_PORT = get_env_int("NUNBOT_API_PORT", 8000, minimum=0)
+MAX_REQUEST_BYTES = 64 * 1024
+
+
+class NunbotHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        server_address: tuple[str, int],
+        *,
+        client: OpenAI,
+        procedures_data: ProcedureData,
+        cache: SearchResultCache | None = None,
+        model: str = DEFAULT_MODEL,
+    ):
+        super().__init__(server_address, NunbotRequestHandler)
+        self.client = client
+        self.procedures_data = procedures_data
+        self.cache = cache
+        self.model = model
+        self.records_by_code = procedure_records_by_code(procedures_data)
+        self.index, _ = get_nun_index(procedures_data)
+
+
+class NunbotRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests from the same client.
+    protocol_version = "HTTP/1.1"
+    server: NunbotHTTPServer
+
+    def do_GET(self) -> None:
+        self._discard_body()
+        path = urlsplit(self.path).path
+        if path == "/health":
+            issues = check_runtime_health(require_openai_key=False)
+            self._send_json(HTTPStatus.OK if not issues else HTTPStatus.SERVICE_UNAVAILABLE, {"ok": not issues, "problemas": issues})
+        elif path == "/metrics":
+            metrics = {
+                "single_flight": get_search_single_flight().stats(),
+                "openai": get_openai_rate_limiter().stats(),
+                "circuit": get_openai_circuit_breaker().stats(),
+                "bypass": get_local_bypass_monitor().stats(),
+                "prompt_tokens": get_prompt_token_meter().stats(),
+            }
+            self._send_json(HTTPStatus.OK, metrics)
+        elif path.startswith("/codes/"):
+            code = unquote(path[len("/codes/") :]).strip()
+            records = self.server.index.records_for_code(code)
+            if not records:
+                self._send_json(HTTPStatus.NOT_FOUND, {"error": f"Código {code} no encontrado"})
+            else:
+                # The first row is canonical; the catalogue repeats a few codes (RO.08.02) for other procedures.
+                payload = records[0].to_dict()
+                payload["alternativas"] = [record.to_dict() for record in records[1:]]
+                self._send_json(HTTPStatus.OK, payload)
+        else:
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": "Ruta no encontrada"})
+
+    def do_POST(self) -> None:
+        path = urlsplit(self.path).path
+        if path not in ("/search", "/validate"):
+            self._discard_body()
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": "Ruta no encontrada"})
+            return
+
+        payload = self._read_json()
+        if payload is None:
+            return
+        description = payload.get("descripcion")
+        if not isinstance(description, str):
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": "El campo 'descripcion' es obligatorio."})
+            return
+
+        is_valid, message = validate_search_query(description)
+        if path == "/validate":
+            self._send_json(HTTPStatus.OK, {"valido": is_valid, "mensaje": message})
+            return
+        if not is_valid:
+            self._send_json(HTTPStatus.UNPROCESSABLE_ENTITY, {"error": message})
+            return
+
+        try:
+            result = search_nun_codes(
+                self.server.client,
+                description,
+                self.server.procedures_data,
+                model=self.server.model,
+                cache=self.server.cache,
+            )
+        except Exception:
+            logger.exception("api_search_failed")
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Error interno durante la búsqueda."})
+            return
+        self._send_json(HTTPStatus.OK, search_result_payload(result, self.server.records_by_code))
+
+    def _content_length(self) -> int:
+        """Declared body length, or -1 when it is malformed or the body is chunked."""
+        if self.headers.get("Transfer-Encoding"):
+            return -1
+        try:
+            return int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            return -1
+
+    def _discard_body(self) -> None:
+        # Unread body bytes would be parsed as the next request on this kept-alive connection.
+        length = self._content_length()
+        if 0 <= length <= MAX_REQUEST_BYTES:
+            self.rfile.read(length)
+        else:
+            self.close_connection = True
+
+    def _read_json(self) -> dict[str, Any] | None:
+        length = self._content_length()
+        if length < 0 or length > MAX_REQUEST_BYTES:
+            self.close_connection = True
+            self._send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "Cuerpo de la solicitud inválido o demasiado grande."})
+            return None
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": "JSON inválido."})
+            return None
+        if not isinstance(payload, dict):
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": "Se esperaba un objeto JSON."})
+            return None
+        return payload
+
+    def _send_json(self, status: HTTPStatus, payload: Any) -> None:
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.info("api_request %s %s", self.address_string(), format % args)
+
+
+def create_server(
+    host: str = DEFAULT_API_HOST,
+    port: int = DEFAULT_API_PORT,
+    *,
+    client: OpenAI,
+    procedures_data: ProcedureData,
+    cache: SearchResultCache | None = None,
+    model: str = DEFAULT_MODEL,
+) -> NunbotHTTPServer:
+    return NunbotHTTPServer((host, port), client=client, procedures_data=procedures_data, cache=cache, model=model)
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m nunbot_api", description="API HTTP JSON de NUNBot.")
+    parser.add_argument("--host", default=DEFAULT_API_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_API_PORT)
+    parser.add_argument("--data", help="Ruta alternativa a nun_procedimientos.csv.")
+    parser.add_argument("--no-cache", action="store_true", help="No usar la caché persistente de resultados.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    issues = check_runtime_health(args.data)
+    if issues:
+        for issue in issues:
+            logger.error(issue)
+        return 1
+
+    from openai import OpenAI
+
+    server = create_server(
+        args.host,
+        args.port,
+        client=OpenAI(),
+        procedures_data=load_procedures(args.data),
+        cache=None if args.no_cache else get_search_cache(),
+    )
+    logger.info("api_listening host=%s port=%s", args.host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
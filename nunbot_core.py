@@ -1,21 +1,50 @@
 from __future__ import annotations
 
+import argparse
+import bisect
+import contextvars
+import csv
+import hashlib
 import json
 import logging
+import math
 import os
+import random
 import re
+import shutil
+import sqlite3
+import sys
+import threading
 import time
 import unicodedata
-from dataclasses import dataclass
+import zlib
+from collections import Counter, deque
+from collections.abc import Mapping
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field, fields, replace
+from enum import StrEnum
+from itertools import chain
 from pathlib import Path
-from typing import Any, Iterable, cast
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator, Sequence, TextIO, cast, overload
 
-import pandas as pd
-from openai import OpenAI
+# pandas, numpy, scipy and the OpenAI SDK are imported where they are first
+# needed so that validation, health checks and the CLI start quickly.
+if TYPE_CHECKING:
+    from concurrent.futures import Future, ThreadPoolExecutor
+    from typing import TypeAlias
+
+    import pandas as pd
+    from openai import AsyncOpenAI, OpenAI
+
+    # Search functions accept the DataFrame from ``load_nun_data`` or the
+    # pandas-free ``ProcedureCatalog`` from ``load_procedures``.
+    ProcedureData: TypeAlias = "pd.DataFrame | ProcedureCatalog"
 
 logger = logging.getLogger(__name__)
 
-def _get_env_int(name: str, default: int) -> int:
+
+def get_env_int(name: str, default: int, *, minimum: int = 1) -> int:
+    """Integer setting ``name``, at least ``minimum``; ``default`` when unset or not a number."""
     raw = os.getenv(name)
     if raw is None or not raw.strip():
         return default
@@ -23,19 +52,93 @@ def _get_env_int(name: str, default: int) -> int:
         value = int(raw)
     except ValueError:
         return default
-    return max(1, value)
+    return max(minimum, value)
+
+
+def _get_env_bool(name: str, default: bool) -> bool:
+    raw = (os.getenv(name) or "").strip().lower()
+    if not raw:
+        return default
+    return raw in {"1", "true", "yes", "on"}
+
+
+def _get_env_float(name: str, default: float) -> float:
+    raw = os.getenv(name)
+    if raw is None or not raw.strip():
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        return default
+
+
+def _get_env_choice(name: str, default: str, choices: Iterable[str]) -> str:
+    raw = (os.getenv(name) or "").strip().lower()
+    return raw if raw in choices else default
 
 
-REGIONS = ("MS", "CO", "PC", "RO", "PP")
+class Region(StrEnum):
+    MS = "MS"
+    CO = "CO"
+    PC = "PC"
+    RO = "RO"
+    PP = "PP"
+
+
+REGIONS = tuple(region.value for region in Region)
 DEFAULT_MODEL = os.getenv("NUNBOT_MODEL", "gpt-4o")
 DEFAULT_REGION_MAX_TOKENS = 250
 DEFAULT_SEARCH_MAX_TOKENS = 1200
-DEFAULT_TIMEOUT_SECONDS = _get_env_int("NUNBOT_TIMEOUT_SECONDS", 30)
-DEFAULT_RETRY_ATTEMPTS = _get_env_int("NUNBOT_RETRY_ATTEMPTS", 2)
-DEFAULT_MIN_QUERY_LENGTH = _get_env_int("NUNBOT_MIN_QUERY_LENGTH", 8)
-DEFAULT_MAX_QUERY_LENGTH = _get_env_int("NUNBOT_MAX_QUERY_LENGTH", 500)
-DEFAULT_TOP_CANDIDATES = _get_env_int("NUNBOT_TOP_CANDIDATES", 25)
-DEFAULT_PROMPT_CANDIDATES = _get_env_int("NUNBOT_PROMPT_CANDIDATES", 12)
+DEFAULT_TIMEOUT_SECONDS = get_env_int("NUNBOT_TIMEOUT_SECONDS", 30)
+DEFAULT_RETRY_ATTEMPTS = get_env_int("NUNBOT_RETRY_ATTEMPTS", 2)
+# Defaults match OpenAI's first usage tier for gpt-4o; raise them for higher tiers.
+DEFAULT_OPENAI_REQUESTS_PER_MINUTE = get_env_int("NUNBOT_OPENAI_RPM", 500, minimum=0)
+DEFAULT_OPENAI_TOKENS_PER_MINUTE = get_env_int("NUNBOT_OPENAI_TPM", 30000, minimum=0)
+DEFAULT_OPENAI_MAX_CONCURRENCY = get_env_int("NUNBOT_OPENAI_MAX_CONCURRENCY", 8, minimum=0)
+DEFAULT_OPENAI_MAX_QUEUE = get_env_int("NUNBOT_OPENAI_MAX_QUEUE", 32, minimum=0)
+DEFAULT_OPENAI_MAX_WAIT_SECONDS = _get_env_float("NUNBOT_OPENAI_MAX_WAIT_SECONDS", 10.0)
+DEFAULT_CIRCUIT_FAILURE_THRESHOLD = get_env_int("NUNBOT_CIRCUIT_FAILURE_THRESHOLD", 5)
+DEFAULT_CIRCUIT_RESET_SECONDS = _get_env_float("NUNBOT_CIRCUIT_RESET_SECONDS", 30.0)
+# Total time allowed for one search, OpenAI retries and backoff included; 0 means unbounded.
+DEFAULT_SEARCH_DEADLINE_SECONDS = _get_env_float("NUNBOT_SEARCH_DEADLINE_SECONDS", 0.0)
+DEFAULT_MIN_QUERY_LENGTH = get_env_int("NUNBOT_MIN_QUERY_LENGTH", 8)
+DEFAULT_MAX_QUERY_LENGTH = get_env_int("NUNBOT_MAX_QUERY_LENGTH", 500)
+DEFAULT_TOP_CANDIDATES = get_env_int("NUNBOT_TOP_CANDIDATES", 25)
+DEFAULT_PROMPT_CANDIDATES = get_env_int("NUNBOT_PROMPT_CANDIDATES", 12)
+DEFAULT_PROMPT_TOKEN_BUDGET = get_env_int("NUNBOT_PROMPT_TOKEN_BUDGET", 1200, minimum=0)
+# Adaptive prompt size: between the minimum and NUNBOT_PROMPT_CANDIDATES, cut at
+# the largest score drop when it carries this share of the window's decline.
+DEFAULT_PROMPT_CANDIDATES_MIN = get_env_int("NUNBOT_PROMPT_CANDIDATES_MIN", 6)
+DEFAULT_PROMPT_DROP_OFF = _get_env_float("NUNBOT_PROMPT_DROP_OFF", 0.35)
+DEFAULT_CACHE_TTL_SECONDS = get_env_int("NUNBOT_CACHE_TTL_SECONDS", 7 * 24 * 3600)
+DEFAULT_CACHE_MAX_ENTRIES = get_env_int("NUNBOT_CACHE_MAX_ENTRIES", 5000)
+# Minimum trigram Jaccard similarity for reusing the cached result of a
+# rephrased query; 0 disables near-duplicate lookups.
+DEFAULT_CACHE_SIMILARITY_THRESHOLD = _get_env_float("NUNBOT_CACHE_SIMILARITY_THRESHOLD", 0.85)
+DEFAULT_BATCH_CONCURRENCY = get_env_int("NUNBOT_BATCH_CONCURRENCY", 4)
+DEFAULT_USE_DATA_SNAPSHOT = _get_env_bool("NUNBOT_DATA_SNAPSHOT", True)
+DEFAULT_SPECULATIVE_RANKING = _get_env_bool("NUNBOT_SPECULATIVE_RANKING", False)
+DEFAULT_COALESCE_SEARCHES = _get_env_bool("NUNBOT_COALESCE_SEARCHES", True)
+# Local bypass gate, calibrated on catalogue phrases: every phrase match with a
+# margin of 0.10 or more already ranked the right code first. Opt-in: answering
+# without the model is a product decision, not a default.
+DEFAULT_LOCAL_BYPASS = _get_env_bool("NUNBOT_LOCAL_BYPASS", False)
+DEFAULT_BYPASS_MIN_MARGIN = _get_env_float("NUNBOT_BYPASS_MIN_MARGIN", 0.25)
+DEFAULT_BYPASS_MIN_REGION_CONFIDENCE = _get_env_float("NUNBOT_BYPASS_MIN_REGION_CONFIDENCE", 0.6)
+DEFAULT_BYPASS_AUDIT_RATE = _get_env_float("NUNBOT_BYPASS_AUDIT_RATE", 0.05)
+DEFAULT_BYPASS_MAX_PENDING_AUDITS = get_env_int("NUNBOT_BYPASS_MAX_PENDING_AUDITS", 4, minimum=0)
+# File that receives one OTLP/JSON line per search trace; empty disables the export.
+DEFAULT_TRACE_EXPORT_PATH = os.getenv("NUNBOT_TRACE_EXPORT_PATH", "").strip()
+SCORING_BACKENDS = ("heuristic", "bm25")
+DEFAULT_SCORING_BACKEND = _get_env_choice("NUNBOT_SCORING_BACKEND", "heuristic", SCORING_BACKENDS)
+DEFAULT_FUZZY_MATCHING = _get_env_bool("NUNBOT_FUZZY_MATCHING", True)
+DEFAULT_REGION_HINTS_PATH = (os.getenv("NUNBOT_REGION_HINTS_PATH") or "").strip()
+
+# BM25F parameters: per-field weights and length normalization for the
+# inverted-index backend.
+BM25_K1 = 1.2
+BM25_FIELD_WEIGHTS = {"description": 1.0, "keywords": 1.5}
+BM25_FIELD_B = {"description": 0.75, "keywords": 0.5}
 
 STOPWORDS = {
     "a",
@@ -56,6 +159,30 @@ STOPWORDS = {
     "y",
 }
 
+# Never dropped by the near-duplicate cache: "sin placa" is not "con placa".
+NEGATION_TERMS = frozenset({"sin", "no"})
+# Side and position qualifiers; a medial and a lateral meniscectomy are different codes.
+LATERALITY_TERMS = frozenset(
+    {
+        "derecho",
+        "derecha",
+        "izquierdo",
+        "izquierda",
+        "bilateral",
+        "unilateral",
+        "medial",
+        "lateral",
+        "interno",
+        "interna",
+        "externo",
+        "externa",
+        "proximal",
+        "distal",
+        "anterior",
+        "posterior",
+    }
+)
+
 REGION_HINTS = {
     "MS": {
         "hombro",
@@ -125,12 +252,786 @@ REGION_HINTS = {
 }
 
 
+NUN_INDEX_ATTR = "nun_index"
+# Columns compared before a frame reuses the index carried in its ``attrs``.
+INDEX_CHECKED_COLUMNS = ("Código", "Descripción")
+SNAPSHOT_FORMAT_VERSION = 6
+CURRENCY_COLUMNS = ("Cirujano", "Ayudantes", "Total")
+SUBSTRING_CACHE_SIZE = 4096
+# Cache miss marker; None is a valid cached typo correction.
+_MISSING: Any = object()
+# Typo correction: query terms absent from the catalogue vocabulary are
+# replaced by the closest vocabulary term by character-trigram Dice similarity.
+FUZZY_MIN_TERM_LENGTH = 5
+FUZZY_MIN_SIMILARITY = 0.6
+FUZZY_MAX_LENGTH_DIFFERENCE = 2
+BATCH_CHUNK_SIZE = 512
+MAX_SUGGESTIONS = 5
+
+
 @dataclass(frozen=True)
 class OpenAIResult:
     content: str
     raw: Any
 
 
+@dataclass
+class SearchResult:
+    """Outcome of ``search_nun_codes``.
+
+    Unpacks like the historical ``(region, confidence, reason, suggestions,
+    local_candidates, used_fallback)`` tuple. ``path`` records how the result
+    was produced: ``local_region`` (region detected locally), ``sequential``
+    (OpenAI region, then ranking), ``speculative`` (the ranking started in
+    parallel with region inference was kept) or ``speculative_reissued``
+    (the regions disagreed and ranking was repeated inside the region).
+    ``similarity`` is set when the result was reused from the cache for a
+    rephrased query: the trigram Jaccard similarity of the two descriptions.
+    ``partial`` is True when the search deadline cut a stage short, so the
+    suggestions are local candidates or an incomplete model answer.
+    ``prompt_count`` is how many local candidates were offered to the model and
+    ``prompt_reason`` why (see ``_adaptive_prompt_count``; ``short_list`` and
+    ``unscored`` when the shortlist itself decided).
+    ``trace`` holds the timed stages of the search that returned this result
+    (see ``SearchTrace``); it is not part of ``to_dict`` and is never cached.
+    """
+
+    region: str
+    confidence: float
+    reason: str
+    suggestions: list[dict[str, Any]]
+    local_candidates: list[Mapping[str, Any]]
+    used_fallback: bool
+    path: str = field(default="local_region", compare=False)
+    cached: bool = field(default=False, compare=False)
+    similarity: float | None = field(default=None, compare=False)
+    partial: bool = field(default=False, compare=False)
+    prompt_count: int | None = field(default=None, compare=False)
+    prompt_reason: str = field(default="", compare=False)
+    trace: SearchTrace | None = field(default=None, compare=False, repr=False)
+
+    def __iter__(self):
+        return iter((self.region, self.confidence, self.reason, self.suggestions, self.local_candidates, self.used_fallback))
+
+    def to_dict(self) -> dict[str, Any]:
+        payload = {item.name: getattr(self, item.name) for item in fields(self) if item.name != "trace"}
+        payload["suggestions"] = [dict(suggestion) for suggestion in self.suggestions]
+        payload["local_candidates"] = [dict(candidate) for candidate in self.local_candidates]
+        return payload
+
+    @classmethod
+    def from_dict(cls, payload: dict[str, Any]) -> SearchResult:
+        return cls(
+            region=str(payload["region"]),
+            confidence=float(payload["confidence"]),
+            reason=str(payload["reason"]),
+            suggestions=list(payload["suggestions"]),
+            local_candidates=list(payload["local_candidates"]),
+            used_fallback=bool(payload["used_fallback"]),
+            path=str(payload.get("path", "local_region")),
+            cached=bool(payload.get("cached", False)),
+            similarity=payload.get("similarity"),
+            partial=bool(payload.get("partial", False)),
+            prompt_count=payload.get("prompt_count"),
+            prompt_reason=str(payload.get("prompt_reason", "")),
+        )
+
+
+class Procedure(Mapping[str, Any]):
+    """One catalogue row as a compact, read-only record.
+
+    The values live in a tuple and the column layout is shared by every row of
+    a catalogue, so a row costs one small object instead of a dict. It reads
+    like the row dict (``row["Código"]``, ``row.get("Total", 0)``); ``code`` is
+    interned and ``region`` is a ``Region`` whenever the row's region is known.
+    ``prompt_line`` is the row as listed in ranking prompts.
+    """
+
+    __slots__ = ("_layout", "_values", "code", "region", "prompt_line", "prompt_tokens")
+
+    def __init__(
+        self,
+        layout: dict[str, int],
+        values: Sequence[Any],
+        *,
+        prompt_line: str | None = None,
+        prompt_tokens: int | None = None,
+    ):
+        self._layout = layout
+        self._values = tuple(values)
+        self.code: str = sys.intern(str(self.get("Código", "")))
+        region = str(self.get("Región", "")).strip().upper()
+        self.region: Region | str = Region(region) if region in REGIONS else region
+        # Formatted once at load time (or read back from the data snapshot); every
+        # ranking prompt reuses it (the +1 is the newline).
+        self.prompt_line = _format_candidate_row(self) if prompt_line is None else prompt_line
+        self.prompt_tokens = estimate_tokens(self.prompt_line) + 1 if prompt_tokens is None else prompt_tokens
+
+    @classmethod
+    def from_mapping(cls, record: Mapping[str, Any]) -> Procedure:
+        if isinstance(record, Procedure):
+            return record
+        return cls({column: position for position, column in enumerate(record)}, record.values())
+
+    def __getitem__(self, column: str) -> Any:
+        return self._values[self._layout[column]]
+
+    def __iter__(self):
+        return iter(self._layout)
+
+    def __len__(self) -> int:
+        return len(self._layout)
+
+    def __contains__(self, column: object) -> bool:
+        return column in self._layout
+
+    def get(self, column: str, default: Any = None) -> Any:
+        position = self._layout.get(column)
+        return default if position is None else self._values[position]
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(zip(self._layout, self._values))
+
+    def __repr__(self) -> str:
+        return f"Procedure({self.to_dict()!r})"
+
+
+@dataclass(frozen=True, slots=True)
+class IndexedProcedure:
+    """One catalogue row with every field the local scorer needs, normalized once."""
+
+    record: Procedure
+    code: str
+    region: Region | str
+    description: str
+    keywords: str
+    code_text: str
+    blob: str
+    description_tokens: tuple[str, ...]
+    keyword_tokens: tuple[str, ...]
+    description_terms: frozenset[str]
+    keyword_terms: frozenset[str]
+
+    @classmethod
+    def from_record(cls, record: Mapping[str, Any]) -> IndexedProcedure:
+        procedure = Procedure.from_mapping(record)
+        description = str(procedure.get("Descripción", ""))
+        keywords = str(procedure.get("Palabras clave", ""))
+        code = procedure.code
+        region = str(procedure.get("Región", ""))
+        description_tokens = tuple(tokenize_query(description))
+        keyword_tokens = tuple(tokenize_query(keywords))
+        return cls(
+            record=procedure,
+            code=code,
+            region=procedure.region,
+            description=normalize_search_query(description),
+            keywords=normalize_search_query(keywords),
+            code_text=normalize_search_query(code),
+            blob=normalize_search_query(" ".join((code, description, keywords, region))),
+            description_tokens=description_tokens,
+            keyword_tokens=keyword_tokens,
+            description_terms=frozenset(description_tokens),
+            keyword_terms=frozenset(keyword_tokens),
+        )
+
+    @classmethod
+    def from_normalized(cls, record: Procedure, description: str, keywords: str, code_text: str, blob: str) -> IndexedProcedure:
+        """Rebuild a row from fields that were already normalized (see ``_load_data_snapshot``)."""
+        description_tokens = tuple(token for token in description.split() if token not in STOPWORDS)
+        keyword_tokens = tuple(token for token in keywords.split() if token not in STOPWORDS)
+        return cls(
+            record=record,
+            code=record.code,
+            region=record.region,
+            description=description,
+            keywords=keywords,
+            code_text=code_text,
+            blob=blob,
+            description_tokens=description_tokens,
+            keyword_tokens=keyword_tokens,
+            description_terms=frozenset(description_tokens),
+            keyword_terms=frozenset(keyword_tokens),
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class _PreparedQuery:
+    normalized: str
+    terms: tuple[str, ...]
+    term_set: frozenset[str]
+
+
+def _prepare_query(query: str) -> _PreparedQuery:
+    normalized = normalize_search_query(query)
+    terms = tuple(token for token in normalized.split() if token not in STOPWORDS)
+    return _PreparedQuery(normalized, terms, frozenset(terms))
+
+
+def _score_indexed(query: _PreparedQuery, row: IndexedProcedure, region: str | None = None) -> float:
+    if not query.normalized or not query.terms:
+        return 0.0
+
+    score = 0.0
+    if region and row.region == region.upper():
+        score += 3.0
+
+    if query.normalized in row.description:
+        score += 8.0
+    if query.normalized in row.keywords:
+        score += 6.0
+    if query.normalized in row.code_text:
+        score += 2.0
+
+    score += len(row.description_terms.intersection(query.term_set)) * 1.5
+    score += len(row.keyword_terms.intersection(query.term_set)) * 2.0
+
+    # Mild boost for exact phrase fragments present anywhere in the row blob.
+    for term in query.terms:
+        if term in row.blob:
+            score += 0.5
+
+    return score
+
+
+class NunIndex:
+    """In-memory search index over the NUN catalogue.
+
+    Built once by ``load_nun_data`` and attached to the returned DataFrame, so
+    every query reuses the normalized fields, token sets and search blobs
+    instead of recomputing them row by row.
+    """
+
+    def __init__(self, rows: Sequence[IndexedProcedure], labels: Sequence[Any] | None = None):
+        self.rows: tuple[IndexedProcedure, ...] = tuple(rows)
+        self.labels: tuple[Any, ...] = tuple(labels) if labels is not None else tuple(range(len(self.rows)))
+        self._position_by_label = {label: position for position, label in enumerate(self.labels)}
+        self._labels_are_range = self.labels == tuple(range(len(self.rows)))
+        self._substring_cache: dict[str, frozenset[int]] = {}
+        # All blobs joined by newlines (never produced by normalization), so a
+        # substring search is a few str.find calls instead of a per-row scan.
+        self._joined_blobs = "\n".join(row.blob for row in self.rows)
+        self._blob_offsets: list[int] = []
+        offset = 0
+        for row in self.rows:
+            self._blob_offsets.append(offset)
+            offset += len(row.blob) + 1
+        self._bm25_postings: dict[str, tuple[tuple[int, float], ...]] | None = None
+        self._term_matrices: dict[str, tuple[dict[str, int], Any]] = {}
+        self._fingerprint: str | None = None
+        self._checked_values: dict[str, list[Any]] = {}
+        # Vocabulary (term -> rows using it) and trigram -> terms postings for typo correction.
+        self._term_frequencies: dict[str, int] = {}
+        for row in self.rows:
+            for term in row.description_terms | row.keyword_terms:
+                self._term_frequencies[term] = self._term_frequencies.get(term, 0) + 1
+        self._trigram_terms: dict[str, list[str]] = {}
+        for term in sorted(self._term_frequencies):
+            for trigram in _term_trigrams(term):
+                self._trigram_terms.setdefault(trigram, []).append(term)
+        self._corrections: dict[str, str | None] = {}
+        # Code lookups: the first row wins, as in the prompt and display paths.
+        # Later rows sharing a code (RO.08.02 appears twice in the March 2026
+        # catalogue) stay reachable through ``duplicate_codes``.
+        self._records_by_code: dict[str, Procedure] = {}
+        duplicates: dict[str, list[int]] = {}
+        first_position: dict[str, int] = {}
+        for position, row in enumerate(self.rows):
+            code = row.code.strip()
+            if not code:
+                continue
+            if code in first_position:
+                duplicates.setdefault(code, [first_position[code]]).append(position)
+            else:
+                first_position[code] = position
+                self._records_by_code[code] = row.record
+        self.duplicate_codes: dict[str, tuple[int, ...]] = {code: tuple(positions) for code, positions in duplicates.items()}
+
+    @classmethod
+    def from_dataframe(cls, procedures_data: pd.DataFrame) -> NunIndex:
+        layout = {column: position for position, column in enumerate(procedures_data.columns)}
+        columns = [procedures_data.iloc[:, position].tolist() for position in range(len(layout))]
+        rows = [IndexedProcedure.from_record(Procedure(layout, values)) for values in zip(*columns)]
+        return cls(rows, procedures_data.index.tolist())
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def records_by_code(self) -> Mapping[str, Procedure]:
+        """Code -> first catalogue row with that code; shared, do not mutate."""
+        return self._records_by_code
+
+    def records_for_code(self, code: str) -> tuple[Procedure, ...]:
+        """Every row with ``code``, first (canonical) row first; empty when unknown."""
+        code = code.strip()
+        if code in self.duplicate_codes:
+            return tuple(self.rows[position].record for position in self.duplicate_codes[code])
+        record = self._records_by_code.get(code)
+        return (record,) if record is not None else ()
+
+    def fingerprint(self, positions: Iterable[int] | None = None) -> str:
+        """Short hash of the selected rows (all rows by default); the full-catalogue value is memoized."""
+        selected = list(range(len(self.rows))) if positions is None else list(positions)
+        whole = selected == list(range(len(self.rows)))
+        if whole and self._fingerprint is not None:
+            return self._fingerprint
+
+        digest = hashlib.sha256()
+        for position in selected:
+            record = self.rows[position].record.to_dict()
+            digest.update(json.dumps(record, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+            digest.update(b"\n")
+        value = digest.hexdigest()[:16]
+        if whole:
+            self._fingerprint = value
+        return value
+
+    def __deepcopy__(self, memo: dict[int, Any]) -> NunIndex:
+        # pandas deep-copies ``attrs`` into every derived frame; the index is
+        # read-only, so filtered views can share it.
+        return self
+
+    def positions_for(self, procedures_data: pd.DataFrame) -> list[int] | None:
+        """Map the rows of ``procedures_data`` to index positions, or None if it holds unknown or edited rows.
+
+        Derived frames carry this index in their ``attrs`` whatever was done to
+        them, so the row labels alone do not prove the rows are the indexed
+        ones: their codes and descriptions must also match.
+        """
+        labels = procedures_data.index
+        # Fast path for the untouched frame from ``load_nun_data`` (a RangeIndex).
+        if self._labels_are_range and (getattr(labels, "start", None), getattr(labels, "step", None), len(labels)) == (0, 1, len(self.rows)):
+            return list(range(len(self.rows))) if self._holds_rows(procedures_data) else None
+        if not procedures_data.index.is_unique:
+            return None
+        positions: list[int] = []
+        for label in procedures_data.index:
+            position = self._position_by_label.get(label)
+            if position is None:
+                return None
+            positions.append(position)
+        return positions if self._holds_rows(procedures_data, positions) else None
+
+    def _holds_rows(self, procedures_data: pd.DataFrame, positions: list[int] | None = None) -> bool:
+        """Whether the checked columns of ``procedures_data`` equal the indexed rows at ``positions`` (all rows by default)."""
+        for column in INDEX_CHECKED_COLUMNS:
+            if column not in procedures_data.columns:
+                return False
+            indexed = self._column_values(column)
+            expected = indexed if positions is None else [indexed[position] for position in positions]
+            if procedures_data[column].tolist() != expected:
+                return False
+        return True
+
+    def _column_values(self, column: str) -> list[Any]:
+        values = self._checked_values.get(column)
+        if values is None:
+            values = self._checked_values[column] = [row.record.get(column) for row in self.rows]
+        return values
+
+    def rows_containing(self, term: str) -> frozenset[int]:
+        """Positions whose search blob contains ``term`` as a substring."""
+        cached = self._substring_cache.get(term, _MISSING)
+        if cached is not _MISSING:
+            return cached
+        if len(self._substring_cache) >= SUBSTRING_CACHE_SIZE:
+            self._substring_cache.clear()
+        found: set[int] = set()
+        if term and "\n" not in term:
+            start = self._joined_blobs.find(term)
+            while start != -1:
+                position = bisect.bisect_right(self._blob_offsets, start) - 1
+                found.add(position)
+                # Jump to the next row: later hits in this blob add nothing.
+                next_offset = self._blob_offsets[position + 1] if position + 1 < len(self._blob_offsets) else len(self._joined_blobs)
+                start = self._joined_blobs.find(term, next_offset)
+        matches = frozenset(found)
+        self._substring_cache[term] = matches
+        return matches
+
+    def correct_term(self, term: str) -> str | None:
+        """Closest catalogue term for a misspelled ``term``, or None when it needs no (or has no) correction.
+
+        Only terms that appear nowhere in the catalogue are corrected, so
+        queries without typos rank exactly as before.
+        """
+        # One lookup: another thread may clear the cache between a membership test and a read.
+        cached = self._corrections.get(term, _MISSING)
+        if cached is not _MISSING:
+            return cached
+        if len(self._corrections) >= SUBSTRING_CACHE_SIZE:
+            self._corrections.clear()
+
+        correction: str | None = None
+        if (
+            len(term) >= FUZZY_MIN_TERM_LENGTH
+            and term.isalpha()
+            and term not in STOPWORDS
+            and term not in self._term_frequencies
+            and not self.rows_containing(term)
+        ):
+            trigrams = _term_trigrams(term)
+            overlaps = Counter(chain.from_iterable(self._trigram_terms.get(trigram, ()) for trigram in trigrams))
+            best_key: tuple[float, int, str] | None = None
+            for candidate, overlap in overlaps.items():
+                if abs(len(candidate) - len(term)) > FUZZY_MAX_LENGTH_DIFFERENCE:
+                    continue
+                # A padded term of length n has n trigrams (duplicates aside, which only lower the score).
+                similarity = 2 * overlap / (len(trigrams) + len(candidate))
+                # Prefer the most similar term, then the most common one, then alphabetical order.
+                key = (-similarity, -self._term_frequencies[candidate], candidate)
+                if similarity >= FUZZY_MIN_SIMILARITY and (best_key is None or key < best_key):
+                    best_key = key
+            correction = best_key[2] if best_key is not None else None
+
+        self._corrections[term] = correction
+        return correction
+
+    def correct_query(self, query: str) -> str:
+        """Normalized ``query`` with misspelled terms replaced by their closest catalogue terms."""
+        terms = normalize_search_query(query).split()
+        return " ".join(self.correct_term(term) or term for term in terms)
+
+    def score(self, query: str, position: int, region: str | None = None) -> float:
+        return _score_indexed(_prepare_query(query), self.rows[position], region=region)
+
+    def _build_bm25_postings(self) -> dict[str, tuple[tuple[int, float], ...]]:
+        """Build term -> [(position, BM25F term weight)] postings for the whole catalogue."""
+        total = len(self.rows) or 1
+        average_lengths = {
+            "description": sum(len(row.description_tokens) for row in self.rows) / total or 1.0,
+            "keywords": sum(len(row.keyword_tokens) for row in self.rows) / total or 1.0,
+        }
+
+        pseudo_frequencies: dict[str, dict[int, float]] = {}
+        for position, row in enumerate(self.rows):
+            for field_name, tokens in (("description", row.description_tokens), ("keywords", row.keyword_tokens)):
+                if not tokens:
+                    continue
+                b = BM25_FIELD_B[field_name]
+                length_norm = 1.0 - b + b * (len(tokens) / average_lengths[field_name])
+                weight = BM25_FIELD_WEIGHTS[field_name] / length_norm
+                for token in tokens:
+                    by_position = pseudo_frequencies.setdefault(token, {})
+                    by_position[position] = by_position.get(position, 0.0) + weight
+
+        postings: dict[str, tuple[tuple[int, float], ...]] = {}
+        for token, by_position in pseudo_frequencies.items():
+            document_frequency = len(by_position)
+            idf = math.log(1.0 + (total - document_frequency + 0.5) / (document_frequency + 0.5))
+            postings[token] = tuple(
+                (position, idf * frequency / (BM25_K1 + frequency)) for position, frequency in sorted(by_position.items())
+            )
+        return postings
+
+    def bm25_scores(self, query: str, positions: Iterable[int] | None = None) -> dict[int, float]:
+        """BM25F scores for the rows that share at least one term with ``query``."""
+        if self._bm25_postings is None:
+            self._bm25_postings = self._build_bm25_postings()
+        allowed = set(positions) if positions is not None else None
+
+        scores: dict[int, float] = {}
+        for term in dict.fromkeys(tokenize_query(query)):
+            for position, weight in self._bm25_postings.get(term, ()):
+                if allowed is None or position in allowed:
+                    scores[position] = scores.get(position, 0.0) + weight
+        return scores
+
+    def _scored_heuristic(self, query: str, candidates: list[int], region: str | None) -> list[tuple[float, str, int]]:
+        prepared = _prepare_query(query)
+        matched: set[int] = set()
+        if prepared.normalized:
+            for term in set(prepared.terms):
+                matched.update(self.rows_containing(term))
+
+        # Rows without any term in their blob can only score the region bonus,
+        # which every remaining candidate shares, so they are never rescored.
+        base_score = 3.0 if region and prepared.normalized and prepared.terms else 0.0
+        scored: list[tuple[float, str, int]] = []
+        for order, position in enumerate(candidates):
+            row = self.rows[position]
+            score = _score_indexed(prepared, row, region=region) if position in matched else base_score
+            if score > 0:
+                scored.append((score, row.code, order))
+        return scored
+
+    def _scored_bm25(self, query: str, candidates: list[int]) -> list[tuple[float, str, int]]:
+        order_by_position = {position: order for order, position in enumerate(candidates)}
+        scores = self.bm25_scores(query, order_by_position)
+        return [(score, self.rows[position].code, order_by_position[position]) for position, score in scores.items() if score > 0]
+
+    def _candidate_positions(self, positions: Iterable[int] | None, region: str | None) -> list[int]:
+        candidates = list(positions) if positions is not None else list(range(len(self.rows)))
+        if region:
+            wanted = region.upper()
+            candidates = [position for position in candidates if self.rows[position].region == wanted]
+        return candidates
+
+    def rank(
+        self,
+        query: str,
+        *,
+        region: str | None = None,
+        limit: int = DEFAULT_TOP_CANDIDATES,
+        positions: Iterable[int] | None = None,
+        scoring: str = DEFAULT_SCORING_BACKEND,
+        fuzzy: bool = DEFAULT_FUZZY_MATCHING,
+    ) -> list[Procedure]:
+        scored = self.rank_scored(query, region=region, limit=limit, positions=positions, scoring=scoring, fuzzy=fuzzy)
+        return [record for _, record in scored]
+
+    def rank_scored(
+        self,
+        query: str,
+        *,
+        region: str | None = None,
+        limit: int = DEFAULT_TOP_CANDIDATES,
+        positions: Iterable[int] | None = None,
+        scoring: str = DEFAULT_SCORING_BACKEND,
+        fuzzy: bool = DEFAULT_FUZZY_MATCHING,
+    ) -> list[tuple[float, Procedure]]:
+        """``rank`` with each record's score; the unscored fallback slice scores 0."""
+        if scoring not in SCORING_BACKENDS:
+            raise ValueError(f"Unknown scoring backend: {scoring!r}")
+        if fuzzy:
+            query = self.correct_query(query)
+
+        candidates = self._candidate_positions(positions, region)
+        if not candidates:
+            return []
+
+        if scoring == "bm25":
+            scored = self._scored_bm25(query, candidates)
+        else:
+            scored = self._scored_heuristic(query, candidates, region)
+
+        if not scored:
+            # Fallback to a safe slice of the region so the model still receives candidates.
+            return [(0.0, self.rows[position].record) for position in candidates[:limit]]
+
+        scored.sort(key=lambda item: (-item[0], item[1], item[2]))
+        return [(score, self.rows[candidates[order]].record) for score, _, order in scored[:limit]]
+
+    def _term_matrix(self, scoring: str) -> tuple[dict[str, int], Any]:
+        """Sparse rows x vocabulary matrix holding each term's contribution to a row's score."""
+        cached = self._term_matrices.get(scoring)
+        if cached is not None:
+            return cached
+
+        from scipy import sparse
+
+        if self._bm25_postings is None:
+            self._bm25_postings = self._build_bm25_postings()
+        vocabulary = {term: column for column, term in enumerate(self._bm25_postings)}
+        row_ids: list[int] = []
+        column_ids: list[int] = []
+        values: list[float] = []
+        if scoring == "bm25":
+            for term, postings in self._bm25_postings.items():
+                for position, weight in postings:
+                    row_ids.append(position)
+                    column_ids.append(vocabulary[term])
+                    values.append(weight)
+        else:
+            for position, row in enumerate(self.rows):
+                for term in row.description_terms | row.keyword_terms:
+                    row_ids.append(position)
+                    column_ids.append(vocabulary[term])
+                    values.append((1.5 if term in row.description_terms else 0.0) + (2.0 if term in row.keyword_terms else 0.0))
+
+        matrix = sparse.csr_matrix((values, (row_ids, column_ids)), shape=(len(self.rows), len(vocabulary)))
+        self._term_matrices[scoring] = (vocabulary, matrix)
+        return vocabulary, matrix
+
+    def _heuristic_batch_scores(self, prepared: list[_PreparedQuery], region: str | None) -> Any:
+        import numpy as np
+        from scipy import sparse
+
+        vocabulary, overlap = self._term_matrix("heuristic")
+        scores = (_query_matrix([query.term_set for query in prepared], vocabulary) @ overlap.T).toarray()
+
+        # Substring boosts: one row per distinct query term in this chunk.
+        term_columns: dict[str, int] = {}
+        for query in prepared:
+            for term in query.terms:
+                term_columns.setdefault(term, len(term_columns))
+        term_rows: list[int] = []
+        row_positions: list[int] = []
+        for term, column in term_columns.items():
+            matches = self.rows_containing(term)
+            term_rows.extend([column] * len(matches))
+            row_positions.extend(matches)
+        substrings = sparse.csr_matrix(
+            (np.ones(len(term_rows)), (term_rows, row_positions)), shape=(len(term_columns), len(self.rows))
+        )
+        query_ids: list[int] = []
+        term_ids: list[int] = []
+        for query_id, query in enumerate(prepared):
+            for term in query.terms:
+                query_ids.append(query_id)
+                term_ids.append(term_columns[term])
+        # Duplicate (query, term) entries are summed, so repeated terms count twice.
+        occurrences = sparse.csr_matrix((np.ones(len(query_ids)), (query_ids, term_ids)), shape=(len(prepared), len(term_columns)))
+        presence = occurrences.copy()
+        presence.data[:] = 1.0
+
+        scores += 0.5 * (occurrences @ substrings).toarray()
+        has_terms = np.array([bool(query.normalized and query.terms) for query in prepared])
+        if region:
+            scores[has_terms] += 3.0
+
+        # A full-phrase match needs every term inside the blob, so only those
+        # (query, row) pairs are checked in Python.
+        distinct_terms = np.asarray(presence.sum(axis=1)).ravel()
+        coverage = (presence @ substrings).toarray()
+        for query_id, position in np.argwhere((coverage == distinct_terms[:, None]) & has_terms[:, None]):
+            normalized = prepared[query_id].normalized
+            row = self.rows[position]
+            bonus = 0.0
+            if normalized in row.description:
+                bonus += 8.0
+            if normalized in row.keywords:
+                bonus += 6.0
+            if normalized in row.code_text:
+                bonus += 2.0
+            scores[query_id, position] += bonus
+        return scores
+
+    def rank_batch(
+        self,
+        queries: Sequence[str],
+        *,
+        region: str | None = None,
+        limit: int = DEFAULT_TOP_CANDIDATES,
+        positions: Iterable[int] | None = None,
+        scoring: str = DEFAULT_SCORING_BACKEND,
+        fuzzy: bool = DEFAULT_FUZZY_MATCHING,
+        chunk_size: int = BATCH_CHUNK_SIZE,
+    ) -> list[list[Procedure]]:
+        """Rank many queries with sparse matrix products; same results as calling ``rank`` per query."""
+        import numpy as np
+
+        if scoring not in SCORING_BACKENDS:
+            raise ValueError(f"Unknown scoring backend: {scoring!r}")
+
+        candidates = self._candidate_positions(positions, region)
+        if not candidates:
+            return [[] for _ in queries]
+
+        allowed = np.zeros(len(self.rows), dtype=bool)
+        allowed[candidates] = True
+        tiebreak = np.zeros(len(self.rows), dtype=np.int64)
+        for rank, order in enumerate(sorted(range(len(candidates)), key=lambda order: (self.rows[candidates[order]].code, order))):
+            tiebreak[candidates[order]] = rank
+
+        # Typo correction rewrites each query before scoring, exactly as ``rank`` does.
+        effective = {query: self.correct_query(query) if fuzzy else query for query in dict.fromkeys(queries)}
+        ranked_positions: dict[str, list[int]] = {}
+        unique_queries = list(dict.fromkeys(effective.values()))
+        for start in range(0, len(unique_queries), max(1, chunk_size)):
+            chunk = unique_queries[start : start + max(1, chunk_size)]
+            prepared = [_prepare_query(query) for query in chunk]
+            if scoring == "bm25":
+                vocabulary, weights = self._term_matrix("bm25")
+                scores = (_query_matrix([query.term_set for query in prepared], vocabulary) @ weights.T).toarray()
+            else:
+                scores = self._heuristic_batch_scores(prepared, region)
+            scores[:, ~allowed] = 0.0
+
+            for query, row_scores in zip(chunk, scores):
+                matched = np.flatnonzero(row_scores > 0)
+                if matched.size > limit:
+                    kth = np.partition(row_scores[matched], matched.size - limit)[matched.size - limit]
+                    matched = matched[row_scores[matched] >= kth]
+                order = np.lexsort((tiebreak[matched], -row_scores[matched]))[:limit]
+                ranked_positions[query] = matched[order].tolist()
+
+        fallback = candidates[:limit]
+        return [[self.rows[position].record for position in (ranked_positions[effective[query]] or fallback)] for query in queries]
+
+
+def _term_trigrams(term: str) -> frozenset[str]:
+    padded = f" {term} "
+    return frozenset(padded[start : start + 3] for start in range(len(padded) - 2))
+
+
+def _query_matrix(term_sets: Sequence[Iterable[str]], vocabulary: dict[str, int]) -> Any:
+    from scipy import sparse
+
+    indptr = [0]
+    indices: list[int] = []
+    for terms in term_sets:
+        indices.extend(sorted({vocabulary[term] for term in terms if term in vocabulary}))
+        indptr.append(len(indices))
+    return sparse.csr_matrix(([1.0] * len(indices), indices, indptr), shape=(len(term_sets), len(vocabulary)))
+
+
+class ProcedureCatalog(Sequence[Procedure]):
+    """Pandas-free NUN catalogue: ``Procedure`` records together with their ``NunIndex``.
+
+    Accepted everywhere the search functions take ``procedures_data``, so a
+    worker that never renders tables does not need to hold a DataFrame.
+    """
+
+    __slots__ = ("index",)
+
+    def __init__(self, index: NunIndex):
+        self.index = index
+
+    @classmethod
+    def from_records(cls, records: Iterable[Mapping[str, Any]]) -> ProcedureCatalog:
+        return cls(NunIndex([IndexedProcedure.from_record(record) for record in records]))
+
+    @property
+    def empty(self) -> bool:
+        return not self.index.rows
+
+    def __len__(self) -> int:
+        return len(self.index.rows)
+
+    @overload
+    def __getitem__(self, position: int) -> Procedure: ...
+
+    @overload
+    def __getitem__(self, position: slice) -> list[Procedure]: ...
+
+    def __getitem__(self, position: int | slice) -> Procedure | list[Procedure]:
+        if isinstance(position, slice):
+            return [row.record for row in self.index.rows[position]]
+        return self.index.rows[position].record
+
+
+def _is_dataframe(value: Any) -> bool:
+    # A DataFrame cannot exist before pandas is imported, so never import it here.
+    pandas = sys.modules.get("pandas")
+    return pandas is not None and isinstance(value, pandas.DataFrame)
+
+
+def get_nun_index(procedures_data: ProcedureData) -> tuple[NunIndex, list[int]]:
+    """Return the catalogue index for ``procedures_data`` and the positions of its rows.
+
+    Catalogues and frames produced by ``load_nun_data`` (and row selections of
+    them) reuse the prebuilt index; any other frame gets a throwaway index
+    built on the spot.
+    """
+    if isinstance(procedures_data, ProcedureCatalog):
+        return procedures_data.index, list(range(len(procedures_data)))
+    index = procedures_data.attrs.get(NUN_INDEX_ATTR)
+    if isinstance(index, NunIndex):
+        positions = index.positions_for(procedures_data)
+        if positions is not None:
+            return index, positions
+    index = NunIndex.from_dataframe(procedures_data)
+    return index, list(range(len(index)))
+
+
+def dataset_fingerprint(procedures_data: ProcedureData) -> str:
+    """Stable hash of the catalogue rows, used to invalidate cached results when the data changes."""
+    index, positions = get_nun_index(procedures_data)
+    return index.fingerprint(positions)
+
+
 def default_data_path() -> Path:
     return Path(__file__).resolve().with_name("nun_procedimientos.csv")
 
@@ -185,25 +1086,238 @@ def validate_search_query(
 
 
 def _clean_currency_column(series: pd.Series) -> pd.Series:
+    import pandas as pd
+
     cleaned = series.astype(str).str.replace("$", "", regex=False).str.replace(",", "", regex=False).str.replace('"', "", regex=False)
     return pd.to_numeric(cleaned, errors="coerce").fillna(0)
 
 
-def load_nun_data(csv_path: str | Path | None = None) -> pd.DataFrame:
+def default_snapshot_path(csv_path: str | Path | None = None) -> Path:
+    configured = os.getenv("NUNBOT_SNAPSHOT_PATH")
+    if configured and configured.strip():
+        return Path(configured).expanduser()
     path = Path(csv_path) if csv_path else default_data_path()
+    return path.with_name(path.name + ".snapshot")
+
+
+def _file_sha256(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def _log_duplicate_codes(index: NunIndex, path: Path) -> None:
+    for code, positions in index.duplicate_codes.items():
+        logger.warning("nun_duplicate_code code=%s rows=%s path=%s; code lookups use the first row", code, list(positions), path)
+
+
+def _read_nun_csv(path: Path) -> pd.DataFrame:
+    import pandas as pd
+
     df = pd.read_csv(path)
     df.columns = df.columns.str.strip()
 
-    for column in ("Cirujano", "Ayudantes", "Total"):
+    for column in CURRENCY_COLUMNS:
         if column in df.columns:
             df[column] = _clean_currency_column(df[column])
 
+    df.attrs[NUN_INDEX_ATTR] = NunIndex.from_dataframe(df)
+    _log_duplicate_codes(df.attrs[NUN_INDEX_ATTR], path)
+    return df
+
+
+# Per-row index fields stored next to the catalogue columns, so a snapshot load
+# skips text normalization and prompt-line formatting.
+SNAPSHOT_INDEX_FIELDS = ("description", "keywords", "code_text", "blob")
+
+
+def _snapshot_stamp(csv_path: Path) -> dict[str, Any]:
+    import numpy as np
+    import pandas as pd
+
+    stat = csv_path.stat()
+    return {
+        "version": SNAPSHOT_FORMAT_VERSION,
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "csv_mtime_ns": stat.st_mtime_ns,
+        "csv_size": stat.st_size,
+    }
+
+
+def _load_snapshot_array(snapshot_path: Path, name: str) -> Any:
+    import numpy as np
+
+    # ``allow_pickle=False`` keeps the load data-only: object arrays are refused.
+    return np.load(snapshot_path / f"{name}.npy", mmap_mode="r", allow_pickle=False)
+
+
+def _load_data_snapshot(csv_path: Path, snapshot_path: Path) -> pd.DataFrame | None:
+    """Return the snapshotted frame if it was built from the current CSV, otherwise None.
+
+    The snapshot is a directory with ``meta.json`` and one ``.npy`` array per
+    column and index field, read without pickle. ``meta.json`` stores the CSV's
+    mtime, size and SHA-256: a matching mtime and size is trusted as-is, and a
+    touched file is accepted only if its hash still matches.
+    """
+    import numpy as np
+    import pandas as pd
+
+    try:
+        meta = json.loads((snapshot_path / "meta.json").read_text(encoding="utf-8"))
+        stamp = _snapshot_stamp(csv_path)
+        if any(meta.get(key) != stamp[key] for key in ("version", "pandas", "numpy")):
+            return None
+        if (meta.get("csv_mtime_ns"), meta.get("csv_size")) != (stamp["csv_mtime_ns"], stamp["csv_size"]):
+            if meta.get("csv_sha256") != _file_sha256(csv_path):
+                return None
+
+        length = int(meta["rows"])
+        columns: dict[str, Any] = {}
+        for position, column in enumerate(meta["columns"]):
+            values = _load_snapshot_array(snapshot_path, f"column_{position}")
+            if len(values) != length:
+                return None
+            if column["text"]:
+                values = np.array(values.tolist(), dtype=object)
+                if column["nulls"]:
+                    values[_load_snapshot_array(snapshot_path, f"nulls_{position}")] = np.nan
+            else:
+                values = np.array(values)
+            columns[str(column["name"])] = values
+        index_fields = [_load_snapshot_array(snapshot_path, f"index_{name}").tolist() for name in SNAPSHOT_INDEX_FIELDS]
+        prompt_lines = _load_snapshot_array(snapshot_path, "prompt_line").tolist()
+        prompt_tokens = _load_snapshot_array(snapshot_path, "prompt_tokens").tolist()
+        if any(len(values) != length for values in (*index_fields, prompt_lines, prompt_tokens)):
+            return None
+
+        df = pd.DataFrame(columns)
+        layout = {column: position for position, column in enumerate(df.columns)}
+        records = [df.iloc[:, position].tolist() for position in range(len(layout))]
+        rows = [
+            IndexedProcedure.from_normalized(
+                Procedure(layout, values, prompt_line=line, prompt_tokens=tokens), *normalized
+            )
+            for values, line, tokens, *normalized in zip(zip(*records), prompt_lines, prompt_tokens, *index_fields)
+        ]
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        logger.warning("Ignoring unreadable NUN data snapshot %s: %s", snapshot_path, exc)
+        return None
+
+    df.attrs[NUN_INDEX_ATTR] = NunIndex(rows, df.index.tolist())
     return df
 
 
-def _row_search_blob(row: pd.Series) -> str:
-    parts = [str(row.get("Código", "")), str(row.get("Descripción", "")), str(row.get("Palabras clave", "")), str(row.get("Región", ""))]
-    return normalize_search_query(" ".join(parts))
+def _write_data_snapshot(df: pd.DataFrame, csv_path: Path, snapshot_path: Path) -> None:
+    import numpy as np
+    import pandas as pd
+
+    index: NunIndex = df.attrs[NUN_INDEX_ATTR]
+    if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0 or df.index.step != 1:
+        return
+
+    meta = {**_snapshot_stamp(csv_path), "csv_sha256": _file_sha256(csv_path), "rows": len(df), "columns": []}
+    arrays: dict[str, Any] = {}
+    for position, (name, series) in enumerate(df.items()):
+        if series.dtype.kind in "biuf":
+            arrays[f"column_{position}"] = series.to_numpy()
+            meta["columns"].append({"name": name, "text": False, "nulls": False})
+            continue
+        nulls = series.isna().to_numpy()
+        values = series.where(~nulls, "").tolist()
+        if not all(isinstance(value, str) for value in values):
+            logger.info("Skipping NUN data snapshot: column %r holds non-text values", name)
+            return
+        arrays[f"column_{position}"] = np.array(values, dtype=str)
+        if nulls.any():
+            arrays[f"nulls_{position}"] = nulls
+        meta["columns"].append({"name": name, "text": True, "nulls": bool(nulls.any())})
+    for name in SNAPSHOT_INDEX_FIELDS:
+        arrays[f"index_{name}"] = np.array([getattr(row, name) for row in index.rows], dtype=str)
+    arrays["prompt_line"] = np.array([row.record.prompt_line for row in index.rows], dtype=str)
+    arrays["prompt_tokens"] = np.array([row.record.prompt_tokens for row in index.rows], dtype=np.int64)
+
+    # Built in a sibling directory and swapped in, so readers see either the old
+    # snapshot, the new one, or none (and then fall back to the CSV).
+    tmp_path = snapshot_path.with_name(f"{snapshot_path.name}.{os.getpid()}.tmp")
+    stale_path = snapshot_path.with_name(f"{snapshot_path.name}.{os.getpid()}.old")
+    try:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        for name, values in arrays.items():
+            np.save(tmp_path / f"{name}.npy", values, allow_pickle=False)
+        (tmp_path / "meta.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+        if snapshot_path.is_dir():
+            os.replace(snapshot_path, stale_path)
+        elif snapshot_path.exists():
+            snapshot_path.unlink()
+        os.replace(tmp_path, snapshot_path)
+    except OSError as exc:
+        logger.warning("Could not write NUN data snapshot %s: %s", snapshot_path, exc)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    finally:
+        shutil.rmtree(stale_path, ignore_errors=True)
+
+
+def _parse_currency(value: str) -> float:
+    try:
+        amount = float(value.replace("$", "").replace(",", "").replace('"', ""))
+    except ValueError:
+        return 0.0
+    return 0.0 if math.isnan(amount) else amount
+
+
+def _convert_csv_column(values: list[str]) -> list[Any]:
+    # Same inference as ``pd.read_csv`` for this catalogue: ints, then floats, else text.
+    for convert in (int, float):
+        try:
+            return [convert(value) for value in values]
+        except ValueError:
+            continue
+    return values
+
+
+def load_procedures(csv_path: str | Path | None = None) -> ProcedureCatalog:
+    """Load the catalogue as compact ``Procedure`` records with the ``csv`` module, without pandas.
+
+    Values and search results match ``load_nun_data``, but no DataFrame is built.
+    """
+    path = Path(csv_path) if csv_path else default_data_path()
+    with path.open(newline="", encoding="utf-8") as fh:
+        reader = csv.reader(fh)
+        header = [column.strip() for column in next(reader, [])]
+        width = len(header)
+        rows = [(row + [""] * width)[:width] for row in reader if any(row)]
+
+    columns: list[list[Any]] = []
+    for position, column in enumerate(header):
+        values = [row[position] for row in rows]
+        columns.append([_parse_currency(value) for value in values] if column in CURRENCY_COLUMNS else _convert_csv_column(values))
+
+    layout = {column: position for position, column in enumerate(header)}
+    catalog = ProcedureCatalog(NunIndex([IndexedProcedure.from_record(Procedure(layout, values)) for values in zip(*columns)]))
+    _log_duplicate_codes(catalog.index, path)
+    return catalog
+
+
+def load_nun_data(csv_path: str | Path | None = None, *, use_snapshot: bool = DEFAULT_USE_DATA_SNAPSHOT) -> pd.DataFrame:
+    """Load the cleaned catalogue with its search index.
+
+    With ``use_snapshot`` the parsed frame and index are kept in a binary
+    snapshot next to the CSV and reused while the CSV is unchanged.
+    """
+    path = Path(csv_path) if csv_path else default_data_path()
+    if not use_snapshot:
+        return _read_nun_csv(path)
+
+    snapshot_path = default_snapshot_path(path)
+    df = _load_data_snapshot(path, snapshot_path)
+    if df is not None:
+        return df
+
+    df = _read_nun_csv(path)
+    _write_data_snapshot(df, path, snapshot_path)
+    return df
 
 
 def _truncate_text(text: Any, max_length: int) -> str:
@@ -213,7 +1327,7 @@ def _truncate_text(text: Any, max_length: int) -> str:
     return value[: max(0, max_length - 1)].rstrip() + "…"
 
 
-def _format_candidate_row(row: dict[str, Any]) -> str:
+def _format_candidate_row(row: Mapping[str, Any]) -> str:
     code = str(row.get("Código", "")).strip()
     description = _truncate_text(row.get("Descripción", ""), 110)
     keywords = _truncate_text(row.get("Palabras clave", ""), 70)
@@ -227,92 +1341,179 @@ def _format_candidate_row(row: dict[str, Any]) -> str:
 
 
 def score_procedure_row(query: str, row: pd.Series, region: str | None = None) -> float:
-    normalized_query = normalize_search_query(query)
-    query_terms = tokenize_query(query)
-    if not normalized_query or not query_terms:
-        return 0.0
-
-    description = normalize_search_query(str(row.get("Descripción", "")))
-    keywords = normalize_search_query(str(row.get("Palabras clave", "")))
-    code = normalize_search_query(str(row.get("Código", "")))
-    row_region = str(row.get("Región", "")).strip().upper()
-    blob = _row_search_blob(row)
+    return _score_indexed(_prepare_query(query), IndexedProcedure.from_record(row.to_dict()), region=region)
 
-    score = 0.0
-    if region and row_region == region.upper():
-        score += 3.0
 
-    if normalized_query in description:
-        score += 8.0
-    if normalized_query in keywords:
-        score += 6.0
-    if normalized_query in code:
-        score += 2.0
+def rank_local_candidates(
+    query: str,
+    procedures_data: ProcedureData,
+    region: str | None = None,
+    limit: int = DEFAULT_TOP_CANDIDATES,
+    *,
+    scoring: str = DEFAULT_SCORING_BACKEND,
+    fuzzy: bool = DEFAULT_FUZZY_MATCHING,
+) -> list[Procedure]:
+    if procedures_data.empty:
+        return []
 
-    description_terms = set(tokenize_query(str(row.get("Descripción", ""))))
-    keyword_terms = set(tokenize_query(str(row.get("Palabras clave", ""))))
-    overlap_description = description_terms.intersection(query_terms)
-    overlap_keywords = keyword_terms.intersection(query_terms)
+    index, positions = get_nun_index(procedures_data)
+    return index.rank(query, region=region, limit=limit, positions=positions, scoring=scoring, fuzzy=fuzzy)
 
-    score += len(overlap_description) * 1.5
-    score += len(overlap_keywords) * 2.0
 
-    # Mild boost for exact phrase fragments present anywhere in the row blob.
-    for term in query_terms:
-        if term in blob:
-            score += 0.5
+def rank_local_candidates_batch(
+    queries: Sequence[str],
+    procedures_data: ProcedureData,
+    region: str | None = None,
+    limit: int = DEFAULT_TOP_CANDIDATES,
+    *,
+    scoring: str = DEFAULT_SCORING_BACKEND,
+    fuzzy: bool = DEFAULT_FUZZY_MATCHING,
+) -> list[list[Procedure]]:
+    if procedures_data.empty:
+        return [[] for _ in queries]
 
-    return score
+    index, positions = get_nun_index(procedures_data)
+    return index.rank_batch(queries, region=region, limit=limit, positions=positions, scoring=scoring, fuzzy=fuzzy)
 
 
-def rank_local_candidates(query: str, procedures_data: pd.DataFrame, region: str | None = None, limit: int = DEFAULT_TOP_CANDIDATES) -> list[dict[str, Any]]:
-    if procedures_data.empty:
-        return []
+@dataclass(frozen=True)
+class RegionMatch:
+    """Local evidence for one anatomical region: its score and the hints found in the query."""
+
+    region: str
+    score: int
+    hints: tuple[str, ...]
+
+
+class RegionHintMatcher:
+    """Aho-Corasick automaton over the normalized region hint vocabulary.
+
+    Finds every hint contained in a query, overlapping ones included, in a
+    single pass over its characters, so detection cost does not grow with
+    the size of the hint dictionary.
+    """
+
+    def __init__(self, hints: dict[str, Iterable[str]]):
+        # Several raw hints can normalize to the same pattern ("muñeca" and
+        # "muneca"); each one still counts, as in the original substring scan.
+        self.weights: dict[str, dict[str, int]] = {}
+        for region, region_hints in hints.items():
+            for hint in region_hints:
+                pattern = normalize_search_query(hint)
+                if pattern:
+                    by_region = self.weights.setdefault(pattern, {})
+                    by_region[region] = by_region.get(region, 0) + 1
+        self.regions = tuple(hints)
+
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[tuple[str, ...]] = [()]
+        for pattern in self.weights:
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                state = next_state
+            self._output[state] = self._output[state] + (pattern,)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find(self, normalized_text: str) -> set[str]:
+        """Every hint pattern occurring in ``normalized_text``."""
+        found: set[str] = set()
+        state = 0
+        for char in normalized_text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._output[state]:
+                found.update(self._output[state])
+        return found
+
+    def match(self, normalized_text: str) -> dict[str, RegionMatch]:
+        scores: dict[str, int] = {}
+        evidence: dict[str, list[str]] = {}
+        for pattern in sorted(self.find(normalized_text)):
+            for region, count in self.weights[pattern].items():
+                scores[region] = scores.get(region, 0) + 2 * count
+                evidence.setdefault(region, []).append(pattern)
+        return {
+            region: RegionMatch(region, scores[region], tuple(evidence[region]))
+            for region in self.regions
+            if region in scores
+        }
+
+
+def load_region_hints(path: str | Path | None = None) -> dict[str, set[str]]:
+    """Built-in ``REGION_HINTS`` merged with an optional JSON file of ``{"MS": ["hint", ...], ...}``."""
+    hints = {region: set(values) for region, values in REGION_HINTS.items()}
+    if not path:
+        return hints
+
+    with Path(path).open(encoding="utf-8") as fh:
+        extra = json.load(fh)
+    if not isinstance(extra, dict):
+        raise ValueError(f"El archivo de pistas anatómicas debe ser un objeto JSON: {path}")
+    for region, values in extra.items():
+        region = str(region).strip().upper()
+        if region not in REGIONS:
+            logger.warning("Ignoring region hints for unknown region %r from %s", region, path)
+            continue
+        hints.setdefault(region, set()).update(str(value) for value in values)
+    return hints
 
-    working = procedures_data
-    if region:
-        working = working[working["Región"].astype(str).str.upper() == region.upper()]
 
-    scored: list[tuple[float, int, dict[str, Any]]] = []
-    for idx, (_, row) in enumerate(working.iterrows()):
-        score = score_procedure_row(query, row, region=region)
-        if score <= 0:
-            continue
-        scored.append((score, idx, row.to_dict()))
+# (hint file, matcher) in one tuple, so the lock-free read sees a consistent pair.
+_region_matcher: tuple[str, RegionHintMatcher] | None = None
+_region_matcher_lock = threading.Lock()
 
-    if not scored:
-        # Fallback to a safe slice of the region so the model still receives candidates.
-        fallback = working.head(limit)
-        return fallback.to_dict(orient="records")
 
-    scored.sort(key=lambda item: (-item[0], str(item[2].get("Código", ""))))
-    return [item[2] for item in scored[:limit]]
+def get_region_matcher() -> RegionHintMatcher:
+    """Compiled matcher for ``REGION_HINTS`` plus ``NUNBOT_REGION_HINTS_PATH``, built once per hint file."""
+    global _region_matcher
+    path = DEFAULT_REGION_HINTS_PATH
+    cached = _region_matcher
+    if cached is not None and cached[0] == path:
+        return cached[1]
+    with _region_matcher_lock:
+        if _region_matcher is None or _region_matcher[0] != path:
+            _region_matcher = (path, RegionHintMatcher(load_region_hints(path or None)))
+        return _region_matcher[1]
 
 
-def determine_region_locally(query: str) -> tuple[str, float, str]:
+def detect_regions(query: str, matcher: RegionHintMatcher | None = None) -> dict[str, RegionMatch]:
+    """Per-region hint evidence found in ``query``, in ``REGIONS`` order."""
     normalized = normalize_search_query(query)
     if not normalized:
-        return "", 0.0, ""
+        return {}
+    return (matcher or get_region_matcher()).match(normalized)
 
-    query_terms = set(tokenize_query(query))
-    if not query_terms:
+
+def determine_region_locally(query: str) -> tuple[str, float, str]:
+    if not tokenize_query(query):
         return "", 0.0, ""
 
     best_region = ""
     best_score = 0
-    for region, hints in REGION_HINTS.items():
-        score = 0
-        for hint in hints:
-            normalized_hint = normalize_search_query(hint)
-            if not normalized_hint:
-                continue
-            if normalized_hint in normalized:
-                score += 2
-            elif any(token == normalized_hint for token in query_terms):
-                score += 1
-        if score > best_score:
-            best_score = score
-            best_region = region
+    for match in detect_regions(query).values():
+        if match.score > best_score:
+            best_score = match.score
+            best_region = match.region
 
     if not best_region or best_score == 0:
         return "", 0.0, ""
@@ -349,233 +1550,1136 @@ def validate_region_response(payload: dict[str, Any] | str | None) -> tuple[str,
     return region, confidence, reason
 
 
-def validate_suggested_codes(suggestions: Any, procedures_data: pd.DataFrame) -> list[dict[str, Any]]:
+def validate_suggested_codes(suggestions: Any, procedures_data: ProcedureData) -> list[dict[str, Any]]:
     if not isinstance(suggestions, list):
         return []
 
-    allowed_codes = set(procedures_data["Código"].astype(str).tolist()) if "Código" in procedures_data.columns else set()
+    records_by_code = procedure_records_by_code(procedures_data)
     cleaned: list[dict[str, Any]] = []
     seen: set[str] = set()
 
     for item in suggestions:
-        if not isinstance(item, dict):
-            continue
-        code = str(item.get("codigo", "")).strip()
-        if not code or code not in allowed_codes or code in seen:
+        suggestion = _validate_suggestion(item, records_by_code, seen)
+        if suggestion is None:
             continue
-
-        try:
-            confidence = float(item.get("confianza", 0))
-        except (TypeError, ValueError):
-            confidence = 0.0
-        confidence = max(0.0, min(1.0, confidence))
-
-        motive = str(item.get("motivo", "")).strip()
-        cleaned.append({"codigo": code, "confianza": confidence, "motivo": motive})
-        seen.add(code)
-        if len(cleaned) >= 5:
+        cleaned.append(suggestion)
+        if len(cleaned) >= MAX_SUGGESTIONS:
             break
 
     return cleaned
 
 
-def _with_timeout(client: OpenAI, timeout_seconds: int):
-    if hasattr(client, "with_options"):
-        return client.with_options(timeout=timeout_seconds)
-    return client
-
+def _validate_suggestion(item: Any, records_by_code: Mapping[str, Procedure], seen: set[str]) -> dict[str, Any] | None:
+    """Clean one model suggestion, or return None when its code is unknown or already in ``seen``."""
+    if not isinstance(item, dict):
+        return None
+    code = str(item.get("codigo", "")).strip()
+    if not code or code not in records_by_code or code in seen:
+        return None
 
-def _parse_json_content(content: str) -> dict[str, Any]:
     try:
-        payload = json.loads(content)
-        return payload if isinstance(payload, dict) else {}
-    except json.JSONDecodeError:
-        return {}
+        confidence = float(item.get("confianza", 0))
+    except (TypeError, ValueError):
+        confidence = 0.0
+    confidence = max(0.0, min(1.0, confidence))
 
+    motive = str(item.get("motivo", "")).strip()
+    seen.add(code)
+    return {"codigo": code, "confianza": confidence, "motivo": motive}
 
-def _chat_json_with_retry(
-    client: OpenAI,
-    *,
-    model: str,
-    messages: list[dict[str, str]],
-    max_tokens: int,
-    temperature: float,
-    timeout_seconds: int = DEFAULT_TIMEOUT_SECONDS,
-    retry_attempts: int = DEFAULT_RETRY_ATTEMPTS,
-) -> dict[str, Any]:
-    last_error: Exception | None = None
-    request_client = _with_timeout(client, timeout_seconds)
 
-    for attempt in range(retry_attempts + 1):
-        try:
-            completion_kwargs: dict[str, Any] = {
-                "model": model,
-                "messages": messages,
-                "response_format": {"type": "json_object"},
-                "temperature": temperature,
-            }
-            if str(model).startswith("gpt-5"):
-                completion_kwargs["max_completion_tokens"] = max_tokens
-            else:
-                completion_kwargs["max_tokens"] = max_tokens
+def suggestion_stream_validator(
+    procedures_data: ProcedureData, on_suggestion: Callable[[dict[str, Any]], None]
+) -> Callable[[Any], None]:
+    """Wrap ``on_suggestion`` so it only sees what ``validate_suggested_codes`` would keep, in order."""
+    records_by_code = procedure_records_by_code(procedures_data)
+    seen: set[str] = set()
 
-            response = request_client.chat.completions.create(**completion_kwargs)
-            content = response.choices[0].message.content or "{}"
-            return _parse_json_content(content)
-        except Exception as exc:  # pragma: no cover - exercised via integration/runtime, not deterministic unit tests
-            last_error = exc
-            logger.warning("OpenAI request failed on attempt %s/%s: %s", attempt + 1, retry_attempts + 1, exc)
-            if attempt < retry_attempts:
-                time.sleep(0.5 * (2 ** attempt))
+    def emit(item: Any) -> None:
+        if len(seen) >= MAX_SUGGESTIONS:
+            return
+        suggestion = _validate_suggestion(item, records_by_code, seen)
+        if suggestion is not None:
+            on_suggestion(suggestion)
 
-    if last_error:
-        raise last_error
-    return {}
+    return emit
 
 
-def build_region_prompt(user_description: str) -> list[dict[str, str]]:
-    return [
-        {
-            "role": "system",
-            "content": "Eres un experto en anatomía traumatológica. Responde siempre en formato JSON válido.",
-        },
-        {
-            "role": "user",
-            "content": f"""
-Eres un asistente médico especializado en traumatología y ortopedia. Tu tarea es determinar la región anatómica basándote en la descripción del procedimiento.
+class OpenAIUnavailable(RuntimeError):
+    """An OpenAI request was not sent; ``reason`` is the user-facing explanation for the fallback."""
 
-DESCRIPCIÓN DEL PROCEDIMIENTO:
-"{user_description}"
+    reason = "OpenAI no está disponible en este momento; se usará una búsqueda determinística de respaldo."
 
-GLOSARIO MÉDICO CONTEXTUAL - REGIONES ANATÓMICAS:
-- **MS** → Miembro Superior (hombro, húmero, codo, antebrazo, muñeca, mano, dedos)
-- **CO** → Columna (cervical, dorsal, lumbar, sacra, vertebras)
-- **PC** → Pelvis y Cadera (fémur proximal, acetábulo, sacro, cadera)
-- **RO** → Rodilla (patela, cóndilos femorales, platillos tibiales, ligamentos cruzados)
-- **PP** → Pierna y Pie (tibia, peroné, tobillo, calcáneo, astrágalo, metatarsianos, falanges)
 
-EJEMPLOS DE INTERPRETACIÓN:
-- "fractura de cadera" → región PC
-- "fractura de muñeca" → región MS
-- "fractura de tobillo" → región PP
-- "fractura de columna" → región CO
-- "fractura de rodilla" → región RO
-- "forage de cadera" → región PC
+class OpenAIRateLimitExceeded(OpenAIUnavailable):
+    """Raised instead of queueing a request that could not start within its allowed wait."""
 
-INSTRUCCIONES:
-1. Analiza la descripción del procedimiento
-2. Identifica la región anatómica más apropiada
-3. Responde SOLO con el código de la región en formato JSON
+    reason = "OpenAI está saturado en este momento; se usará una búsqueda determinística de respaldo."
 
-FORMATO DE RESPUESTA (JSON obligatorio):
-{{
-    "region": "PC",
-    "confianza": 0.95,
-    "motivo": "Explicación breve de por qué esta región es correcta"
-}}
 
-IMPORTANTE:
-- Responde SOLO en formato JSON
-- La región debe ser exactamente: MS, CO, PC, RO, o PP
-- La confianza debe ser un número entre 0 y 1
-""".strip(),
-        },
-    ]
+class OpenAICircuitOpen(OpenAIUnavailable):
+    """Raised without calling OpenAI while the circuit breaker is open."""
 
+    reason = "OpenAI no responde desde hace unos instantes; se usará una búsqueda determinística de respaldo."
 
-def build_search_prompt(user_description: str, candidate_procedures: pd.DataFrame | Iterable[dict[str, Any]]) -> list[dict[str, str]]:
-    if isinstance(candidate_procedures, pd.DataFrame):
-        candidate_df = cast(pd.DataFrame, candidate_procedures)
-        if "Código" in candidate_df.columns:
-            rows = candidate_df.drop_duplicates(subset=["Código"], keep="first").to_dict(orient="records")
-        else:
-            rows = candidate_df.to_dict(orient="records")
-    else:
-        rows = list(candidate_procedures)
 
-    compact_rows: list[dict[str, Any]] = []
-    seen_codes: set[str] = set()
-    for row in rows:
-        code = str(row.get("Código", "")).strip()
-        if code and code in seen_codes:
-            continue
-        if code:
-            seen_codes.add(code)
-        compact_rows.append(row)
+class SearchDeadlineExceeded(OpenAIUnavailable):
+    """Raised instead of starting (or retrying) an OpenAI request once the search budget is spent."""
 
-    procedures_text = "\n".join(_format_candidate_row(row) for row in compact_rows)
+    reason = "Se agotó el tiempo máximo de búsqueda; se muestran los mejores resultados disponibles."
 
-    return [
-        {
-            "role": "system",
-            "content": "Eres un experto en códigos NUN para traumatología. Responde siempre en formato JSON válido.",
-        },
-        {
-            "role": "user",
-            "content": f"""
-Eres un asistente médico especializado en traumatología y ortopedia. Tu tarea es encontrar los códigos NUN más apropiados para el procedimiento descrito.
 
-DESCRIPCIÓN DEL PROCEDIMIENTO:
-"{user_description}"
+class SearchBudget:
+    """End-to-end time budget shared by every stage of one search.
 
-LISTA DE PROCEDIMIENTOS POSIBLES:
-{procedures_text}
+    Each OpenAI attempt, rate-limit wait and backoff gets at most what
+    remains. ``exhausted`` turns True the first time a stage finds the budget
+    spent, which marks the search result as partial. ``seconds`` of None or
+    0 means unbounded. ``clock`` is a monotonic clock in seconds.
+    """
 
-INSTRUCCIONES:
-1. Analiza la descripción del procedimiento médico
-2. Busca coincidencias EXACTAS en las descripciones primero
-3. Identifica palabras clave médicas relevantes (anatomía, técnica quirúrgica, tipo de lesión, etc.)
-4. Considera la complejidad y tipo de procedimiento
-5. Devuelve EXACTAMENTE 3-5 códigos más probables, ordenados por relevancia y confianza
+    def __init__(self, seconds: float | None = None, *, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self.deadline = clock() + seconds if seconds and seconds > 0 else None
+        self.exhausted = False
 
-FORMATO DE RESPUESTA (JSON obligatorio):
-{{
+    def remaining(self) -> float:
+        if self.deadline is None:
+            return math.inf
+        return max(0.0, self.deadline - self._clock())
+
+    def cap(self, seconds: float) -> float:
+        return min(seconds, self.remaining())
+
+    @property
+    def expired(self) -> bool:
+        if self.deadline is not None and self._clock() >= self.deadline:
+            self.exhausted = True
+        return self.exhausted
+
+
+# Innermost open span of the current thread or task, with the trace it belongs to.
+_active_span: contextvars.ContextVar[tuple[SearchTrace, str] | None] = contextvars.ContextVar(
+    "nunbot_active_span", default=None
+)
+
+
+@dataclass(slots=True)
+class TraceSpan:
+    """One timed stage of a search; ``start_ns`` and ``end_ns`` are ``time.perf_counter_ns`` readings."""
+
+    name: str
+    span_id: str
+    parent_id: str
+    start_ns: int
+    end_ns: int = 0
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: str = ""
+
+    @property
+    def duration_ms(self) -> float:
+        return max(0, self.end_ns - self.start_ns) / 1e6
+
+
+def _otlp_attribute(key: str, value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        typed: dict[str, Any] = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+class SearchTrace:
+    """Timed stages of one search, as a tree of spans.
+
+    Stages open spans with ``_trace_span``; the innermost span open in the
+    current context is the parent, so the speculative ranking thread or task
+    nests under the search that started it. ``summary`` totals the time per
+    stage and ``to_otlp`` renders the spans as OTLP/JSON for an OpenTelemetry
+    collector.
+    """
+
+    def __init__(self) -> None:
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.spans: list[TraceSpan] = []
+        self._lock = threading.Lock()
+        # Spans are timed on the monotonic clock; this anchor converts them to wall-clock time for export.
+        self._wall_anchor_ns = time.time_ns() - time.perf_counter_ns()
+
+    @contextmanager
+    def span(self, name: str, parent_id: str = "", **attributes: Any) -> Iterator[TraceSpan]:
+        """Time the block as a span; an exception escaping it is recorded as the span's ``error``."""
+        span = TraceSpan(name, f"{random.getrandbits(64):016x}", parent_id, time.perf_counter_ns(), attributes=attributes)
+        token = _active_span.set((self, span.span_id))
+        try:
+            yield span
+        except BaseException as exc:
+            span.error = span.error or type(exc).__name__
+            raise
+        finally:
+            _active_span.reset(token)
+            span.end_ns = time.perf_counter_ns()
+            with self._lock:
+                self.spans.append(span)
+
+    def ordered_spans(self) -> list[TraceSpan]:
+        with self._lock:
+            return sorted(self.spans, key=lambda span: span.start_ns)
+
+    def summary(self) -> dict[str, float]:
+        """Milliseconds spent per stage name, summed over repeated stages such as retried attempts."""
+        totals: dict[str, float] = {}
+        for span in self.ordered_spans():
+            totals[span.name] = totals.get(span.name, 0.0) + span.duration_ms
+        return {name: round(total, 3) for name, total in totals.items()}
+
+    def to_dict(self) -> dict[str, Any]:
+        spans = self.ordered_spans()
+        origin = spans[0].start_ns if spans else 0
+        return {
+            "trace_id": self.trace_id,
+            "spans": [
+                {
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "start_ms": round((span.start_ns - origin) / 1e6, 3),
+                    "duration_ms": round(span.duration_ms, 3),
+                    "attributes": dict(span.attributes),
+                    "error": span.error,
+                }
+                for span in spans
+            ],
+        }
+
+    def to_otlp(self, service_name: str = "nunbot") -> dict[str, Any]:
+        """The trace as an OTLP/JSON ``ExportTraceServiceRequest``."""
+        spans = []
+        for span in self.ordered_spans():
+            otlp_span: dict[str, Any] = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": span.parent_id,
+                "name": span.name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(self._wall_anchor_ns + span.start_ns),
+                "endTimeUnixNano": str(self._wall_anchor_ns + span.end_ns),
+                "attributes": [_otlp_attribute(f"nunbot.{key}", value) for key, value in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {},
+            }
+            spans.append(otlp_span)
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [_otlp_attribute("service.name", service_name)]},
+                    "scopeSpans": [{"scope": {"name": "nunbot_core"}, "spans": spans}],
+                }
+            ]
+        }
+
+
+@contextmanager
+def _trace_span(name: str, **attributes: Any) -> Iterator[TraceSpan]:
+    """Span under the active one of the current search; outside a search the span is timed nowhere."""
+    active = _active_span.get()
+    if active is None:
+        yield TraceSpan(name, "", "", 0, attributes=attributes)
+        return
+    trace, parent_id = active
+    with trace.span(name, parent_id, **attributes) as span:
+        yield span
+
+
+_trace_export_lock = threading.Lock()
+
+
+def export_trace(trace: SearchTrace, path: str | Path) -> None:
+    """Append ``trace`` to ``path`` as one OTLP/JSON line, the layout read by the collector's ``otlpjsonfile`` receiver."""
+    line = json.dumps(trace.to_otlp(), ensure_ascii=False, separators=(",", ":"))
+    with _trace_export_lock, open(path, "a", encoding="utf-8") as handle:
+        handle.write(line + "\n")
+
+
+def _export_search_trace(trace: SearchTrace) -> None:
+    if not DEFAULT_TRACE_EXPORT_PATH:
+        return
+    try:
+        export_trace(trace, DEFAULT_TRACE_EXPORT_PATH)
+    except OSError as exc:
+        logger.warning("search_trace_export_failed path=%s: %s", DEFAULT_TRACE_EXPORT_PATH, exc)
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for OpenAI calls.
+
+    ``closed``: calls go through; ``failure_threshold`` consecutive outage
+    failures (network errors, timeouts, 408, 429 and 5xx responses) open it.
+    ``open``: calls fail at once with ``OpenAICircuitOpen`` for
+    ``reset_seconds``. ``half_open``: one probe call is let through; its
+    success closes the breaker and its failure opens it again. ``clock`` is a
+    monotonic clock in seconds.
+    """
+
+    def __init__(
+        self,
+        *,
+        failure_threshold: int = DEFAULT_CIRCUIT_FAILURE_THRESHOLD,
+        reset_seconds: float = DEFAULT_CIRCUIT_RESET_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.opened = 0
+        self.short_circuited = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(self._clock())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == "open" and now - self._opened_at >= self.reset_seconds:
+            self._transition("half_open")
+        return self._state
+
+    def _transition(self, state: str) -> None:
+        if state != self._state:
+            logger.warning("openai_circuit state=%s previous=%s failures=%s", state, self._state, self._failures)
+        self._state = state
+        if state == "open":
+            self._opened_at = self._clock()
+            self.opened += 1
+        self._probe_in_flight = False
+
+    def before_call(self) -> None:
+        with self._lock:
+            state = self._current_state(self._clock())
+            if state == "closed":
+                return
+            if state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            self.short_circuited += 1
+            retry_in = max(0.0, self.reset_seconds - (self._clock() - self._opened_at))
+            raise OpenAICircuitOpen(f"OpenAI circuit {state}; next probe in {retry_in:.0f}s")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            if self._state != "closed":
+                self._transition("closed")
+
+    def record_failure(self, error: BaseException) -> None:
+        status = getattr(error, "status_code", None)
+        if isinstance(status, int) and 400 <= status < 500 and status not in (408, 429):
+            # The request itself was rejected; the provider is up.
+            self.record_skipped()
+            return
+        with self._lock:
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                self._transition("open")
+
+    def record_skipped(self) -> None:
+        """Release a half-open probe that never reached OpenAI."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self._current_state(self._clock()),
+                "consecutive_failures": self._failures,
+                "opened": self.opened,
+                "short_circuited": self.short_circuited,
+            }
+
+
+class OpenAIRateLimiter:
+    """Process-wide admission control for OpenAI requests.
+
+    Two token buckets enforce requests per minute and estimated tokens per
+    minute; a counter caps requests in flight. A request reserves its share
+    of both buckets on arrival, so the buckets may go negative and later
+    arrivals wait in FIFO order for the deficit to refill. A request is
+    rejected with ``OpenAIRateLimitExceeded`` when the wait queue is full or
+    its wait would exceed ``max_wait`` seconds, so callers can fall back
+    instead of piling up behind the provider's limits. A rate or
+    concurrency limit of 0 disables it.
+    """
+
+    def __init__(
+        self,
+        *,
+        requests_per_minute: int = DEFAULT_OPENAI_REQUESTS_PER_MINUTE,
+        tokens_per_minute: int = DEFAULT_OPENAI_TOKENS_PER_MINUTE,
+        max_concurrency: int = DEFAULT_OPENAI_MAX_CONCURRENCY,
+        max_queue: int = DEFAULT_OPENAI_MAX_QUEUE,
+    ):
+        self.requests_per_minute = max(0, requests_per_minute)
+        self.tokens_per_minute = max(0, tokens_per_minute)
+        self.max_concurrency = max(0, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self._slot_freed = threading.Condition(threading.Lock())
+        self._request_balance = float(self.requests_per_minute)
+        self._token_balance = float(self.tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.peak_queue_depth = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.delayed = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _refill(self, now: float) -> None:
+        elapsed_minutes = (now - self._refilled_at) / 60
+        self._refilled_at = now
+        self._request_balance = min(float(self.requests_per_minute), self._request_balance + elapsed_minutes * self.requests_per_minute)
+        self._token_balance = min(float(self.tokens_per_minute), self._token_balance + elapsed_minutes * self.tokens_per_minute)
+
+    def _slots_full(self) -> bool:
+        return bool(self.max_concurrency) and self.in_flight >= self.max_concurrency
+
+    def _reserve(self, tokens: int, max_wait: float) -> float | None:
+        """Reserve bucket capacity; return None when admitted at once, else how long to sleep before taking a slot."""
+        with self._slot_freed:
+            self._refill(time.monotonic())
+            tokens = min(tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+            wait = 0.0
+            if self.requests_per_minute and self._request_balance < 1:
+                wait = (1 - self._request_balance) * 60 / self.requests_per_minute
+            if self.tokens_per_minute and self._token_balance < tokens:
+                wait = max(wait, (tokens - self._token_balance) * 60 / self.tokens_per_minute)
+            queued = wait > 0 or self._slots_full()
+            if wait > max_wait or (queued and self.queue_depth >= self.max_queue):
+                self.rejected += 1
+                reason = "queue full" if wait <= max_wait else f"needs {wait:.1f}s"
+                raise OpenAIRateLimitExceeded(f"OpenAI request not admitted ({reason}; queue_depth={self.queue_depth})")
+            if self.requests_per_minute:
+                self._request_balance -= 1
+            self._token_balance -= tokens
+            if not queued:
+                self.in_flight += 1
+                self.admitted += 1
+                return None
+            self.queue_depth += 1
+            self.peak_queue_depth = max(self.peak_queue_depth, self.queue_depth)
+            return wait
+
+    def _try_take_slot(self, deadline: float, tokens: int) -> bool:
+        """Take a free slot, or return False while none is free before ``deadline``; the caller holds the lock."""
+        if not self._slots_full():
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+        if time.monotonic() >= deadline:
+            self._refund(tokens)
+            self.rejected += 1
+            raise OpenAIRateLimitExceeded(f"OpenAI request not admitted (no free slot; in_flight={self.in_flight})")
+        return False
+
+    def _take_slot(self, deadline: float, tokens: int) -> None:
+        with self._slot_freed:
+            while not self._try_take_slot(deadline, tokens):
+                self._slot_freed.wait(deadline - time.monotonic())
+
+    def _refund(self, tokens: int) -> None:
+        """Give back the bucket share reserved for a request that will not be sent; the caller holds the lock."""
+        self._token_balance += min(tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+        self._request_balance += 1 if self.requests_per_minute else 0
+
+    def _dequeue(self, started: float) -> None:
+        waited = time.monotonic() - started
+        with self._slot_freed:
+            self.queue_depth -= 1
+            self.delayed += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def _release(self) -> None:
+        with self._slot_freed:
+            self.in_flight -= 1
+            self._slot_freed.notify()
+
+    @contextmanager
+    def limit(self, tokens: int, *, max_wait: float = DEFAULT_OPENAI_MAX_WAIT_SECONDS) -> Iterator[None]:
+        """Hold an admitted request slot for the duration of the block."""
+        started = time.monotonic()
+        wait = self._reserve(tokens, max_wait)
+        if wait is not None:
+            with _trace_span("openai.queue", wait_ms=round(wait * 1000, 1)):
+                try:
+                    time.sleep(wait)
+                    self._take_slot(started + max_wait, tokens)
+                finally:
+                    self._dequeue(started)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def async_limit(self, tokens: int, *, max_wait: float = DEFAULT_OPENAI_MAX_WAIT_SECONDS) -> AsyncIterator[None]:
+        """``limit`` for coroutines: waiting for capacity never blocks the event loop."""
+        import asyncio
+
+        started = time.monotonic()
+        wait = self._reserve(tokens, max_wait)
+        if wait is not None:
+            with _trace_span("openai.queue", wait_ms=round(wait * 1000, 1)):
+                try:
+                    await asyncio.sleep(wait)
+                    # Poll instead of parking a worker thread on the condition. Slots are only
+                    # taken under the lock, so a cancelled waiter holds nothing but its reservation.
+                    while True:
+                        with self._slot_freed:
+                            if self._try_take_slot(started + max_wait, tokens):
+                                break
+                        await asyncio.sleep(0.01)
+                except asyncio.CancelledError:
+                    with self._slot_freed:
+                        self._refund(tokens)
+                    raise
+                finally:
+                    self._dequeue(started)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> dict[str, Any]:
+        with self._slot_freed:
+            return {
+                "in_flight": self.in_flight,
+                "queue_depth": self.queue_depth,
+                "peak_queue_depth": self.peak_queue_depth,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "delayed": self.delayed,
+                "wait_seconds_total": round(self.wait_seconds_total, 3),
+                "wait_seconds_max": round(self.wait_seconds_max, 3),
+                "wait_seconds_mean": round(self.wait_seconds_total / self.delayed, 3) if self.delayed else 0.0,
+            }
+
+
+_openai_rate_limiter = OpenAIRateLimiter()
+_openai_circuit_breaker = CircuitBreaker()
+
+
+def get_openai_rate_limiter() -> OpenAIRateLimiter:
+    """Process-wide limiter shared by every OpenAI call NUNBot makes."""
+    return _openai_rate_limiter
+
+
+def get_openai_circuit_breaker() -> CircuitBreaker:
+    """Process-wide circuit breaker shared by every OpenAI call NUNBot makes."""
+    return _openai_circuit_breaker
+
+
+class PromptTokenMeter:
+    """Prompt tokens of every answered OpenAI request: the local estimate and what the provider billed.
+
+    ``cached_prompt_tokens`` is the part of the prompt served from the
+    provider's prefix cache (``usage.prompt_tokens_details.cached_tokens``).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.estimated_prompt_tokens = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+
+    def record(self, model: str, estimated: int, usage: Any = None) -> None:
+        prompt_tokens = int(getattr(usage, "prompt_tokens", 0) or 0)
+        cached_tokens = int(getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0)
+        with self._lock:
+            self.requests += 1
+            self.estimated_prompt_tokens += estimated
+            self.prompt_tokens += prompt_tokens
+            self.cached_prompt_tokens += cached_tokens
+        logger.info(
+            "openai_prompt_tokens model=%s estimated=%s prompt=%s cached=%s",
+            model,
+            estimated,
+            prompt_tokens if usage is not None else "-",
+            cached_tokens if usage is not None else "-",
+        )
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "estimated_prompt_tokens": self.estimated_prompt_tokens,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_prompt_tokens": self.cached_prompt_tokens,
+                "mean_prompt_tokens": round((self.prompt_tokens or self.estimated_prompt_tokens) / self.requests, 1) if self.requests else 0.0,
+            }
+
+
+_prompt_token_meter = PromptTokenMeter()
+
+
+def get_prompt_token_meter() -> PromptTokenMeter:
+    """Process-wide prompt token counters for the requests OpenAI answered."""
+    return _prompt_token_meter
+
+
+def _is_timeout(error: BaseException) -> bool:
+    return isinstance(error, TimeoutError) or "timeout" in type(error).__name__.lower()
+
+
+def _record_openai_failure(error: Exception, budget_limited: bool) -> None:
+    # A timeout we shortened to fit the search budget says nothing about the provider.
+    if budget_limited and _is_timeout(error):
+        _openai_circuit_breaker.record_skipped()
+    else:
+        _openai_circuit_breaker.record_failure(error)
+
+
+@dataclass(slots=True)
+class _GuardedRequest:
+    """One OpenAI request inside ``_circuit_guard``; set ``budget_limited`` once the timeout is known."""
+
+    budget_limited: bool = False
+
+
+@contextmanager
+def _circuit_guard() -> Iterator[_GuardedRequest]:
+    """Send one OpenAI request behind the circuit breaker, recording its outcome."""
+    _openai_circuit_breaker.before_call()
+    request = _GuardedRequest()
+    try:
+        yield request
+    except OpenAIUnavailable:
+        _openai_circuit_breaker.record_skipped()
+        raise
+    except Exception as exc:
+        _record_openai_failure(exc, request.budget_limited)
+        raise
+    except BaseException:
+        # Cancelled or interrupted before an answer: nothing is known about the provider.
+        _openai_circuit_breaker.record_skipped()
+        raise
+    _openai_circuit_breaker.record_success()
+
+
+def _with_timeout(client: OpenAI | AsyncOpenAI, timeout_seconds: float, *, sdk_retries: bool = True):
+    if hasattr(client, "with_options"):
+        if not sdk_retries:
+            return client.with_options(timeout=timeout_seconds, max_retries=0)
+        return client.with_options(timeout=timeout_seconds)
+    return client
+
+
+def _attempt_max_wait(budget: SearchBudget, attempt: int, last_error: Exception | None) -> float:
+    """Longest rate-limit wait for the next attempt."""
+    if budget.expired:
+        raise SearchDeadlineExceeded(f"search budget spent before OpenAI attempt {attempt + 1}") from last_error
+    return budget.cap(DEFAULT_OPENAI_MAX_WAIT_SECONDS)
+
+
+def _admitted_client(client: OpenAI | AsyncOpenAI, budget: SearchBudget, timeout_seconds: float) -> tuple[Any, bool]:
+    """Client for a request the rate limiter just admitted, and whether the budget shortened its timeout.
+
+    The timeout is taken from what the queue wait left of the budget, not
+    from what remained before it.
+    """
+    if budget.expired:
+        raise SearchDeadlineExceeded("search budget spent while queued for OpenAI")
+    timeout = budget.cap(timeout_seconds)
+    budget_limited = timeout < timeout_seconds
+    # The SDK's own retries would run past the budget; our loop retries within it instead.
+    return _with_timeout(client, timeout, sdk_retries=not budget_limited), budget_limited
+
+
+def _parse_json_content(content: str) -> dict[str, Any]:
+    try:
+        payload = json.loads(content)
+        return payload if isinstance(payload, dict) else {}
+    except json.JSONDecodeError:
+        return {}
+
+
+def _completion_kwargs(model: str, messages: list[dict[str, str]], max_tokens: int, temperature: float) -> dict[str, Any]:
+    completion_kwargs: dict[str, Any] = {
+        "model": model,
+        "messages": messages,
+        "response_format": {"type": "json_object"},
+        "temperature": temperature,
+    }
+    if str(model).startswith("gpt-5"):
+        completion_kwargs["max_completion_tokens"] = max_tokens
+    else:
+        completion_kwargs["max_tokens"] = max_tokens
+    return completion_kwargs
+
+
+def _retry_delay(attempt: int, error: Exception | None = None) -> float:
+    """Exponential backoff, or the provider's ``Retry-After`` hint on a 429 when it is longer."""
+    delay = 0.5 * (2 ** attempt)
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        retry_after = float(headers.get("retry-after", 0))
+    except (TypeError, ValueError, AttributeError):
+        retry_after = 0.0
+    return max(delay, min(retry_after, DEFAULT_OPENAI_MAX_WAIT_SECONDS))
+
+
+class JsonArrayStreamParser:
+    """Incrementally extracts the objects of one JSON array from streamed completion text.
+
+    ``feed`` returns every object of ``array_key`` whose closing brace arrived
+    with the chunk, so callers can act on a suggestion before the rest of the
+    response is generated. String contents (including escaped quotes and
+    braces) are skipped, and objects that fail to parse are dropped.
+    """
+
+    def __init__(self, array_key: str):
+        self._array_start = re.compile(r'"' + re.escape(array_key) + r'"\s*:\s*\[')
+        self._text = ""
+        self._position = 0
+        self._state = "key"
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._object_start = 0
+        self.items: list[dict[str, Any]] = []
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def feed(self, chunk: str) -> list[dict[str, Any]]:
+        self._text += chunk
+        if self._state == "key":
+            match = self._array_start.search(self._text)
+            if match is None:
+                return []
+            self._state = "array"
+            self._position = match.end()
+        if self._state != "array":
+            return []
+
+        found: list[dict[str, Any]] = []
+        text = self._text
+        position = self._position
+        while position < len(text):
+            char = text[position]
+            position += 1
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    self._object_start = position - 1
+                self._depth += 1
+            elif char == "}" and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        item = json.loads(text[self._object_start : position])
+                    except json.JSONDecodeError:
+                        continue
+                    if isinstance(item, dict):
+                        found.append(item)
+            elif char == "]" and self._depth == 0:
+                self._state = "done"
+                break
+        self._position = position
+        self.items.extend(found)
+        return found
+
+
+def _stream_content(stream: Iterable[Any], usage: list[Any] | None = None) -> Iterable[str]:
+    """Delta text of a completion stream; the final usage chunk, when present, is appended to ``usage``."""
+    for chunk in stream:
+        if usage is not None and getattr(chunk, "usage", None) is not None:
+            usage.append(chunk.usage)
+        choices = getattr(chunk, "choices", None)
+        if not choices:
+            continue
+        content = getattr(choices[0].delta, "content", None)
+        if content:
+            yield content
+
+
+def _read_stream(
+    stream: Any, *, parser: JsonArrayStreamParser, on_item: Callable[[dict[str, Any]], None], budget: SearchBudget, span: TraceSpan, start: float
+) -> tuple[str, Any]:
+    """Text and usage of a completion stream, handing each closed ``parser`` item to ``on_item`` on the way."""
+    parts: list[str] = []
+    usage: list[Any] = []
+    for content in _stream_content(stream, usage):
+        # A chunk that arrives after the deadline is dropped; the HTTP read timeout bounds a stall.
+        if budget.expired:
+            break
+        parts.append(content)
+        for item in parser.feed(content):
+            if item is parser.items[0]:
+                span.attributes["first_item_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                logger.info("openai_stream_first_item elapsed=%.2fs", time.perf_counter() - start)
+            on_item(item)
+    if budget.exhausted and hasattr(stream, "close"):
+        stream.close()
+    return "".join(parts), usage[-1] if usage else None
+
+
+def _chat_request(
+    model: str, messages: list[dict[str, str]], max_tokens: int, temperature: float, *, stream: bool = False
+) -> tuple[dict[str, Any], int, int]:
+    """Completion kwargs, the estimated prompt tokens and the estimate charged against the TPM limit."""
+    completion_kwargs = _completion_kwargs(model, messages, max_tokens, temperature)
+    if stream:
+        completion_kwargs.update(stream=True, stream_options={"include_usage": True})
+    prompt_tokens = estimate_prompt_tokens(messages)
+    # OpenAI counts the prompt plus the completion budget against the TPM limit.
+    return completion_kwargs, prompt_tokens, prompt_tokens + max_tokens
+
+
+def _completion_payload(model: str, prompt_tokens: int, response: Any) -> dict[str, Any]:
+    _prompt_token_meter.record(model, prompt_tokens, getattr(response, "usage", None))
+    return _parse_json_content(response.choices[0].message.content or "{}")
+
+
+def _failed_attempt(error: Exception, attempt: int, retry_attempts: int, budget: SearchBudget) -> Exception:
+    """Log a failed attempt and return its error, or raise ``SearchDeadlineExceeded`` when no time is left to retry."""
+    logger.warning("OpenAI request failed on attempt %s/%s: %s", attempt + 1, retry_attempts + 1, error)
+    if budget.expired:
+        raise SearchDeadlineExceeded("search budget spent during an OpenAI attempt") from error
+    return error
+
+
+def _backoff_delay(attempt: int, retry_attempts: int, error: Exception | None, budget: SearchBudget) -> float | None:
+    """Seconds to wait before the next attempt; None after the last one or once the breaker opened."""
+    if attempt >= retry_attempts or _openai_circuit_breaker.state == "open":
+        return None
+    return budget.cap(_retry_delay(attempt, error))
+
+
+def _chat_json_with_retry(
+    client: OpenAI,
+    *,
+    model: str,
+    messages: list[dict[str, str]],
+    max_tokens: int,
+    temperature: float,
+    timeout_seconds: int = DEFAULT_TIMEOUT_SECONDS,
+    retry_attempts: int = DEFAULT_RETRY_ATTEMPTS,
+    budget: SearchBudget | None = None,
+    array_key: str = "",
+    on_item: Callable[[dict[str, Any]], None] | None = None,
+) -> dict[str, Any]:
+    """JSON completion with retries, backoff, circuit breaking and rate limiting, bounded by ``budget``.
+
+    With ``on_item`` the completion is streamed and each object of
+    ``array_key`` is handed to ``on_item`` as it closes. Such a request is
+    only retried while nothing has been handed over yet; once items were
+    emitted, an interrupted or truncated stream returns the items received so
+    far instead of repeating them. The same applies when the search budget
+    runs out mid-stream: reading stops and the items received so far are
+    returned.
+    """
+    last_error: Exception | None = None
+    budget = budget or SearchBudget()
+    streaming = on_item is not None
+    completion_kwargs, prompt_tokens, estimated_tokens = _chat_request(model, messages, max_tokens, temperature, stream=streaming)
+    attributes = {"stream": True} if streaming else {}
+
+    for attempt in range(retry_attempts + 1):
+        max_wait = _attempt_max_wait(budget, attempt, last_error)
+        parser = JsonArrayStreamParser(array_key)
+        start = time.perf_counter()
+        with _trace_span("openai.attempt", attempt=attempt + 1, model=model, estimated_tokens=estimated_tokens, **attributes) as span:
+            try:
+                with _circuit_guard() as guard, _openai_rate_limiter.limit(estimated_tokens, max_wait=max_wait):
+                    request_client, guard.budget_limited = _admitted_client(client, budget, timeout_seconds)
+                    response = request_client.chat.completions.create(**completion_kwargs)
+                    if not streaming:
+                        return _completion_payload(model, prompt_tokens, response)
+                    # The slot stays held while the stream is read.
+                    content, usage = _read_stream(response, parser=parser, on_item=on_item, budget=budget, span=span, start=start)
+                _prompt_token_meter.record(model, prompt_tokens, usage)
+                return _streamed_payload(content, parser, array_key, budget)
+            except OpenAIUnavailable:
+                raise
+            except Exception as exc:
+                span.error = type(exc).__name__
+                if parser.items:
+                    logger.warning("OpenAI stream interrupted after %s items: %s", len(parser.items), exc)
+                    return {array_key: parser.items}
+                last_error = _failed_attempt(exc, attempt, retry_attempts, budget)
+        # The backoff is its own span so the attempt durations stay request latencies.
+        delay = _backoff_delay(attempt, retry_attempts, last_error, budget)
+        if delay is not None:
+            with _trace_span("openai.backoff", attempt=attempt + 1):
+                time.sleep(delay)
+
+    if last_error:
+        raise last_error
+    return {}
+
+
+async def _async_chat_json_with_retry(
+    client: AsyncOpenAI,
+    *,
+    model: str,
+    messages: list[dict[str, str]],
+    max_tokens: int,
+    temperature: float,
+    timeout_seconds: int = DEFAULT_TIMEOUT_SECONDS,
+    retry_attempts: int = DEFAULT_RETRY_ATTEMPTS,
+    budget: SearchBudget | None = None,
+) -> dict[str, Any]:
+    """``_chat_json_with_retry`` for ``AsyncOpenAI``, without streaming; waits never block the event loop."""
+    import asyncio
+
+    last_error: Exception | None = None
+    budget = budget or SearchBudget()
+    completion_kwargs, prompt_tokens, estimated_tokens = _chat_request(model, messages, max_tokens, temperature)
+
+    for attempt in range(retry_attempts + 1):
+        max_wait = _attempt_max_wait(budget, attempt, last_error)
+        with _trace_span("openai.attempt", attempt=attempt + 1, model=model, estimated_tokens=estimated_tokens) as span:
+            try:
+                with _circuit_guard() as guard:
+                    async with _openai_rate_limiter.async_limit(estimated_tokens, max_wait=max_wait):
+                        request_client, guard.budget_limited = _admitted_client(client, budget, timeout_seconds)
+                        response = await request_client.chat.completions.create(**completion_kwargs)
+                return _completion_payload(model, prompt_tokens, response)
+            except OpenAIUnavailable:
+                raise
+            except Exception as exc:
+                span.error = type(exc).__name__
+                last_error = _failed_attempt(exc, attempt, retry_attempts, budget)
+        delay = _backoff_delay(attempt, retry_attempts, last_error, budget)
+        if delay is not None:
+            with _trace_span("openai.backoff", attempt=attempt + 1):
+                await asyncio.sleep(delay)
+
+    if last_error:
+        raise last_error
+    return {}
+
+
+def _streamed_payload(content: str, parser: JsonArrayStreamParser, array_key: str, budget: SearchBudget) -> dict[str, Any]:
+    if budget.exhausted:
+        logger.info("openai_stream_cut_by_deadline items=%s", len(parser.items))
+        if not parser.items:
+            raise SearchDeadlineExceeded("search budget spent before the first suggestion")
+        return {array_key: parser.items}
+    payload = _parse_json_content(content or "{}")
+    if isinstance(payload.get(array_key), list):
+        return payload
+    # Truncated or malformed JSON: keep the objects that did close.
+    return {array_key: parser.items}
+
+
+# Static instructions go in the system message and the variable content last,
+# so every request shares one token prefix that the provider can cache.
+REGION_SYSTEM_PROMPT = """
+Eres un asistente médico especializado en traumatología y ortopedia, experto en anatomía traumatológica. Tu tarea es determinar la región anatómica basándote en la descripción del procedimiento que envía el usuario.
+
+GLOSARIO MÉDICO CONTEXTUAL - REGIONES ANATÓMICAS:
+- **MS** → Miembro Superior (hombro, húmero, codo, antebrazo, muñeca, mano, dedos)
+- **CO** → Columna (cervical, dorsal, lumbar, sacra, vertebras)
+- **PC** → Pelvis y Cadera (fémur proximal, acetábulo, sacro, cadera)
+- **RO** → Rodilla (patela, cóndilos femorales, platillos tibiales, ligamentos cruzados)
+- **PP** → Pierna y Pie (tibia, peroné, tobillo, calcáneo, astrágalo, metatarsianos, falanges)
+
+EJEMPLOS DE INTERPRETACIÓN:
+- "fractura de cadera" → región PC
+- "fractura de muñeca" → región MS
+- "fractura de tobillo" → región PP
+- "fractura de columna" → región CO
+- "fractura de rodilla" → región RO
+- "forage de cadera" → región PC
+
+INSTRUCCIONES:
+1. Analiza la descripción del procedimiento
+2. Identifica la región anatómica más apropiada
+3. Responde SOLO con el código de la región en formato JSON
+
+FORMATO DE RESPUESTA (JSON obligatorio):
+{
+    "region": "PC",
+    "confianza": 0.95,
+    "motivo": "Explicación breve de por qué esta región es correcta"
+}
+
+IMPORTANTE:
+- Responde SOLO en formato JSON válido
+- La región debe ser exactamente: MS, CO, PC, RO, o PP
+- La confianza debe ser un número entre 0 y 1
+""".strip()
+
+SEARCH_SYSTEM_PROMPT = """
+Eres un asistente médico especializado en traumatología y ortopedia, experto en códigos NUN. Tu tarea es encontrar los códigos NUN más apropiados para el procedimiento que describe el usuario, eligiendo solo entre los procedimientos de la lista que acompaña cada consulta.
+
+INSTRUCCIONES:
+1. Analiza la descripción del procedimiento médico
+2. Busca coincidencias EXACTAS en las descripciones primero
+3. Identifica palabras clave médicas relevantes (anatomía, técnica quirúrgica, tipo de lesión, etc.)
+4. Considera la complejidad y tipo de procedimiento
+5. Devuelve EXACTAMENTE 3-5 códigos más probables, ordenados por relevancia y confianza
+
+FORMATO DE RESPUESTA (JSON obligatorio):
+{
     "codigos_sugeridos": [
-        {{
+        {
             "codigo": "PC.05.07",
             "motivo": "Explicación breve de por qué este código es relevante",
             "confianza": 0.95
-        }}
+        }
     ]
-}}
+}
 
 IMPORTANTE:
 - Solo sugiere códigos que existan en la lista proporcionada
 - Busca coincidencias EXACTAS en las descripciones antes que aproximadas
 - La confianza debe ser un número entre 0 y 1
 - Ordena por relevancia (más relevante primero)
-- Responde SOLO en formato JSON
+- Responde SOLO en formato JSON válido
 - Para "forage de cadera" busca específicamente códigos que contengan "forage" y "cadera"
-""".strip(),
+""".strip()
+
+_TOKEN_PIECE = re.compile(r"\w+|[^\w\s]")
+# Per-message framing tokens of the chat format.
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Local token estimate: one per punctuation mark and about one per five letters of each word.
+
+    BPE vocabularies split Spanish medical terms (and accented letters) more
+    than English prose, so this errs slightly high, which is the safe side for
+    a budget.
+    """
+    return sum((len(piece) + 4) // 5 for piece in _TOKEN_PIECE.findall(text))
+
+
+def estimate_prompt_tokens(messages: list[dict[str, str]]) -> int:
+    return sum(estimate_tokens(message.get("content", "")) + MESSAGE_TOKEN_OVERHEAD for message in messages)
+
+
+_SEARCH_SYSTEM_PROMPT_TOKENS = estimate_tokens(SEARCH_SYSTEM_PROMPT)
+
+
+def build_region_prompt(user_description: str) -> list[dict[str, str]]:
+    return [
+        {"role": "system", "content": REGION_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": f'''DESCRIPCIÓN DEL PROCEDIMIENTO:
+"{user_description}"
+
+Indica la región anatómica de este procedimiento en el formato JSON indicado.''',
         },
     ]
 
 
-def infer_region_with_openai(client: OpenAI, user_description: str, *, model: str = DEFAULT_MODEL) -> tuple[str, float, str]:
+def build_search_prompt(
+    user_description: str,
+    candidate_procedures: pd.DataFrame | Iterable[Mapping[str, Any]],
+    *,
+    token_budget: int = DEFAULT_PROMPT_TOKEN_BUDGET,
+) -> tuple[list[dict[str, str]], int]:
+    """Ranking prompt listing the candidates, in order, that fit ``token_budget`` (0 for no limit), and how many it lists.
+
+    The budget covers the whole prompt; the first candidate is always sent.
+    Rows repeating an earlier code are skipped and not counted.
+    """
+    if _is_dataframe(candidate_procedures):
+        candidate_df = cast("pd.DataFrame", candidate_procedures)
+        if "Código" in candidate_df.columns:
+            rows = candidate_df.drop_duplicates(subset=["Código"], keep="first").to_dict(orient="records")
+        else:
+            rows = candidate_df.to_dict(orient="records")
+    else:
+        rows = list(candidate_procedures)
+
+    header = "LISTA DE PROCEDIMIENTOS POSIBLES:\n"
+    footer = f'''
+
+DESCRIPCIÓN DEL PROCEDIMIENTO:
+"{user_description}"
+
+Responde con los "codigos_sugeridos" en el formato JSON indicado, usando solo códigos de la lista.'''
+    used_tokens = (
+        _SEARCH_SYSTEM_PROMPT_TOKENS + estimate_tokens(header) + estimate_tokens(footer) + 2 * MESSAGE_TOKEN_OVERHEAD
+    )
+    lines: list[str] = []
+    seen_codes: set[str] = set()
+    for row in rows:
+        code = str(row.get("Código", "")).strip()
+        if code and code in seen_codes:
+            continue
+        if code:
+            seen_codes.add(code)
+        if isinstance(row, Procedure):
+            line, line_tokens = row.prompt_line, row.prompt_tokens
+        else:
+            line = _format_candidate_row(row)
+            line_tokens = estimate_tokens(line) + 1
+        if token_budget and lines and used_tokens + line_tokens > token_budget:
+            break
+        lines.append(line)
+        used_tokens += line_tokens
+
+    messages = [
+        {"role": "system", "content": SEARCH_SYSTEM_PROMPT},
+        {"role": "user", "content": header + "\n".join(lines) + footer},
+    ]
+    return messages, len(lines)
+
+
+def infer_region_with_openai(
+    client: OpenAI, user_description: str, *, model: str = DEFAULT_MODEL, budget: SearchBudget | None = None
+) -> tuple[str, float, str]:
     payload = _chat_json_with_retry(
         client,
         model=model,
         messages=build_region_prompt(user_description),
         max_tokens=DEFAULT_REGION_MAX_TOKENS,
         temperature=0.2,
+        budget=budget,
     )
     return validate_region_response(payload)
 
 
-def rank_codes_with_openai(
-    client: OpenAI,
-    user_description: str,
-    candidate_procedures: pd.DataFrame | Iterable[dict[str, Any]],
-    *,
-    model: str = DEFAULT_MODEL,
-) -> list[dict[str, Any]]:
-    payload = _chat_json_with_retry(
+async def async_infer_region_with_openai(
+    client: AsyncOpenAI, user_description: str, *, model: str = DEFAULT_MODEL, budget: SearchBudget | None = None
+) -> tuple[str, float, str]:
+    payload = await _async_chat_json_with_retry(
         client,
         model=model,
-        messages=build_search_prompt(user_description, candidate_procedures),
-        max_tokens=DEFAULT_SEARCH_MAX_TOKENS,
-        temperature=0.3,
+        messages=build_region_prompt(user_description),
+        max_tokens=DEFAULT_REGION_MAX_TOKENS,
+        temperature=0.2,
+        budget=budget,
     )
+    return validate_region_response(payload)
+
+
+def _extract_suggestions(payload: Any) -> list[dict[str, Any]]:
     suggestions = payload.get("codigos_sugeridos", []) if isinstance(payload, dict) else []
     if not isinstance(suggestions, list):
         return []
@@ -583,62 +2687,1349 @@ def rank_codes_with_openai(
     return suggestions
 
 
-def search_nun_codes(
+def _search_prompt(
+    user_description: str, candidate_procedures: pd.DataFrame | Iterable[Mapping[str, Any]]
+) -> tuple[list[dict[str, str]], int]:
+    with _trace_span("prompt.build") as span:
+        messages, listed = build_search_prompt(user_description, candidate_procedures)
+        span.attributes["listed"] = listed
+    return messages, listed
+
+
+def rank_codes_with_openai(
     client: OpenAI,
     user_description: str,
-    procedures_data: pd.DataFrame,
+    candidate_procedures: pd.DataFrame | Iterable[Mapping[str, Any]],
+    *,
+    model: str = DEFAULT_MODEL,
+    on_suggestion: Callable[[dict[str, Any]], None] | None = None,
+    budget: SearchBudget | None = None,
+    messages: list[dict[str, str]] | None = None,
+) -> list[dict[str, Any]]:
+    """Ask the model to rank ``candidate_procedures``.
+
+    With ``on_suggestion`` the completion is streamed and each raw suggestion
+    is passed to the callback as soon as its JSON object is complete.
+    ``messages`` is the prompt already built for ``candidate_procedures`` by
+    ``build_search_prompt``; without it the prompt is built here.
+    """
+    with _trace_span("ranking.openai", stream=on_suggestion is not None) as span:
+        if messages is None:
+            messages, _ = _search_prompt(user_description, candidate_procedures)
+        payload = _chat_json_with_retry(
+            client,
+            model=model,
+            messages=messages,
+            max_tokens=DEFAULT_SEARCH_MAX_TOKENS,
+            temperature=0.3,
+            budget=budget,
+            array_key="codigos_sugeridos",
+            on_item=on_suggestion,
+        )
+        suggestions = _extract_suggestions(payload)
+        span.attributes["suggestions"] = len(suggestions)
+    return suggestions
+
+
+async def async_rank_codes_with_openai(
+    client: AsyncOpenAI,
+    user_description: str,
+    candidate_procedures: pd.DataFrame | Iterable[Mapping[str, Any]],
+    *,
+    model: str = DEFAULT_MODEL,
+    budget: SearchBudget | None = None,
+    messages: list[dict[str, str]] | None = None,
+) -> list[dict[str, Any]]:
+    with _trace_span("ranking.openai", stream=False) as span:
+        if messages is None:
+            messages, _ = _search_prompt(user_description, candidate_procedures)
+        payload = await _async_chat_json_with_retry(
+            client,
+            model=model,
+            messages=messages,
+            max_tokens=DEFAULT_SEARCH_MAX_TOKENS,
+            temperature=0.3,
+            budget=budget,
+        )
+        suggestions = _extract_suggestions(payload)
+        span.attributes["suggestions"] = len(suggestions)
+    return suggestions
+
+
+def default_cache_path() -> Path:
+    configured = os.getenv("NUNBOT_CACHE_PATH")
+    if configured and configured.strip():
+        return Path(configured).expanduser()
+    return Path.home() / ".cache" / "nunbot" / "search_cache.sqlite3"
+
+
+def build_search_cache_key(
+    user_description: str,
+    procedures_data: ProcedureData,
     *,
     model: str = DEFAULT_MODEL,
     top_candidates: int = DEFAULT_TOP_CANDIDATES,
-) -> tuple[str, float, str, list[dict[str, Any]], list[dict[str, Any]], bool]:
-    used_fallback = False
-    region, confidence, reason = determine_region_locally(user_description)
-    if not region:
+    scoring: str = DEFAULT_SCORING_BACKEND,
+) -> str:
+    parts = [normalize_search_query(user_description), model, scoring, top_candidates, dataset_fingerprint(procedures_data)]
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def build_search_cache_scope(
+    procedures_data: ProcedureData,
+    *,
+    model: str = DEFAULT_MODEL,
+    top_candidates: int = DEFAULT_TOP_CANDIDATES,
+    scoring: str = DEFAULT_SCORING_BACKEND,
+) -> str:
+    """Everything in the cache key except the query; near-duplicate matches never cross scopes."""
+    parts = [model, scoring, top_candidates, dataset_fingerprint(procedures_data)]
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_parameters: list[tuple[int, int]] | None = None
+
+
+def _similarity_terms(text: str) -> list[str]:
+    """``tokenize_query`` terms plus the negations, which are stopwords for ranking but change the procedure."""
+    return [term for term in normalize_search_query(text).split() if term not in STOPWORDS or term in NEGATION_TERMS]
+
+
+def query_shingles(text: str) -> frozenset[str]:
+    """Character trigrams of every query term, padded at word boundaries.
+
+    Word order and stopwords other than negations do not change the set, and
+    a typo only changes the few trigrams around it.
+    """
+    shingles: set[str] = set()
+    for term in _similarity_terms(text):
+        padded = f" {term} "
+        shingles.update(padded[start : start + 3] for start in range(len(padded) - 2))
+    return frozenset(shingles)
+
+
+def query_discriminators(text: str) -> frozenset[str]:
+    """Negation, laterality and anatomy terms of ``text``.
+
+    A near-duplicate must have exactly the same ones: "con placa" / "sin
+    placa" or "medial" / "lateral" score high trigram similarity but bill
+    different codes.
+    """
+    normalized = normalize_search_query(text)
+    terms = set(normalized.split()) & (NEGATION_TERMS | LATERALITY_TERMS)
+    return frozenset(terms | get_region_matcher().find(normalized))
+
+
+def _jaccard(left: frozenset[str], right: frozenset[str]) -> float:
+    if not left or not right:
+        return 0.0
+    return len(left & right) / len(left | right)
+
+
+def _lsh_bands(shingles: frozenset[str], scope: str) -> list[str]:
+    """MinHash signature of ``shingles`` split into LSH band keys prefixed by ``scope``."""
+    global _minhash_parameters
+    if _minhash_parameters is None:
+        generator = random.Random(20260316)
+        _minhash_parameters = [
+            (generator.randrange(1, _MINHASH_PRIME), generator.randrange(0, _MINHASH_PRIME)) for _ in range(MINHASH_PERMUTATIONS)
+        ]
+
+    hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles]
+    signature = [min((a * value + b) % _MINHASH_PRIME for value in hashes) for a, b in _minhash_parameters]
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    bands: list[str] = []
+    for band in range(MINHASH_BANDS):
+        chunk = ",".join(map(str, signature[band * rows : (band + 1) * rows]))
+        bands.append(f"{scope}:{band}:{hashlib.blake2b(chunk.encode('ascii'), digest_size=8).hexdigest()}")
+    return bands
+
+
+class SearchResultCache:
+    """Disk-backed cache of ``search_nun_codes`` results shared across sessions and processes.
+
+    Entries live in a local SQLite file, expire after ``ttl_seconds`` and the
+    least recently used ones are evicted once ``max_entries`` is exceeded.
+    Any SQLite error is logged and treated as a cache miss.
+
+    Entries stored with their query and scope are also indexed with MinHash
+    LSH over ``query_shingles``, so ``get_similar`` can find the result of a
+    rephrased description without scanning every entry.
+    """
+
+    def __init__(
+        self,
+        path: str | Path | None = None,
+        *,
+        ttl_seconds: int = DEFAULT_CACHE_TTL_SECONDS,
+        max_entries: int = DEFAULT_CACHE_MAX_ENTRIES,
+    ):
+        self.path = Path(path) if path else default_cache_path()
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._schema_ready = False
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self._local.connection = connection
+        if not self._schema_ready:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS search_results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS search_results_accessed ON search_results (accessed_at)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS search_queries ("
+                "key TEXT PRIMARY KEY REFERENCES search_results (key) ON DELETE CASCADE, query TEXT NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS search_query_bands ("
+                "band TEXT NOT NULL, key TEXT NOT NULL REFERENCES search_queries (key) ON DELETE CASCADE, "
+                "PRIMARY KEY (band, key)) WITHOUT ROWID"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS search_query_bands_key ON search_query_bands (key)")
+            self._schema_ready = True
+        return connection
+
+    def get(self, key: str) -> SearchResult | None:
+        now = time.time()
         try:
-            region, confidence, reason = infer_region_with_openai(client, user_description, model=model)
-        except Exception as exc:
-            logger.warning("OpenAI region inference failed; using deterministic fallback: %s", exc)
-            region, confidence, reason = "", 0.0, (
-                "No se pudo inferir la región con OpenAI; se usará una búsqueda determinística de respaldo."
+            connection = self._connect()
+            row = connection.execute("SELECT value, created_at FROM search_results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl_seconds:
+                connection.execute("DELETE FROM search_results WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE search_results SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as exc:
+            logger.warning("Search cache read failed (%s): %s", self.path, exc)
+            return None
+
+        try:
+            result = SearchResult.from_dict(json.loads(value))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+        result.cached = True
+        return result
+
+    def get_similar(self, query: str, scope: str, *, threshold: float) -> SearchResult | None:
+        """Cached result of the most similar stored query in ``scope``, if its similarity reaches ``threshold``.
+
+        Stored queries whose ``query_discriminators`` differ are never reused, however similar.
+        """
+        shingles = query_shingles(query)
+        if not shingles:
+            return None
+        bands = _lsh_bands(shingles, scope)
+        try:
+            rows = self._connect().execute(
+                "SELECT DISTINCT q.key, q.query FROM search_query_bands b JOIN search_queries q ON q.key = b.key "
+                f"WHERE b.band IN ({','.join('?' * len(bands))})",
+                bands,
+            ).fetchall()
+        except sqlite3.Error as exc:
+            logger.warning("Search cache similarity lookup failed (%s): %s", self.path, exc)
+            return None
+
+        candidates = sorted(((_jaccard(shingles, query_shingles(stored)), key, stored) for key, stored in rows), reverse=True)
+        discriminators = query_discriminators(query)
+        for similarity, key, stored in candidates:
+            if similarity < threshold:
+                break
+            if query_discriminators(stored) != discriminators:
+                continue
+            result = self.get(key)
+            if result is not None:
+                result.similarity = round(similarity, 4)
+                return result
+        return None
+
+    def set(self, key: str, result: SearchResult, *, query: str | None = None, scope: str | None = None) -> None:
+        """Store ``result``; with ``query`` and ``scope`` it also becomes reachable through ``get_similar``."""
+        now = time.time()
+        payload = result.to_dict()
+        payload["cached"] = False
+        payload["similarity"] = None
+        value = json.dumps(payload, ensure_ascii=False, default=str)
+        try:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO search_results (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            shingles = query_shingles(query or "")
+            if scope and shingles:
+                connection.execute(
+                    "INSERT OR REPLACE INTO search_queries (key, query) VALUES (?, ?)", (key, normalize_search_query(query or ""))
+                )
+                connection.executemany(
+                    "INSERT OR IGNORE INTO search_query_bands (band, key) VALUES (?, ?)",
+                    [(band, key) for band in _lsh_bands(shingles, scope)],
+                )
+            connection.execute("DELETE FROM search_results WHERE created_at < ?", (now - self.ttl_seconds,))
+            connection.execute(
+                "DELETE FROM search_results WHERE key IN ("
+                "SELECT key FROM search_results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
             )
-            used_fallback = True
+        except sqlite3.Error as exc:
+            logger.warning("Search cache write failed (%s): %s", self.path, exc)
 
-    if region:
-        region_df = procedures_data[procedures_data["Región"].astype(str).str.upper() == region.upper()]
+    def clear(self) -> None:
+        try:
+            self._connect().execute("DELETE FROM search_results")
+        except sqlite3.Error as exc:
+            logger.warning("Search cache clear failed (%s): %s", self.path, exc)
+
+    def __len__(self) -> int:
+        try:
+            return int(self._connect().execute("SELECT COUNT(*) FROM search_results").fetchone()[0])
+        except sqlite3.Error:
+            return 0
+
+
+_default_search_cache: SearchResultCache | None = None
+_default_search_cache_lock = threading.Lock()
+
+
+def get_search_cache() -> SearchResultCache:
+    """Process-wide cache instance at ``default_cache_path()``."""
+    global _default_search_cache
+    with _default_search_cache_lock:
+        if _default_search_cache is None:
+            _default_search_cache = SearchResultCache()
+        return _default_search_cache
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key onto one in-flight computation.
+
+    The first caller for a key (the leader) runs the computation; callers that
+    arrive while it is running wait for it and receive the same result or
+    exception. ``async_search_nun_codes`` runs the pipeline in a worker
+    thread too, so Streamlit sessions and the async path share computations
+    with each other.
+
+    Only results and ``Exception``s are shared. When the leader is
+    interrupted (``KeyboardInterrupt``, ``SystemExit``, a cancelled task) or a
+    caller's ``timeout`` runs out first, that caller runs the computation
+    itself instead.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[str, Future[Any]] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _join(self, key: str) -> tuple[Future[Any], bool]:
+        from concurrent.futures import Future
+
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = Future()
+            self._calls[key] = future
+            self.leaders += 1
+            return future, True
+
+    def _settle(self, key: str, future: Future[Any], result: Any = None, error: Exception | None = None) -> None:
+        # Later callers start a fresh computation (or hit the cache it filled).
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _abandon(self, key: str, future: Future[Any]) -> None:
+        with self._lock:
+            self._calls.pop(key, None)
+        # Wakes the waiting callers with CancelledError, so each runs the computation itself.
+        future.cancel()
+
+    def do(self, key: str, function: Callable[[], Any], *, timeout: float | None = None) -> Any:
+        """Result of ``function``, shared with concurrent callers of ``key``; waits at most ``timeout`` seconds for a leader."""
+        from concurrent.futures import CancelledError
+
+        future, leader = self._join(key)
+        if not leader:
+            logger.info("single_flight_coalesced key=%s", key[:12])
+            try:
+                return future.result(timeout)
+            except (CancelledError, TimeoutError):
+                logger.info("single_flight_leader_lost key=%s", key[:12])
+                return function()
+        try:
+            result = function()
+        except Exception as exc:
+            self._settle(key, future, error=exc)
+            raise
+        except BaseException:
+            self._abandon(key, future)
+            raise
+        self._settle(key, future, result)
+        return result
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+_search_single_flight = SingleFlight()
+
+
+def get_search_single_flight() -> SingleFlight:
+    """Process-wide coalescing layer used by ``search_nun_codes`` and ``async_search_nun_codes``."""
+    return _search_single_flight
+
+
+_background_pool: ThreadPoolExecutor | None = None
+_background_pool_lock = threading.Lock()
+
+
+def _background_executor() -> ThreadPoolExecutor:
+    """Process-wide worker threads for speculative rankings and local bypass audits."""
+    global _background_pool
+    with _background_pool_lock:
+        if _background_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            # Each task is one OpenAI request, which the rate limiter admits at this concurrency anyway.
+            workers = max(1, DEFAULT_OPENAI_MAX_CONCURRENCY)
+            _background_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="nunbot-background")
+        return _background_pool
+
+
+class LocalBypassMonitor:
+    """Bypass rate of the local decision gate and its sampled agreement with OpenAI.
+
+    ``audit_rate`` of the bypassed searches are still ranked by OpenAI in the
+    background; ``agreed`` counts audits whose first code matches the local one.
+    Audits run on the shared background executor, at most
+    ``max_pending_audits`` at a time; samples beyond that are dropped and
+    counted in ``audit_skipped``. ``wait_for_audits`` joins the pending ones.
+    """
+
+    def __init__(
+        self,
+        audit_rate: float = DEFAULT_BYPASS_AUDIT_RATE,
+        *,
+        max_pending_audits: int = DEFAULT_BYPASS_MAX_PENDING_AUDITS,
+        seed: int | None = None,
+    ):
+        self.audit_rate = min(1.0, max(0.0, audit_rate))
+        self.max_pending_audits = max(0, max_pending_audits)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._pending_audits: set[Future[None]] = set()
+        self.evaluated = 0
+        self.bypassed = 0
+        self.audited = 0
+        self.agreed = 0
+        self.audit_failed = 0
+        self.audit_skipped = 0
+
+    def record(self, bypassed: bool) -> bool:
+        """Count one gate decision; True when this bypass should be audited."""
+        with self._lock:
+            self.evaluated += 1
+            if not bypassed:
+                return False
+            self.bypassed += 1
+            return self._random.random() < self.audit_rate
+
+    def start_audit(self, audit: Callable[..., None], *args: Any) -> bool:
+        """Run ``audit(*args)`` in the background unless ``max_pending_audits`` are already pending."""
+        with self._lock:
+            self._pending_audits = {future for future in self._pending_audits if not future.done()}
+            if len(self._pending_audits) >= self.max_pending_audits:
+                self.audit_skipped += 1
+                return False
+            # A fresh context keeps the audit's spans out of the bypassed search's trace.
+            future = _background_executor().submit(contextvars.Context().run, audit, *args)
+            self._pending_audits.add(future)
+        return True
+
+    def wait_for_audits(self, timeout: float | None = None) -> bool:
+        """Wait for the pending audits; False when some are still running after ``timeout`` seconds."""
+        from concurrent.futures import wait
+
+        with self._lock:
+            pending = set(self._pending_audits)
+        return not wait(pending, timeout).not_done
+
+    def record_audit(self, local_code: str, raw_suggestions: list[dict[str, Any]]) -> None:
+        codes = [str(item.get("codigo", "")).strip() for item in raw_suggestions if isinstance(item, dict)]
+        agreed = bool(codes) and codes[0] == local_code
+        with self._lock:
+            self.audited += 1
+            self.agreed += agreed
+        logger.info("local_bypass_audit local=%s openai=%s agreed=%s", local_code, codes[0] if codes else "", agreed)
+
+    def record_audit_failure(self, error: Exception) -> None:
+        with self._lock:
+            self.audit_failed += 1
+        logger.warning("local_bypass_audit_failed error=%s", error)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "evaluated": self.evaluated,
+                "bypassed": self.bypassed,
+                "bypass_rate": round(self.bypassed / self.evaluated, 4) if self.evaluated else 0.0,
+                "audited": self.audited,
+                "agreed": self.agreed,
+                "agreement_rate": round(self.agreed / self.audited, 4) if self.audited else None,
+                "audit_failed": self.audit_failed,
+                "audit_skipped": self.audit_skipped,
+                "audit_pending": sum(not future.done() for future in self._pending_audits),
+            }
+
+
+_local_bypass_monitor = LocalBypassMonitor()
+
+
+def get_local_bypass_monitor() -> LocalBypassMonitor:
+    """Process-wide counters for the searches answered without the OpenAI ranking."""
+    return _local_bypass_monitor
+
+
+REGION_FALLBACK_REASON = "No se pudo inferir la región con OpenAI; se usará una búsqueda determinística de respaldo."
+# Region reasons meaning OpenAI refused to even send the request; the ranking is skipped too.
+OPENAI_UNAVAILABLE_REASONS = frozenset(
+    error.reason for error in (OpenAIUnavailable, OpenAIRateLimitExceeded, OpenAICircuitOpen, SearchDeadlineExceeded)
+)
+
+
+def search_nun_codes(
+    client: OpenAI,
+    user_description: str,
+    procedures_data: ProcedureData,
+    *,
+    model: str = DEFAULT_MODEL,
+    top_candidates: int = DEFAULT_TOP_CANDIDATES,
+    scoring: str = DEFAULT_SCORING_BACKEND,
+    cache: SearchResultCache | None = None,
+    speculative: bool = DEFAULT_SPECULATIVE_RANKING,
+    similarity_threshold: float = DEFAULT_CACHE_SIMILARITY_THRESHOLD,
+    on_suggestion: Callable[[dict[str, Any]], None] | None = None,
+    coalesce: bool = DEFAULT_COALESCE_SEARCHES,
+    deadline_seconds: float | None = DEFAULT_SEARCH_DEADLINE_SECONDS,
+    local_bypass: bool = DEFAULT_LOCAL_BYPASS,
+) -> SearchResult:
+    """Suggest NUN codes for ``user_description``.
+
+    ``on_suggestion`` streams the model ranking: it receives each validated
+    suggestion as soon as the model has written it, in final order. It is not
+    called for cache hits, fallback suggestions, a kept speculative ranking or
+    a search coalesced onto an identical one already in flight (``coalesce``),
+    so callers render ``result.suggestions`` when nothing was streamed.
+
+    ``deadline_seconds`` bounds the whole search. Every OpenAI attempt,
+    backoff and rate-limit wait gets only what remains; when it runs out the
+    best result so far is returned with ``partial=True`` and is not cached.
+
+    ``local_bypass`` answers from the local ranking alone, with
+    ``path="local_bypass"``, when its winner is decisive (see
+    ``_local_bypass_suggestions``). Those results are not cached either: they
+    take milliseconds to recompute, and the near-duplicate lookup would
+    otherwise hand them to rephrasings that never passed the gate.
+
+    Every result carries its own ``trace`` of timed stages, also for cache
+    hits and coalesced searches; with ``NUNBOT_TRACE_EXPORT_PATH`` set each
+    trace is appended there as OTLP/JSON.
+    """
+    return _search(
+        client, user_description, procedures_data, model=model, top_candidates=top_candidates, scoring=scoring, cache=cache,
+        speculative=speculative, similarity_threshold=similarity_threshold, on_suggestion=on_suggestion, coalesce=coalesce,
+        deadline_seconds=deadline_seconds, local_bypass=local_bypass,
+        infer_region=infer_region_with_openai, rank_codes=rank_codes_with_openai,
+    )
+
+
+async def async_search_nun_codes(
+    client: AsyncOpenAI,
+    user_description: str,
+    procedures_data: ProcedureData,
+    *,
+    model: str = DEFAULT_MODEL,
+    top_candidates: int = DEFAULT_TOP_CANDIDATES,
+    scoring: str = DEFAULT_SCORING_BACKEND,
+    cache: SearchResultCache | None = None,
+    speculative: bool = DEFAULT_SPECULATIVE_RANKING,
+    similarity_threshold: float = DEFAULT_CACHE_SIMILARITY_THRESHOLD,
+    coalesce: bool = DEFAULT_COALESCE_SEARCHES,
+    deadline_seconds: float | None = DEFAULT_SEARCH_DEADLINE_SECONDS,
+    local_bypass: bool = DEFAULT_LOCAL_BYPASS,
+) -> SearchResult:
+    """Same pipeline as ``search_nun_codes`` on an ``AsyncOpenAI`` client.
+
+    The pipeline runs in a worker thread; its OpenAI requests are sent as
+    coroutines on the calling event loop, so waits and backoff never block it.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    def on_loop(function: Callable[..., Awaitable[Any]]) -> Callable[..., Any]:
+        def call(*args: Any, **kwargs: Any) -> Any:
+            return asyncio.run_coroutine_threadsafe(function(*args, **kwargs), loop).result()
+
+        return call
+
+    return await asyncio.to_thread(
+        _search,
+        client, user_description, procedures_data, model=model, top_candidates=top_candidates, scoring=scoring, cache=cache,
+        speculative=speculative, similarity_threshold=similarity_threshold, on_suggestion=None, coalesce=coalesce,
+        deadline_seconds=deadline_seconds, local_bypass=local_bypass,
+        infer_region=on_loop(async_infer_region_with_openai), rank_codes=on_loop(async_rank_codes_with_openai),
+    )
+
+
+def _search(
+    client: OpenAI | AsyncOpenAI,
+    user_description: str,
+    procedures_data: ProcedureData,
+    *,
+    model: str,
+    top_candidates: int,
+    scoring: str,
+    cache: SearchResultCache | None,
+    speculative: bool,
+    similarity_threshold: float,
+    on_suggestion: Callable[[dict[str, Any]], None] | None,
+    coalesce: bool,
+    deadline_seconds: float | None,
+    local_bypass: bool,
+    infer_region: Callable[..., tuple[str, float, str]],
+    rank_codes: Callable[..., list[dict[str, Any]]],
+) -> SearchResult:
+    budget = SearchBudget(deadline_seconds)
+    trace = SearchTrace()
+    options = {"model": model, "top_candidates": top_candidates, "scoring": scoring}
+    cache_key = cache_scope = ""
+
+    def compute() -> SearchResult:
+        result = _uncached_search(
+            client,
+            user_description,
+            procedures_data,
+            speculative=speculative,
+            on_suggestion=on_suggestion,
+            budget=budget,
+            local_bypass=local_bypass,
+            infer_region=infer_region,
+            rank_codes=rank_codes,
+            **options,
+        )
+        result.partial = budget.exhausted
+        logger.info(
+            "search_path path=%s region=%s fallback=%s partial=%s prompt_candidates=%s prompt_reason=%s",
+            result.path, result.region or "", result.used_fallback, result.partial, result.prompt_count, result.prompt_reason or "-",
+        )
+        # Fallback and partial results reflect a transient failure or deadline; never persist them.
+        if cache is not None and not result.used_fallback and not result.partial and result.path != "local_bypass":
+            cache.set(cache_key, result, query=user_description, scope=cache_scope)
+        # Set before the coalesced callers are released, so they can tell the result is not theirs.
+        result.trace = trace
+        return result
+
+    with trace.span("search", deadline_seconds=float(deadline_seconds or 0)) as root:
+        result: SearchResult | None = None
+        if cache is not None or coalesce:
+            with _trace_span("normalize"):
+                cache_key = build_search_cache_key(user_description, procedures_data, **options)
+        if cache is not None:
+            with _trace_span("cache.lookup") as span:
+                cache_scope = build_search_cache_scope(procedures_data, **options)
+                result = _cached_search_result(cache, user_description, cache_key, cache_scope, similarity_threshold)
+                span.attributes["hit"] = result is not None
+        if result is None and not coalesce:
+            result = compute()
+        elif result is None:
+            flight_key = _search_flight_key(
+                cache_key, client, cache, speculative=speculative, local_bypass=local_bypass, deadline_seconds=deadline_seconds
+            )
+            # A leader stuck past this caller's own deadline is not waited for.
+            wait = budget.remaining()
+            result = _search_single_flight.do(flight_key, compute, timeout=None if math.isinf(wait) else wait)
+        result = _attach_trace(result, trace, root)
+    if DEFAULT_TRACE_EXPORT_PATH:
+        _export_search_trace(trace)
+    return result
+
+
+def _search_flight_key(
+    cache_key: str,
+    client: Any,
+    cache: SearchResultCache | None,
+    *,
+    speculative: bool,
+    local_bypass: bool,
+    deadline_seconds: float | None,
+) -> str:
+    """Single-flight key covering every argument that changes the computed result.
+
+    ``cache_key`` already covers the query, model, scoring, shortlist size and
+    dataset. The client and cache are keyed by identity: an in-flight search
+    keeps both alive, so their ids cannot be reused meanwhile. Callers with
+    different deadlines must not wait on each other either.
+    """
+    cache_id = id(cache) if cache is not None else 0
+    return f"{cache_key}:{id(client)}:{cache_id}:{int(speculative)}:{int(local_bypass)}:{deadline_seconds or 0}"
+
+
+def _attach_trace(result: SearchResult, trace: SearchTrace, root: TraceSpan) -> SearchResult:
+    """``result`` carrying this caller's ``trace``; a result computed for another coalesced caller is copied."""
+    coalesced = result.trace is not None and result.trace is not trace
+    if coalesced:
+        result = replace(result, trace=trace)
+    else:
+        result.trace = trace
+    root.attributes.update(
+        path=result.path, cached=result.cached, coalesced=coalesced, fallback=result.used_fallback, partial=result.partial
+    )
+    return result
+
+
+def _cached_search_result(
+    cache: SearchResultCache, user_description: str, cache_key: str, cache_scope: str, similarity_threshold: float
+) -> SearchResult | None:
+    cached = cache.get(cache_key)
+    if cached is not None or not 0 < similarity_threshold <= 1:
+        return cached
+
+    cached = cache.get_similar(user_description, cache_scope, threshold=similarity_threshold)
+    if cached is None:
+        return None
+    # A rephrasing must not move the procedure to another region ("tibia" vs "tobillo").
+    local_region, _, _ = determine_region_locally(user_description)
+    if local_region and cached.region and local_region != cached.region:
+        return None
+    logger.info("search_cache_similar_hit similarity=%.3f region=%s", cached.similarity, cached.region or "")
+    return cached
+
+
+def _region_candidates(procedures_data: ProcedureData, region: str) -> tuple[NunIndex, list[int]]:
+    """Index positions of the rows in ``region`` (every row when empty), keeping the first row per code."""
+    index, positions = get_nun_index(procedures_data)
+    wanted = region.upper() if region else ""
+    selected: list[int] = []
+    seen_codes: set[str] = set()
+    for position in positions:
+        row = index.rows[position]
+        if (wanted and row.region != wanted) or row.code in seen_codes:
+            continue
+        seen_codes.add(row.code)
+        selected.append(position)
+    return index, selected
+
+
+def _adaptive_prompt_count(scores: list[float], minimum: int, maximum: int) -> tuple[int, str]:
+    """How many ranked candidates to send the model, read from their local score curve.
+
+    Only cuts that send between ``minimum`` and ``maximum`` candidates are
+    considered: the largest drop among them is taken when it carries at
+    least ``DEFAULT_PROMPT_DROP_OFF`` of the decline over that range
+    (``drop_off``), otherwise ``maximum`` are sent (``flat``). A cut never
+    separates candidates with equal scores; it moves to the end of their tie
+    group, even past ``maximum``. When the scores fall to zero before
+    ``minimum`` (``rank_scored`` pads with unscored rows), ``minimum`` are sent.
+    """
+    minimum = max(1, min(minimum, maximum))
+    window = scores[: maximum + 1]
+    if len(window) <= minimum:
+        return len(window), "short_list"
+    if window[0] <= 0:
+        return min(maximum, len(window)), "unscored"
+    if window[minimum - 1] <= 0:
+        return minimum, "drop_off"
+    # Cutting at k sends window[:k] and skips the drop from window[k - 1] to window[k].
+    spread = window[minimum - 1] - window[-1]
+    drop, cut = max(
+        ((window[k - 1] - window[k], k) for k in range(minimum, len(window))), key=lambda item: (item[0], -item[1])
+    )
+    if spread <= 0 or drop < DEFAULT_PROMPT_DROP_OFF * spread:
+        cut, reason = min(maximum, len(window)), "flat"
     else:
-        region_df = procedures_data
+        reason = "drop_off"
+    while cut < len(scores) and scores[cut] > 0 and scores[cut] == scores[cut - 1]:
+        cut += 1
+    return cut, reason
+
+
+def _local_shortlist(
+    user_description: str,
+    index: NunIndex,
+    positions: list[int],
+    region: str,
+    top_candidates: int,
+    scoring: str,
+) -> tuple[list[Procedure], list[Procedure], str]:
+    """Local candidates, the ones offered to the model, and why that many; the prompt token budget may list fewer."""
+    with _trace_span("ranking.local", region=region, scoring=scoring) as span:
+        scored = index.rank_scored(user_description, region=region, limit=top_candidates, positions=positions, scoring=scoring)
+        local_candidates = [record for _, record in scored]
+        if local_candidates:
+            count, prompt_reason = _adaptive_prompt_count(
+                [score for score, _ in scored], DEFAULT_PROMPT_CANDIDATES_MIN, min(top_candidates, DEFAULT_PROMPT_CANDIDATES)
+            )
+            prompt_candidates = local_candidates[:count]
+        else:
+            prompt_limit = min(top_candidates, DEFAULT_PROMPT_CANDIDATES)
+            prompt_candidates = [index.rows[position].record for position in positions[:prompt_limit]]
+            prompt_reason = "unscored"
+        span.attributes.update(candidates=len(local_candidates), shortlisted=len(prompt_candidates), prompt_reason=prompt_reason)
+    logger.debug("prompt_shortlist count=%s of=%s reason=%s", len(prompt_candidates), len(local_candidates), prompt_reason)
+    return local_candidates, prompt_candidates, prompt_reason
 
-    if "Código" in region_df.columns:
-        region_df = region_df.drop_duplicates(subset=["Código"], keep="first")
 
-    if region_df.empty:
-        return region, confidence, reason, [], [], True
+LOCAL_BYPASS_REASON = "Coincidencia local decisiva: la descripción del código contiene la consulta completa."
+LOCAL_ALTERNATIVE_REASON = "Alternativa local por coincidencia de términos."
 
-    local_candidates = rank_local_candidates(user_description, region_df, region=region, limit=top_candidates)
-    prompt_limit = min(top_candidates, DEFAULT_PROMPT_CANDIDATES)
-    prompt_candidates = local_candidates[:prompt_limit]
-    candidate_df = pd.DataFrame(prompt_candidates) if prompt_candidates else region_df.head(prompt_limit)
 
+def _local_bypass_suggestions(
+    user_description: str,
+    index: NunIndex,
+    positions: list[int],
+    local_candidates: list[Procedure],
+    region_confidence: float,
+) -> list[dict[str, Any]] | None:
+    """Local suggestions when the shortlist has a decisive winner, otherwise None.
+
+    The winner must contain the whole query as a phrase in its description,
+    lead the runner-up by ``DEFAULT_BYPASS_MIN_MARGIN`` of its heuristic score
+    and sit in a region detected with ``DEFAULT_BYPASS_MIN_REGION_CONFIDENCE``.
+    """
+    if len(local_candidates) < 2 or region_confidence < DEFAULT_BYPASS_MIN_REGION_CONFIDENCE:
+        return None
+    query = index.correct_query(user_description) if DEFAULT_FUZZY_MATCHING else user_description
+    prepared = _prepare_query(query)
+    # A single term ("rodilla") is contained in too many descriptions to be decisive.
+    if len(prepared.terms) < 2:
+        return None
+
+    position_by_code = {index.rows[position].code: position for position in positions}
+    shortlist = [position_by_code[str(record.get("Código", ""))] for record in local_candidates[:MAX_SUGGESTIONS]]
+    top = index.rows[shortlist[0]]
+    if prepared.normalized not in top.description:
+        return None
+    region = top.region
+    scores = [_score_indexed(prepared, index.rows[position], region=region) for position in shortlist]
+    margin = (scores[0] - scores[1]) / scores[0] if scores[0] > 0 else 0.0
+    if margin < DEFAULT_BYPASS_MIN_MARGIN:
+        return None
+
+    confidence = min(0.95, 0.5 + 0.25 * margin + 0.2 * region_confidence)
+    suggestions = [{"codigo": top.code.strip(), "confianza": round(confidence, 2), "motivo": LOCAL_BYPASS_REASON}]
+    for position, score in zip(shortlist[1:], scores[1:]):
+        if score > 0:
+            suggestions.append(
+                {"codigo": index.rows[position].code.strip(), "confianza": round(confidence * score / scores[0], 2), "motivo": LOCAL_ALTERNATIVE_REASON}
+            )
+    logger.info("local_bypass code=%s margin=%.2f region_confidence=%.2f", suggestions[0]["codigo"], margin, region_confidence)
+    return suggestions
+
+
+def _audit_local_bypass(
+    rank_codes: Callable[..., list[dict[str, Any]]],
+    client: OpenAI | AsyncOpenAI,
+    user_description: str,
+    prompt_candidates: list[Procedure],
+    local_code: str,
+    model: str,
+) -> None:
     try:
-        raw_suggestions = rank_codes_with_openai(client, user_description, candidate_df, model=model)
+        raw_suggestions = rank_codes(client, user_description, prompt_candidates, model=model)
+    except Exception as exc:
+        _local_bypass_monitor.record_audit_failure(exc)
+        return
+    _local_bypass_monitor.record_audit(local_code, raw_suggestions)
+
+
+def _finalize_search(
+    region: str,
+    confidence: float,
+    reason: str,
+    raw_suggestions: Any,
+    local_candidates: list[Procedure],
+    prompt_candidates: list[Procedure],
+    procedures_data: ProcedureData,
+    used_fallback: bool,
+    path: str,
+    *,
+    prompt_count: int | None = None,
+    prompt_reason: str = "",
+) -> SearchResult:
+    """Validated suggestions as a result, or local fallback suggestions from ``prompt_candidates``.
+
+    ``prompt_count`` is how many candidates the ranking prompt listed, None
+    when no ranking request was built.
+    """
+    prompt = {"prompt_count": prompt_count, "prompt_reason": prompt_reason if prompt_count is not None else ""}
+    with _trace_span("validation") as span:
+        validated = validate_suggested_codes(raw_suggestions, procedures_data)
+        span.attributes["valid"] = len(validated)
+    if validated:
+        return SearchResult(region, confidence, reason, validated, local_candidates, used_fallback, path=path, **prompt)
+
+    # Fallback: use deterministic candidates when the model output is empty or malformed.
+    fallback_results: list[dict[str, Any]] = []
+    with _trace_span("fallback", candidates=len(prompt_candidates[:5])):
+        for row in prompt_candidates[:5]:
+            fallback_results.append(
+                {
+                    "codigo": str(row.get("Código", "")),
+                    "confianza": 0.5,
+                    "motivo": "Sugerencia de respaldo basada en coincidencia local determinística.",
+                }
+            )
+    return SearchResult(region, confidence, reason, fallback_results, local_candidates, True, path=path, **prompt)
+
+
+def _speculative_suggestions(raw_suggestions: Any, region: str, procedures_data: ProcedureData) -> list[dict[str, Any]] | None:
+    """Keep a speculative cross-region ranking only when its best code lies in the inferred region."""
+    validated = validate_suggested_codes(raw_suggestions, procedures_data)
+    if not validated:
+        return None
+    index, positions = get_nun_index(procedures_data)
+    code_regions: dict[str, str] = {}
+    for position in positions:
+        code_regions.setdefault(index.rows[position].code.strip(), index.rows[position].region)
+    if code_regions.get(validated[0]["codigo"]) != region.upper():
+        return None
+    return [item for item in validated if code_regions.get(item["codigo"]) == region.upper()]
+
+
+def _infer_region_or_fallback(
+    infer_region: Callable[..., tuple[str, float, str]],
+    client: OpenAI | AsyncOpenAI,
+    user_description: str,
+    model: str,
+    budget: SearchBudget | None = None,
+) -> tuple[str, float, str, bool]:
+    with _trace_span("region.openai") as span:
+        try:
+            region, confidence, reason = infer_region(client, user_description, model=model, budget=budget)
+        except OpenAIUnavailable as exc:
+            span.error = type(exc).__name__
+            logger.warning("OpenAI region inference not sent; using deterministic fallback: %s", exc)
+            return "", 0.0, exc.reason, True
+        except Exception as exc:
+            span.error = type(exc).__name__
+            logger.warning("OpenAI region inference failed; using deterministic fallback: %s", exc)
+            return "", 0.0, REGION_FALLBACK_REASON, True
+        span.attributes.update(region=region, confidence=round(confidence, 3))
+    return region, confidence, reason, False
+
+
+def _rank_in_region(
+    client: OpenAI | AsyncOpenAI,
+    user_description: str,
+    procedures_data: ProcedureData,
+    region: str,
+    confidence: float,
+    reason: str,
+    *,
+    model: str,
+    top_candidates: int,
+    scoring: str,
+    used_fallback: bool,
+    path: str,
+    rank_codes: Callable[..., list[dict[str, Any]]],
+    on_suggestion: Callable[[dict[str, Any]], None] | None = None,
+    budget: SearchBudget | None = None,
+    local_bypass: bool = False,
+) -> SearchResult:
+    index, positions = _region_candidates(procedures_data, region)
+    if not positions:
+        return SearchResult(region, confidence, reason, [], [], True, path=path)
+
+    local_candidates, prompt_candidates, prompt_reason = _local_shortlist(
+        user_description, index, positions, region, top_candidates, scoring
+    )
+    if local_bypass:
+        with _trace_span("local_bypass") as span:
+            bypass = _local_bypass_suggestions(user_description, index, positions, local_candidates, confidence)
+            span.attributes["bypassed"] = bypass is not None
+        if _local_bypass_monitor.record(bypass is not None):
+            _local_bypass_monitor.start_audit(
+                _audit_local_bypass, rank_codes, client, user_description, prompt_candidates, bypass[0]["codigo"], model
+            )
+        if bypass:
+            return SearchResult(region, confidence, reason, bypass, local_candidates, used_fallback, path="local_bypass")
+    if reason in OPENAI_UNAVAILABLE_REASONS:
+        # The region request was just refused; queueing the ranking would only wait or fail again.
+        return _finalize_search(region, confidence, reason, [], local_candidates, prompt_candidates, procedures_data, True, path)
+    messages, listed = _search_prompt(user_description, prompt_candidates)
+    # The token budget may have cut the shortlist; record and fall back on what the model saw.
+    prompt_candidates = prompt_candidates[:listed]
+    ranking = {"model": model, "budget": budget, "messages": messages}
+    if on_suggestion is not None:
+        ranking["on_suggestion"] = suggestion_stream_validator(procedures_data, on_suggestion)
+    try:
+        raw_suggestions = rank_codes(client, user_description, prompt_candidates, **ranking)
     except Exception as exc:  # pragma: no cover - integration/runtime path
         logger.warning("OpenAI ranking failed; using deterministic fallback: %s", exc)
         raw_suggestions = []
         used_fallback = True
 
-    validated = validate_suggested_codes(raw_suggestions, procedures_data)
-    if validated:
-        return region, confidence, reason, validated, local_candidates, used_fallback
+    return _finalize_search(
+        region, confidence, reason, raw_suggestions, local_candidates, prompt_candidates, procedures_data, used_fallback, path,
+        prompt_count=listed, prompt_reason=prompt_reason,
+    )
 
-    # Fallback: use deterministic candidates when the model output is empty or malformed.
-    fallback_candidates = candidate_df.head(5).to_dict(orient="records")
-    fallback_results: list[dict[str, Any]] = []
-    for row in fallback_candidates[:5]:
-        fallback_results.append(
+
+def _uncached_search(
+    client: OpenAI | AsyncOpenAI,
+    user_description: str,
+    procedures_data: ProcedureData,
+    *,
+    model: str,
+    top_candidates: int,
+    scoring: str,
+    speculative: bool,
+    infer_region: Callable[..., tuple[str, float, str]],
+    rank_codes: Callable[..., list[dict[str, Any]]],
+    on_suggestion: Callable[[dict[str, Any]], None] | None = None,
+    budget: SearchBudget | None = None,
+    local_bypass: bool = False,
+) -> SearchResult:
+    options = {
+        "model": model,
+        "top_candidates": top_candidates,
+        "scoring": scoring,
+        "rank_codes": rank_codes,
+        "on_suggestion": on_suggestion,
+        "budget": budget,
+        "local_bypass": local_bypass,
+    }
+    with _trace_span("region.local") as span:
+        region, confidence, reason = determine_region_locally(user_description)
+        span.attributes.update(region=region, confidence=round(confidence, 3))
+    if region:
+        return _rank_in_region(
+            client, user_description, procedures_data, region, confidence, reason, used_fallback=False, path="local_region", **options
+        )
+    if not speculative:
+        region, confidence, reason, used_fallback = _infer_region_or_fallback(infer_region, client, user_description, model, budget)
+        return _rank_in_region(
+            client, user_description, procedures_data, region, confidence, reason, used_fallback=used_fallback, path="sequential", **options
+        )
+
+    # Speculative: rank the best cross-region candidates while the region is inferred.
+    index, positions = _region_candidates(procedures_data, "")
+    if not positions:
+        return SearchResult("", 0.0, "", [], [], True, path="speculative")
+    cross_candidates, cross_prompt, cross_reason = _local_shortlist(user_description, index, positions, "", top_candidates, scoring)
+    messages, listed = _search_prompt(user_description, cross_prompt)
+    cross_prompt = cross_prompt[:listed]
+    # The copied context parents the speculative ranking's spans under this search.
+    ranking = _background_executor().submit(
+        contextvars.copy_context().run,
+        rank_codes, client, user_description, cross_prompt, model=model, budget=budget, messages=messages,
+    )
+    region, confidence, reason, used_fallback = _infer_region_or_fallback(infer_region, client, user_description, model, budget)
+    try:
+        raw_suggestions: Any = ranking.result()
+    except Exception as exc:
+        logger.warning("Speculative OpenAI ranking failed: %s", exc)
+        raw_suggestions = None
+
+    reconciled = _reconcile_speculative(
+        user_description, procedures_data, region, confidence, reason, used_fallback, raw_suggestions,
+        cross_candidates, cross_prompt, cross_reason, options,
+    )
+    if reconciled is not None:
+        return reconciled
+    return _rank_in_region(
+        client, user_description, procedures_data, region, confidence, reason,
+        used_fallback=used_fallback, path="speculative_reissued", **options,
+    )
+
+
+def _reconcile_speculative(
+    user_description: str,
+    procedures_data: ProcedureData,
+    region: str,
+    confidence: float,
+    reason: str,
+    used_fallback: bool,
+    raw_suggestions: Any,
+    cross_candidates: list[Procedure],
+    cross_prompt: list[Procedure],
+    cross_reason: str,
+    options: dict[str, Any],
+) -> SearchResult | None:
+    """Turn a speculative ranking into a result, or return None when it must be re-issued inside ``region``."""
+    if not region:
+        # Without a region the sequential path would rank these same cross-region candidates.
+        return _finalize_search(
+            region, confidence, reason, raw_suggestions or [], cross_candidates, cross_prompt, procedures_data,
+            used_fallback or raw_suggestions is None, "speculative", prompt_count=len(cross_prompt), prompt_reason=cross_reason,
+        )
+
+    accepted = _speculative_suggestions(raw_suggestions, region, procedures_data)
+    if accepted is None:
+        return None
+    index, positions = _region_candidates(procedures_data, region)
+    local_candidates, prompt_candidates, _ = _local_shortlist(
+        user_description, index, positions, region, options["top_candidates"], options["scoring"]
+    )
+    # The kept ranking came from the cross-region prompt, so that is the prompt recorded.
+    return _finalize_search(
+        region, confidence, reason, accepted, local_candidates, prompt_candidates, procedures_data, used_fallback, "speculative",
+        prompt_count=len(cross_prompt), prompt_reason=cross_reason,
+    )
+
+
+BATCH_DESCRIPTION_COLUMNS = ("descripcion", "descripción", "description", "Descripción", "Descripcion")
+
+
+# ``estado`` of each batch output line. Only final rows are skipped on resume;
+# fallback, partial and failed rows are searched again.
+BATCH_FINAL_STATUSES = frozenset({"ok", "invalida"})
+
+
+def read_batch_input(path: str | Path, *, column: str | None = None, id_column: str = "id") -> Iterator[tuple[str, str]]:
+    """Yield ``(id, description)`` pairs from a CSV or JSONL file as it is read; rows without an id use their line number.
+
+    Raises ``ValueError`` when the CSV header, or a JSONL record, has no
+    description column: such rows are a wrong ``column``, not empty
+    descriptions to be recorded as ``invalida``.
+    """
+    path = Path(path)
+    columns = (column,) if column else BATCH_DESCRIPTION_COLUMNS
+    missing = f"{path.name} no tiene la columna de descripción {' / '.join(columns)}"
+    with path.open(newline="", encoding="utf-8") as fh:
+        if path.suffix.lower() in {".jsonl", ".ndjson"}:
+            records: Iterable[Any] = (json.loads(line) for line in fh if line.strip())
+        else:
+            records = reader = csv.DictReader(fh)
+            if not set(columns) & set(reader.fieldnames or ()):
+                raise ValueError(missing)
+        for number, record in enumerate(records, 1):
+            if not isinstance(record, dict):
+                continue
+            if not any(name in record for name in columns):
+                raise ValueError(f"{missing} (registro {number})")
+            description = next((str(record[name]) for name in columns if record.get(name) not in (None, "")), "")
+            item_id = record.get(id_column)
+            yield (str(item_id) if item_id not in (None, "") else str(number), description)
+
+
+def _batch_status(record: Mapping[str, Any]) -> str:
+    if "estado" in record:
+        return str(record["estado"])
+    # Lines written before ``estado`` existed.
+    if "error" in record:
+        return "error"
+    return "fallback" if record.get("fallback") else "ok"
+
+
+def _read_batch_checkpoint(output_path: Path) -> dict[str, str]:
+    """Status of the last line written for each id; a re-run item appends a newer line."""
+    statuses: dict[str, str] = {}
+    if not output_path.exists():
+        return statuses
+    with output_path.open(encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+                statuses[str(record["id"])] = _batch_status(record)
+            except (KeyError, TypeError, ValueError):
+                # A truncated last line from an interrupted run is simply redone.
+                continue
+    return statuses
+
+
+def procedure_records_by_code(procedures_data: ProcedureData) -> Mapping[str, Procedure]:
+    """Map each code to its catalogue row; the first row wins for duplicated codes.
+
+    For a whole loaded catalogue this is the lookup prebuilt in its index, so
+    no table scan happens; row selections get a lookup restricted to their rows.
+    """
+    index, positions = get_nun_index(procedures_data)
+    if positions == list(range(len(index))):
+        return index.records_by_code
+    records_by_code: dict[str, Procedure] = {}
+    for position in positions:
+        records_by_code.setdefault(index.rows[position].code.strip(), index.rows[position].record)
+    return records_by_code
+
+
+def search_result_payload(result: SearchResult, records_by_code: Mapping[str, Mapping[str, Any]]) -> dict[str, Any]:
+    """JSON-ready view of a search result with the fees of every suggested code."""
+    codes: list[dict[str, Any]] = []
+    for suggestion in result.suggestions:
+        row = records_by_code.get(suggestion["codigo"], {})
+        codes.append(
             {
-                "codigo": str(row.get("Código", "")),
-                "confianza": 0.5,
-                "motivo": "Sugerencia de respaldo basada en coincidencia local determinística.",
+                **suggestion,
+                "descripcion": row.get("Descripción", ""),
+                "cirujano": row.get("Cirujano", 0),
+                "ayudantes": row.get("Ayudantes", 0),
+                "total": row.get("Total", 0),
             }
         )
-    return region, confidence, reason, fallback_results, local_candidates, True
+    return {
+        "region": result.region,
+        "confianza_region": result.confidence,
+        "motivo_region": result.reason,
+        "codigos": codes,
+        "fallback": result.used_fallback,
+        "path": result.path,
+        "cached": result.cached,
+        "similitud": result.similarity,
+        "parcial": result.partial,
+    }
+
+
+def run_batch(
+    items: Iterable[tuple[str, str]],
+    output_path: str | Path,
+    *,
+    client: OpenAI,
+    procedures_data: ProcedureData,
+    concurrency: int = DEFAULT_BATCH_CONCURRENCY,
+    cache: SearchResultCache | None = None,
+    progress: TextIO | None = None,
+    **search_options: Any,
+) -> dict[str, int]:
+    """Code ``items`` with ``search_nun_codes`` and append one JSON line per item to ``output_path``.
+
+    ``items`` is consumed lazily, so inputs larger than memory stream through.
+    Every line records its ``estado`` (``ok``, ``fallback``, ``parcial``,
+    ``error`` or ``invalida``). Items whose last line in the output is final
+    (``ok`` or ``invalida``) are skipped, so an interrupted run resumes where it
+    stopped and a re-run retries the fallback, partial and failed rows. At
+    most ``concurrency`` searches run at once.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    checkpoint = _read_batch_checkpoint(output_path)
+
+    records_by_code = procedure_records_by_code(procedures_data)
+    summary = {"total": 0, "skipped": 0, "retried": 0, "completed": 0, "fallback": 0, "invalid": 0, "errors": 0}
+    started = time.perf_counter()
+
+    def pending_items() -> Iterator[tuple[str, str]]:
+        for item_id, description in items:
+            summary["total"] += 1
+            status = checkpoint.get(item_id)
+            if status in BATCH_FINAL_STATUSES:
+                summary["skipped"] += 1
+                continue
+            summary["retried"] += int(status is not None)
+            yield item_id, description
+
+    def run_one(item_id: str, description: str) -> dict[str, Any]:
+        is_valid, message = validate_search_query(description)
+        if not is_valid:
+            return {"id": item_id, "descripcion": description, "codigos": [], "estado": "invalida", "error": message}
+        try:
+            result = search_nun_codes(client, description, procedures_data, cache=cache, **search_options)
+        except Exception as exc:
+            logger.exception("batch_item_failed id=%s", item_id)
+            return {"id": item_id, "descripcion": description, "codigos": [], "estado": "error", "error": str(exc)}
+        status = "fallback" if result.used_fallback else "parcial" if result.partial else "ok"
+        return {"id": item_id, "descripcion": description, "estado": status, **search_result_payload(result, records_by_code)}
+
+    with output_path.open("a", encoding="utf-8") as out, ThreadPoolExecutor(
+        max_workers=max(1, concurrency), thread_name_prefix="nunbot-batch"
+    ) as pool:
+        queue = pending_items()
+        in_flight: set[Future[dict[str, Any]]] = set()
+        while True:
+            # Keep a bounded window of submitted work so huge inputs are streamed.
+            while len(in_flight) < max(1, concurrency) * 2:
+                item = next(queue, None)
+                if item is None:
+                    break
+                in_flight.add(pool.submit(run_one, *item))
+            if not in_flight:
+                break
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                record = future.result()
+                out.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                summary["completed"] += 1
+                summary["fallback"] += int(bool(record.get("fallback")))
+                summary["invalid"] += int(record["estado"] == "invalida")
+                summary["errors"] += int(record["estado"] == "error")
+            out.flush()
+            if progress is not None:
+                elapsed = time.perf_counter() - started
+                progress.write(
+                    f"\r[nunbot batch] {summary['completed'] + summary['skipped']} procesadas "
+                    f"fallback={summary['fallback']} errores={summary['errors']} "
+                    f"{summary['completed'] / elapsed if elapsed else 0.0:.1f}/s"
+                )
+                progress.flush()
+
+    if progress is not None:
+        progress.write("\n")
+    return summary
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m nunbot_core", description="Herramientas de línea de comandos de NUNBot.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    batch = subcommands.add_parser("batch", help="Codificar un CSV/JSONL de descripciones quirúrgicas.")
+    batch.add_argument("input", help="Archivo CSV o JSONL con las descripciones.")
+    batch.add_argument("output", help="Archivo JSONL de salida; si existe, se retoma desde donde quedó.")
+    batch.add_argument("--column", help="Columna con la descripción (por defecto: descripcion/description).")
+    batch.add_argument("--id-column", default="id", help="Columna con el identificador de cada fila.")
+    batch.add_argument("--concurrency", type=int, default=DEFAULT_BATCH_CONCURRENCY, help="Búsquedas simultáneas.")
+    batch.add_argument("--data", help="Ruta alternativa a nun_procedimientos.csv.")
+    batch.add_argument("--model", default=DEFAULT_MODEL)
+    batch.add_argument("--no-cache", action="store_true", help="No usar la caché persistente de resultados.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    issues = check_runtime_health(args.data)
+    if issues:
+        for issue in issues:
+            print(issue, file=sys.stderr)
+        return 1
+
+    from openai import OpenAI
+
+    items = read_batch_input(args.input, column=args.column, id_column=args.id_column)
+    try:
+        summary = run_batch(
+            items,
+            args.output,
+            client=OpenAI(),
+            procedures_data=load_procedures(args.data),
+            concurrency=args.concurrency,
+            cache=None if args.no_cache else get_search_cache(),
+            progress=sys.stderr,
+            model=args.model,
+        )
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    print(json.dumps(summary), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,136 @@
+"""Shared fixtures for the NUNBot test suites."""
+
+import json
+import threading
+from types import SimpleNamespace
+from unittest.mock import patch
+
+HIP_FRACTURE_ROW = {
+    "Código": "PC.10.01",
+    "Descripción": "Reducción cerrada de fractura de cadera",
+    "Región": "PC",
+    "Palabras clave": "cadera, fractura, reducción",
+    "Cirujano": 100,
+    "Ayudantes": 50,
+    "Total": 150,
+}
+HIP_OSTEOSYNTHESIS_ROW = {
+    "Código": "PC.10.02",
+    "Descripción": "Osteosíntesis de fractura de cadera",
+    "Región": "PC",
+    "Palabras clave": "cadera, fractura, osteosíntesis",
+    "Cirujano": 150,
+    "Ayudantes": 75,
+    "Total": 225,
+}
+WRIST_FRACTURE_ROW = {
+    "Código": "MS.10.01",
+    "Descripción": "Reducción de fractura de muñeca",
+    "Región": "MS",
+    "Palabras clave": "muñeca, fractura, reducción",
+    "Cirujano": 90,
+    "Ayudantes": 45,
+    "Total": 135,
+}
+HIP_FRACTURE_SUGGESTION = {"codigo": "PC.10.01", "confianza": 0.9, "motivo": "Coincidencia exacta"}
+
+
+def hip_fracture_catalogue(*extra_rows):
+    """Catalogue DataFrame with the PC.10.01 hip fracture row followed by ``extra_rows``."""
+    import pandas as pd
+
+    return pd.DataFrame([HIP_FRACTURE_ROW, *extra_rows])
+
+
+def chat_completion(content, **fields):
+    """Non-streamed SDK response; ``content`` is JSON-encoded unless it is already text."""
+    text = content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], **fields)
+
+
+def stream_chunk(piece):
+    """One chunk of a streamed SDK response."""
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+
+
+def prompt_of(request):
+    """Text of the last message of a ``chat.completions.create`` request."""
+    return request["messages"][-1]["content"]
+
+
+def is_ranking_prompt(request):
+    return "codigos_sugeridos" in prompt_of(request)
+
+
+class FakeOpenAIClient:
+    """Stand-in for ``OpenAI`` that answers region and ranking prompts with canned JSON.
+
+    Ranking prompts get ``suggestions``, or the first three listed codes when it
+    is omitted; region prompts get ``region``. Streamed calls split the content
+    into ``chunk_size`` pieces. Tests that need other answers override
+    ``respond`` or ``create``.
+    """
+
+    def __init__(self, suggestions=None, *, region="PC", chunk_size=4):
+        self.suggestions = suggestions
+        self.region = region
+        self.chunk_size = chunk_size
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def with_options(self, **kwargs):
+        return self
+
+    def respond(self, request):
+        """JSON payload answering ``request``."""
+        if not is_ranking_prompt(request):
+            return {"region": self.region, "confianza": 0.9, "motivo": "cadera"}
+        suggestions = self.suggestions
+        if suggestions is None:
+            codes = [line.split(" | ", 1)[0] for line in prompt_of(request).splitlines() if " | " in line][:3]
+            suggestions = [{"codigo": code, "confianza": 0.8, "motivo": "coincidencia"} for code in codes]
+        return {"codigos_sugeridos": suggestions}
+
+    def create(self, **kwargs):
+        with self._lock:
+            self.calls += 1
+        content = json.dumps(self.respond(kwargs), ensure_ascii=False)
+        if kwargs.get("stream"):
+            return (stream_chunk(content[start : start + self.chunk_size]) for start in range(0, len(content), self.chunk_size))
+        return chat_completion(content)
+
+
+class FakeClock:
+    """Monotonic clock that only moves when a test advances it."""
+
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def isolate_process_state(test_case):
+    """Give ``test_case`` fresh process-wide singletons, restored when it finishes.
+
+    Searches share a single-flight table, the OpenAI rate limiter and circuit
+    breaker, the local bypass monitor and the prompt token meter; without a
+    reset, one test's failures or load leak into the next.
+    """
+    import nunbot_core
+
+    fresh = {
+        "_search_single_flight": nunbot_core.SingleFlight(),
+        "_openai_rate_limiter": nunbot_core.OpenAIRateLimiter(),
+        "_openai_circuit_breaker": nunbot_core.CircuitBreaker(),
+        "_local_bypass_monitor": nunbot_core.LocalBypassMonitor(),
+        "_prompt_token_meter": nunbot_core.PromptTokenMeter(),
+    }
+    for name, value in fresh.items():
+        patcher = patch.object(nunbot_core, name, value)
+        patcher.start()
+        test_case.addCleanup(patcher.stop)
@@ -0,0 +1,104 @@
+import http.client
+import json
+import threading
+import unittest
+
+
+class TestNunbotApi(unittest.TestCase):
+    def setUp(self):
+        from helpers import HIP_FRACTURE_SUGGESTION, FakeOpenAIClient, hip_fracture_catalogue, isolate_process_state
+        from nunbot_api import create_server
+
+        isolate_process_state(self)
+
+        self.client = FakeOpenAIClient([HIP_FRACTURE_SUGGESTION])
+        self.server = create_server("127.0.0.1", 0, client=self.client, procedures_data=hip_fracture_catalogue())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.connection = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=5)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _request(self, method, path, payload=None):
+        body = json.dumps(payload) if payload is not None else None
+        self.connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_search_returns_codes_with_fees_over_a_kept_alive_connection(self):
+        status, payload = self._request("POST", "/search", {"descripcion": "fractura de cadera con reducción"})
+        self.assertEqual(status, 200)
+        self.assertEqual(payload["region"], "PC")
+        self.assertEqual(payload["codigos"][0]["codigo"], "PC.10.01")
+        self.assertEqual(payload["codigos"][0]["total"], 150)
+        self.assertFalse(payload["fallback"])
+
+        status, payload = self._request("GET", "/codes/PC.10.01")
+        self.assertEqual(status, 200)
+        self.assertEqual(payload["Descripción"], "Reducción cerrada de fractura de cadera")
+        self.assertEqual(self.client.calls, 1)
+
+    def test_validation_errors_and_unknown_codes(self):
+        status, payload = self._request("POST", "/validate", {"descripcion": "abc"})
+        self.assertEqual(status, 200)
+        self.assertFalse(payload["valido"])
+
+        status, payload = self._request("POST", "/search", {"descripcion": "abc"})
+        self.assertEqual(status, 422)
+        self.assertIn("más específica", payload["error"])
+
+        status, _ = self._request("GET", "/codes/NO.EXISTE")
+        self.assertEqual(status, 404)
+        self.assertEqual(self.client.calls, 0)
+
+    def test_metrics_report_single_flight_and_rate_limiter_counters(self):
+        status, payload = self._request("GET", "/metrics")
+        self.assertEqual(status, 200)
+        self.assertEqual(set(payload["single_flight"]), {"leaders", "coalesced", "in_flight"})
+        self.assertIn("queue_depth", payload["openai"])
+        self.assertIn("wait_seconds_max", payload["openai"])
+        self.assertIn(payload["circuit"]["state"], {"closed", "open", "half_open"})
+        self.assertIn("bypass_rate", payload["bypass"])
+        self.assertIn("cached_prompt_tokens", payload["prompt_tokens"])
+
+    def test_unread_bodies_close_the_kept_alive_connection(self):
+        self.connection.putrequest("POST", "/nope")
+        self.connection.putheader("Content-Length", "abc")
+        self.connection.endheaders()
+        response = self.connection.getresponse()
+        response.read()
+        self.assertEqual(response.status, 404)
+        self.assertEqual(response.getheader("Connection"), "close")
+
+        self.connection.close()
+        status, _ = self._request("POST", "/nope", {"descripcion": "fractura de cadera"})
+        self.assertEqual(status, 404)
+        status, payload = self._request("GET", "/metrics")
+        self.assertEqual(status, 200)
+
+    def test_codes_endpoint_returns_every_row_of_a_duplicated_code(self):
+        from nunbot_api import create_server
+        from nunbot_core import load_procedures
+
+        server = create_server("127.0.0.1", 0, client=self.client, procedures_data=load_procedures())
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+        try:
+            connection.request("GET", "/codes/RO.08.02")
+            response = connection.getresponse()
+            payload = json.loads(response.read())
+        finally:
+            connection.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(payload["Código"], "RO.08.02")
+        self.assertEqual(len(payload["alternativas"]), 1)
+        self.assertNotEqual(payload["alternativas"][0]["Descripción"], payload["Descripción"])
+
+        status, payload = self._request("GET", "/codes/PC.10.01")
+        self.assertEqual(payload["alternativas"], [])
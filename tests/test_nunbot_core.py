@@ -6,6 +6,11 @@ import pandas as pd
 
 
 class TestNunbotCore(unittest.TestCase):
+    def setUp(self):
+        from helpers import isolate_process_state
+
+        isolate_process_state(self)
+
     def test_normalize_search_query_strips_accents_and_punctuation(self):
         from nunbot_core import normalize_search_query
 
@@ -28,6 +33,36 @@ class TestNunbotCore(unittest.TestCase):
         self.assertFalse(ok)
         self.assertIn("demasiado larga", message)
 
+    def test_import_defers_heavy_dependencies(self):
+        import os
+        import subprocess
+        import sys
+
+        script = (
+            "import sys, nunbot_core; "
+            "nunbot_core.validate_search_query('fractura de cadera'); "
+            "nunbot_core.check_runtime_health(require_openai_key=False); "
+            "print(','.join(m for m in ('pandas', 'numpy', 'scipy', 'openai', 'asyncio') if m in sys.modules))"
+        )
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", script],
+            cwd=Path(__file__).resolve().parents[1],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        self.assertEqual(completed.stdout.strip(), "")
+
+        # The import takes ~30ms; the default budget leaves room for slow CI machines
+        # but still fails if a heavy dependency is imported at module level again.
+        budget_ms = int(os.getenv("NUNBOT_IMPORT_BUDGET_MS", "500"))
+        cumulative_us = {
+            parts[2].strip(): int(parts[1])
+            for parts in (line.split("|") for line in completed.stderr.splitlines() if line.startswith("import time:"))
+            if parts[1].strip().isdigit()
+        }
+        self.assertLess(cumulative_us["nunbot_core"] / 1000, budget_ms)
+
     def test_rank_local_candidates_prefers_exact_keyword_match(self):
         from nunbot_core import rank_local_candidates
 
@@ -51,6 +86,210 @@ class TestNunbotCore(unittest.TestCase):
         ranked = rank_local_candidates("fractura de cadera", df, region="PC", limit=2)
         self.assertEqual(ranked[0]["Código"], "PC.01.01")
 
+    def test_nun_index_scores_match_row_scoring(self):
+        from nunbot_core import get_nun_index, load_nun_data, score_procedure_row
+
+        df = load_nun_data()
+        region_df = df[df["Región"] == "PC"]
+        index, positions = get_nun_index(region_df)
+
+        self.assertIs(index, df.attrs["nun_index"])
+        self.assertEqual(len(positions), len(region_df))
+        for position, (_, row) in list(zip(positions, region_df.iterrows()))[:40]:
+            self.assertEqual(
+                index.score("fractura de cadera con osteosíntesis", position, region="PC"),
+                score_procedure_row("fractura de cadera con osteosíntesis", row, region="PC"),
+            )
+
+    def test_rank_local_candidates_uses_prebuilt_index_for_loaded_data(self):
+        from unittest.mock import patch
+
+        from nunbot_core import load_nun_data, rank_local_candidates
+
+        df = load_nun_data()
+        with patch("nunbot_core.NunIndex.from_dataframe", side_effect=AssertionError("index rebuilt")):
+            ranked = rank_local_candidates("artroscopia de rodilla", df, region="RO", limit=5)
+
+        self.assertEqual(len(ranked), 5)
+        self.assertTrue(all(row["Región"] == "RO" for row in ranked))
+
+    def test_edited_frame_does_not_reuse_the_stale_index(self):
+        from nunbot_core import get_nun_index, load_nun_data, rank_local_candidates
+
+        loaded = load_nun_data()
+        df = loaded.copy()
+        # Copies, selections and edits keep the loaded frame's index in ``attrs``.
+        self.assertIs(df.attrs["nun_index"], loaded.attrs["nun_index"])
+        df.loc[0, "Descripción"] = "Procedimiento zzyzx de prueba"
+
+        index, positions = get_nun_index(df)
+        self.assertIsNot(index, loaded.attrs["nun_index"])
+        self.assertEqual(index.rows[positions[0]].record["Descripción"], "Procedimiento zzyzx de prueba")
+        self.assertEqual(rank_local_candidates("zzyzx", df, limit=1)[0]["Código"], df.loc[0, "Código"])
+
+        selection = df.iloc[:5]
+        self.assertEqual(get_nun_index(selection)[0].rows[0].record["Descripción"], "Procedimiento zzyzx de prueba")
+        self.assertIs(get_nun_index(loaded.iloc[:5])[0], loaded.attrs["nun_index"])
+
+    def test_load_nun_data_reuses_snapshot_until_csv_changes(self):
+        import shutil
+        import tempfile
+        from unittest.mock import patch
+
+        from nunbot_core import default_data_path, default_snapshot_path, load_nun_data, rank_local_candidates
+
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = Path(tmp) / "nun.csv"
+            shutil.copyfile(default_data_path(), csv_path)
+            first = load_nun_data(csv_path)
+            snapshot_path = default_snapshot_path(csv_path)
+            self.assertTrue(snapshot_path.exists())
+
+            self.assertTrue((snapshot_path / "meta.json").exists())
+            with (
+                patch("pandas.read_csv", side_effect=AssertionError("CSV should not be parsed")),
+                patch("nunbot_core.normalize_search_query", side_effect=AssertionError("index rebuilt from text")),
+            ):
+                second = load_nun_data(csv_path)
+            pd.testing.assert_frame_equal(first, second)
+            first_index, second_index = first.attrs["nun_index"], second.attrs["nun_index"]
+            self.assertEqual(first_index.rows, second_index.rows)
+            self.assertEqual(
+                [row.record.prompt_line for row in first_index.rows],
+                [row.record.prompt_line for row in second_index.rows],
+            )
+            self.assertEqual(
+                rank_local_candidates("fractura de cadera", first, limit=5),
+                rank_local_candidates("fractura de cadera", second, limit=5),
+            )
+
+            with csv_path.open("a", encoding="utf-8") as fh:
+                fh.write("ZZ.99.99,Procedimiento de prueba,ZZ,1,prueba,$1.00,$0.00,$1.00\n")
+            self.assertIn("ZZ.99.99", set(load_nun_data(csv_path)["Código"]))
+
+            (snapshot_path / "column_0.npy").write_bytes(b"not a snapshot")
+            self.assertEqual(len(load_nun_data(csv_path)), len(first) + 1)
+
+            # Object (pickled) arrays are never loaded from a snapshot.
+            import numpy as np
+
+            np.save(snapshot_path / "column_0.npy", np.array([object()] * (len(first) + 1), dtype=object), allow_pickle=True)
+            with self.assertLogs("nunbot_core", level="WARNING"):
+                self.assertEqual(len(load_nun_data(csv_path)), len(first) + 1)
+
+    def test_procedure_catalog_matches_dataframe_search_path(self):
+        from nunbot_core import Region, dataset_fingerprint, load_nun_data, load_procedures, rank_local_candidates
+
+        df = load_nun_data(use_snapshot=False)
+        catalog = load_procedures()
+        self.assertEqual(len(catalog), len(df))
+        self.assertEqual(dataset_fingerprint(catalog), dataset_fingerprint(df))
+
+        row = catalog[0]
+        self.assertEqual(row.to_dict(), df.iloc[0].to_dict())
+        self.assertIs(row.region, Region.MS)
+        self.assertEqual(row.get("Total"), row["Total"])
+        self.assertNotIn("Inexistente", row)
+        self.assertEqual(catalog[1:3], [catalog[1], catalog[2]])
+        self.assertIs(catalog[-1], catalog[len(catalog) - 1])
+        self.assertEqual(catalog[:-1], list(catalog)[:-1])
+
+        for query, region in (("fractura de cadera", "PC"), ("artroscopia de rodilla", None)):
+            self.assertEqual(
+                rank_local_candidates(query, catalog, region=region, limit=8),
+                rank_local_candidates(query, df, region=region, limit=8),
+            )
+
+    def test_rank_local_candidates_bm25_only_scores_rows_sharing_a_term(self):
+        from nunbot_core import rank_local_candidates
+
+        df = pd.DataFrame(
+            [
+                {"Código": "RO.01.01", "Descripción": "Artroscopia de rodilla", "Región": "RO", "Palabras clave": "artroscopia, rodilla"},
+                {"Código": "RO.01.02", "Descripción": "Meniscectomía artroscópica", "Región": "RO", "Palabras clave": "menisco, artroscopia"},
+                {"Código": "RO.01.03", "Descripción": "Amputación supracondílea", "Región": "RO", "Palabras clave": "amputación"},
+            ]
+        )
+
+        ranked = rank_local_candidates("artroscopia de rodilla", df, region="RO", scoring="bm25")
+        self.assertEqual([row["Código"] for row in ranked], ["RO.01.01", "RO.01.02"])
+
+        with self.assertRaises(ValueError):
+            rank_local_candidates("artroscopia de rodilla", df, scoring="tfidf")
+
+    def test_rank_local_candidates_batch_matches_single_query_path(self):
+        from nunbot_core import load_nun_data, rank_local_candidates, rank_local_candidates_batch
+
+        df = load_nun_data()
+        queries = [
+            "fractura de cadera con osteosíntesis",
+            "artroscopia de rodilla menisco",
+            "forage de cadera",
+            "de la",
+            "fractura fractura radio",
+            "artroscopia de rodilla menisco",
+        ]
+
+        for scoring in ("heuristic", "bm25"):
+            for region in (None, "PC"):
+                batch = rank_local_candidates_batch(queries, df, region=region, limit=8, scoring=scoring)
+                self.assertEqual(len(batch), len(queries))
+                for query, ranked in zip(queries, batch):
+                    single = rank_local_candidates(query, df, region=region, limit=8, scoring=scoring)
+                    self.assertEqual(ranked, single, (scoring, region, query))
+
+    def test_rank_local_candidates_tolerates_typos_in_single_and_batch_paths(self):
+        from nunbot_core import get_nun_index, load_nun_data, rank_local_candidates, rank_local_candidates_batch
+
+        df = load_nun_data()
+        index, _ = get_nun_index(df)
+        self.assertEqual(index.correct_term("atroscopia"), "artroscopia")
+        self.assertEqual(index.correct_term("osteosinteis"), "osteosintesis")
+        self.assertIsNone(index.correct_term("artroscopia"))
+        self.assertIsNone(index.correct_term("xyzxyzxyz"))
+
+        for typo, expected in (
+            ("atroscopia de rodilla con menisectomia", "artroscopia de rodilla con menisectomia"),
+            ("osteosinteis de fractura de femur", "osteosintesis de fractura de femur"),
+        ):
+            self.assertEqual(rank_local_candidates(typo, df, limit=5), rank_local_candidates(expected, df, limit=5))
+            self.assertNotEqual(rank_local_candidates(typo, df, limit=5, fuzzy=False), rank_local_candidates(expected, df, limit=5))
+
+        queries = ["atroscopia de rodilla", "osteosinteis de cadera", "fractura de cadera"]
+        for scoring in ("heuristic", "bm25"):
+            self.assertEqual(
+                rank_local_candidates_batch(queries, df, limit=6, scoring=scoring),
+                [rank_local_candidates(query, df, limit=6, scoring=scoring) for query in queries],
+            )
+
+    def test_detect_regions_reports_overlapping_hint_evidence(self):
+        from nunbot_core import detect_regions, determine_region_locally
+
+        matches = detect_regions("Luxación coxofemoral")
+
+        self.assertEqual(matches["PC"].hints, ("coxofemoral",))
+        self.assertEqual(matches["RO"].hints, ("femoral",))
+        self.assertEqual(determine_region_locally("Luxación coxofemoral")[0], "PC")
+        self.assertEqual(matches["PC"].score, 2)
+
+    def test_region_hint_file_extends_local_detection(self):
+        import json
+        import tempfile
+        from unittest.mock import patch
+
+        from nunbot_core import determine_region_locally
+
+        self.assertEqual(determine_region_locally("fractura de escafoides carpiano"), ("", 0.0, ""))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            hints_path = Path(tmp) / "pistas.json"
+            hints_path.write_text(json.dumps({"MS": ["escafoides", "carpiano"], "XX": ["ignorada"]}), encoding="utf-8")
+            with patch("nunbot_core.DEFAULT_REGION_HINTS_PATH", str(hints_path)):
+                region, confidence, _ = determine_region_locally("fractura de escafoides carpiano")
+
+        self.assertEqual(region, "MS")
+        self.assertEqual(confidence, 0.85)
+
     def test_validate_region_response_rejects_invalid_region(self):
         from nunbot_core import validate_region_response
 
@@ -76,6 +315,24 @@ class TestNunbotCore(unittest.TestCase):
         self.assertEqual(cleaned[0]["codigo"], "MS.01.01")
         self.assertEqual(cleaned[0]["confianza"], 1.0)
 
+    def test_code_lookup_is_shared_and_keeps_first_duplicate_row(self):
+        from nunbot_core import get_nun_index, load_nun_data, procedure_records_by_code, validate_suggested_codes
+
+        df = load_nun_data()
+        index, _ = get_nun_index(df)
+        records_by_code = procedure_records_by_code(df)
+        self.assertIs(records_by_code, index.records_by_code)
+        self.assertEqual(index.duplicate_codes, {"RO.08.02": (519, 520)})
+
+        duplicates = index.records_for_code("RO.08.02")
+        self.assertEqual([row["Descripción"] for row in duplicates], df.loc[[519, 520], "Descripción"].tolist())
+        self.assertIs(records_by_code["RO.08.02"], duplicates[0])
+        self.assertEqual(
+            [item["codigo"] for item in validate_suggested_codes([{"codigo": "RO.08.02"}, {"codigo": "RO.08.02"}], df)],
+            ["RO.08.02"],
+        )
+        self.assertNotIn("RO.08.02", procedure_records_by_code(df[df["Región"] == "PC"]))
+
     def test_check_runtime_health_reports_missing_requirements(self):
         from unittest.mock import patch
 
@@ -246,6 +503,784 @@ class TestNunbotCore(unittest.TestCase):
         self.assertFalse(used_fallback)
         self.assertGreaterEqual(len(local_candidates), 1)
 
+    def test_search_result_cache_expires_and_evicts_least_recently_used(self):
+        import itertools
+        import tempfile
+        from unittest.mock import patch
+
+        from nunbot_core import SearchResult, SearchResultCache
+
+        result = SearchResult("PC", 0.9, "motivo", [{"codigo": "PC.01.01", "confianza": 0.9, "motivo": "ok"}], [], False)
+        clock = itertools.count(1000)
+        with tempfile.TemporaryDirectory() as tmp, patch("nunbot_core.time.time", side_effect=lambda: next(clock)):
+            cache = SearchResultCache(Path(tmp) / "cache.sqlite3", ttl_seconds=50, max_entries=2)
+            cache.set("a", result)
+            cache.set("b", result)
+            self.assertEqual(cache.get("a"), result)
+            cache.set("c", result)
+
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(len(cache), 2)
+
+            for _ in range(60):
+                next(clock)
+            self.assertIsNone(cache.get("a"))
+
+    def test_search_nun_codes_reuses_results_across_cache_instances(self):
+        import tempfile
+        from unittest.mock import patch
+
+        from helpers import hip_fracture_catalogue
+        from nunbot_core import SearchResultCache, search_nun_codes
+
+        df = hip_fracture_catalogue()
+        suggestion = [{"codigo": "PC.10.01", "confianza": 0.91, "motivo": "Coincidencia exacta"}]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "cache.sqlite3"
+            with patch("nunbot_core.rank_codes_with_openai", return_value=suggestion) as openai_rank:
+                first = search_nun_codes(object(), "fractura de cadera con reducción", df, cache=SearchResultCache(path))
+                second = search_nun_codes(object(), "Fractura de cadera, con reducción", df, cache=SearchResultCache(path))
+
+        openai_rank.assert_called_once()
+        self.assertEqual(first, second)
+        self.assertFalse(first.cached)
+        self.assertTrue(second.cached)
+
+    def test_search_nun_codes_reuses_results_for_rephrased_queries(self):
+        import sqlite3
+        import tempfile
+        from unittest.mock import patch
+
+        from nunbot_core import SearchResultCache, build_search_cache_scope, search_nun_codes
+
+        df = pd.DataFrame(
+            [
+                {
+                    "Código": "MS.20.01",
+                    "Descripción": "Osteosíntesis de fractura de radio distal con placa",
+                    "Región": "MS",
+                    "Palabras clave": "fractura, osteosíntesis, placa, radio",
+                },
+            ]
+        )
+        suggestion = [{"codigo": "MS.20.01", "confianza": 0.9, "motivo": "Coincidencia"}]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SearchResultCache(Path(tmp) / "cache.sqlite3")
+            with patch("nunbot_core.rank_codes_with_openai", return_value=suggestion) as openai_rank:
+                first = search_nun_codes(object(), "fractura de radio distal con placa", df, cache=cache)
+                rephrased = search_nun_codes(object(), "placa en fractura distal de radio", df, cache=cache)
+                typo = search_nun_codes(object(), "fractura de radio distal con placa bloqueda", df, cache=cache)
+                different = search_nun_codes(object(), "fractura de cúbito distal con placa", df, cache=cache)
+                disabled = search_nun_codes(object(), "placa, fractura de radio distal", df, cache=cache, similarity_threshold=0)
+
+            self.assertEqual(openai_rank.call_count, 4)
+            self.assertFalse(first.cached)
+            self.assertTrue(rephrased.cached)
+            self.assertEqual(rephrased.similarity, 1.0)
+            self.assertEqual(rephrased.suggestions, first.suggestions)
+            self.assertFalse(typo.cached)
+            self.assertFalse(different.cached)
+            self.assertFalse(disabled.cached)
+
+            scope = build_search_cache_scope(df)
+            loose = cache.get_similar("fractura del radio distal con placa volar", scope, threshold=0.5)
+            self.assertLess(loose.similarity, 0.85)
+            self.assertIsNone(cache.get_similar("fractura de radio distal con placa", "otro-alcance", threshold=0.5))
+
+            cache.clear()
+            with sqlite3.connect(cache.path) as connection:
+                self.assertEqual(connection.execute("SELECT COUNT(*) FROM search_query_bands").fetchone()[0], 0)
+
+    def test_near_duplicate_cache_never_crosses_negation_or_laterality(self):
+        import tempfile
+
+        from nunbot_core import SearchResult, SearchResultCache, query_shingles
+
+        self.assertIn("sin", " ".join(query_shingles("fractura sin placa")))
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SearchResultCache(Path(tmp) / "cache.sqlite3")
+            for key, query, code in (
+                ("con-placa", "fractura de radio distal con placa", "MS.20.01"),
+                ("medial", "meniscectomía medial", "PP.30.01"),
+            ):
+                result = SearchResult("MS", 0.9, "", [{"codigo": code, "confianza": 0.9, "motivo": ""}], [], False)
+                cache.set(key, result, query=query, scope="alcance")
+
+            self.assertIsNone(cache.get_similar("fractura de radio distal sin placa", "alcance", threshold=0.5))
+            self.assertIsNone(cache.get_similar("meniscectomía lateral", "alcance", threshold=0.5))
+            self.assertIsNone(cache.get_similar("fractura de cúbito distal con placa", "alcance", threshold=0.5))
+            self.assertIsNone(cache.get_similar("fractura de radio proximal con placa", "alcance", threshold=0.5))
+            self.assertEqual(cache.get_similar("placa en fractura distal de radio", "alcance", threshold=0.85).similarity, 1.0)
+            self.assertIsNotNone(cache.get_similar("meniscectomia  medial.", "alcance", threshold=0.85))
+
+    def test_async_chat_json_with_retry_backs_off_without_blocking(self):
+        import asyncio
+        from unittest.mock import AsyncMock, patch
+
+        from helpers import FakeOpenAIClient, chat_completion
+        from nunbot_core import _async_chat_json_with_retry
+
+        class FlakyAsyncClient(FakeOpenAIClient):
+            async def create(self, **kwargs):
+                self.calls += 1
+                if self.calls == 1:
+                    raise RuntimeError("transient")
+                return chat_completion({"region": "PC"})
+
+        client = FlakyAsyncClient()
+
+        with patch("asyncio.sleep", new_callable=AsyncMock) as async_sleep, patch("nunbot_core.time.sleep") as blocking_sleep:
+            payload = asyncio.run(
+                _async_chat_json_with_retry(client, model="gpt-4o", messages=[], max_tokens=10, temperature=0.0)
+            )
+
+        self.assertEqual(payload, {"region": "PC"})
+        self.assertEqual(client.calls, 2)
+        async_sleep.assert_awaited_once_with(0.5)
+        blocking_sleep.assert_not_called()
+
+    def test_async_search_nun_codes_falls_back_when_openai_fails(self):
+        import asyncio
+        from unittest.mock import AsyncMock, patch
+
+        from helpers import hip_fracture_catalogue
+        from nunbot_core import async_search_nun_codes
+
+        df = hip_fracture_catalogue()
+
+        with patch("nunbot_core.determine_region_locally", return_value=("", 0.0, "")), patch(
+            "nunbot_core.async_infer_region_with_openai", new=AsyncMock(side_effect=RuntimeError("openai down"))
+        ), patch("nunbot_core.async_rank_codes_with_openai", new=AsyncMock(side_effect=RuntimeError("openai down"))):
+            region, _, reason, suggestions, local_candidates, used_fallback = asyncio.run(
+                async_search_nun_codes(object(), "fractura de cadera", df)
+            )
+
+        self.assertEqual(region, "")
+        self.assertIn("búsqueda determinística", reason)
+        self.assertTrue(used_fallback)
+        self.assertEqual(suggestions[0]["codigo"], "PC.10.01")
+        self.assertTrue(local_candidates)
+
+    def test_identical_concurrent_searches_share_one_computation(self):
+        import asyncio
+        import threading
+        import time
+        from unittest.mock import patch
+
+        from helpers import HIP_FRACTURE_SUGGESTION, hip_fracture_catalogue
+        from nunbot_core import async_search_nun_codes, get_search_single_flight, search_nun_codes
+
+        df = hip_fracture_catalogue()
+        suggestions = [HIP_FRACTURE_SUGGESTION]
+        flight = get_search_single_flight()
+        before = flight.stats()
+
+        def slow_rank(*args, **kwargs):
+            # Hold the leader until the other three sessions are waiting on it.
+            deadline = time.monotonic() + 5
+            while flight.stats()["coalesced"] - before["coalesced"] < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            return suggestions
+
+        client = object()
+        results = []
+        with patch("nunbot_core.rank_codes_with_openai", side_effect=slow_rank) as openai_rank:
+            threads = [
+                threading.Thread(target=lambda: results.append(search_nun_codes(client, "Fractura de cadera, con reducción", df)))
+                for _ in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(timeout=10)
+
+        openai_rank.assert_called_once()
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result.suggestions == results[0].suggestions for result in results))
+        after = flight.stats()
+        self.assertEqual(after["coalesced"] - before["coalesced"], 3)
+        self.assertEqual(after["in_flight"], 0)
+
+        calls = []
+
+        async def slow_async_rank(*args, **kwargs):
+            calls.append(args)
+            await asyncio.sleep(0.05)
+            return suggestions
+
+        async def search_three_times():
+            return await asyncio.gather(*(async_search_nun_codes(client, "fractura de cadera con reducción", df) for _ in range(3)))
+
+        with patch("nunbot_core.async_rank_codes_with_openai", new=slow_async_rank):
+            async_results = asyncio.run(search_three_times())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([result.suggestions for result in async_results], [suggestions] * 3)
+        self.assertEqual(flight.stats()["coalesced"] - after["coalesced"], 2)
+
+        async def search_with_different_options():
+            return await asyncio.gather(
+                async_search_nun_codes(client, "fractura de cadera con reducción", df),
+                async_search_nun_codes(client, "fractura de cadera con reducción", df, speculative=True),
+                async_search_nun_codes(object(), "fractura de cadera con reducción", df),
+                async_search_nun_codes(client, "fractura de cadera con reducción", df, model="gpt-4o-mini"),
+            )
+
+        calls.clear()
+        with patch("nunbot_core.async_rank_codes_with_openai", new=slow_async_rank):
+            asyncio.run(search_with_different_options())
+        self.assertEqual(len(calls), 4)
+
+    def test_single_flight_followers_compute_when_the_leader_cannot_answer(self):
+        import threading
+
+        from nunbot_core import SingleFlight
+
+        class Interrupted(BaseException):
+            pass
+
+        flight = SingleFlight()
+        leader_running = threading.Event()
+        release_leader = threading.Event()
+        follower_results = []
+
+        def interrupted_leader():
+            leader_running.set()
+            release_leader.wait(5)
+            raise Interrupted()
+
+        def lead():
+            with self.assertRaises(Interrupted):
+                flight.do("key", interrupted_leader)
+
+        def follow():
+            follower_results.append(flight.do("key", lambda: "computed by follower"))
+
+        leader = threading.Thread(target=lead)
+        leader.start()
+        leader_running.wait(5)
+        follower = threading.Thread(target=follow)
+        follower.start()
+        while flight.stats()["coalesced"] < 1:
+            follower.join(0.01)
+        release_leader.set()
+        leader.join(5)
+        follower.join(5)
+
+        # The interruption is the leader's own; the follower ran the computation instead of re-raising it.
+        self.assertEqual(follower_results, ["computed by follower"])
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+        stuck = threading.Thread(target=flight.do, args=("stuck", lambda: release_leader.wait(5) and "late"))
+        release_leader.clear()
+        stuck.start()
+        while flight.stats()["in_flight"] < 1:
+            stuck.join(0.01)
+        self.assertEqual(flight.do("stuck", lambda: "own result", timeout=0.05), "own result")
+        release_leader.set()
+        stuck.join(5)
+
+    def test_openai_rate_limiter_queues_within_budget_and_rejects_beyond_it(self):
+        import threading
+        from unittest.mock import patch
+
+        from nunbot_core import OpenAIRateLimiter, OpenAIRateLimitExceeded
+
+        limiter = OpenAIRateLimiter(requests_per_minute=3, tokens_per_minute=1000, max_concurrency=1, max_queue=1)
+        with limiter.limit(300, max_wait=1):
+            pass
+        # 800 estimated tokens exceed the 700 left and the deficit needs 6s to refill.
+        with self.assertRaises(OpenAIRateLimitExceeded):
+            with limiter.limit(800, max_wait=1):
+                pass
+
+        release = threading.Event()
+        holding = threading.Event()
+
+        def hold_slot():
+            with limiter.limit(100, max_wait=1):
+                holding.set()
+                release.wait(5)
+
+        holder = threading.Thread(target=hold_slot)
+        holder.start()
+        holding.wait(5)
+        threading.Timer(0.1, release.set).start()
+        # The only slot is busy: this request queues until it is released.
+        with limiter.limit(100, max_wait=2):
+            pass
+        holder.join(5)
+
+        stats = limiter.stats()
+        self.assertEqual(stats["admitted"], 3)
+        self.assertEqual(stats["rejected"], 1)
+        self.assertEqual(stats["delayed"], 1)
+        self.assertEqual(stats["peak_queue_depth"], 1)
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertGreater(stats["wait_seconds_max"], 0)
+        # All three requests per minute are spent: the next one would wait 20s and is refused without queueing.
+        with patch("nunbot_core.time.sleep", side_effect=AssertionError("a refused request must not wait")):
+            with self.assertRaises(OpenAIRateLimitExceeded):
+                with limiter.limit(10, max_wait=1):
+                    pass
+        self.assertEqual(limiter.stats()["rejected"], 2)
+        self.assertEqual(limiter.stats()["delayed"], 1)
+
+    def test_cancelled_async_waiter_does_not_leak_its_slot(self):
+        import asyncio
+
+        from nunbot_core import OpenAIRateLimiter
+
+        limiter = OpenAIRateLimiter(requests_per_minute=0, tokens_per_minute=0, max_concurrency=1, max_queue=2)
+
+        async def wait_until(condition):
+            for _ in range(500):
+                if condition():
+                    return
+                await asyncio.sleep(0.01)
+
+        async def scenario():
+            release = asyncio.Event()
+
+            async def holder():
+                async with limiter.async_limit(10, max_wait=5):
+                    await release.wait()
+
+            async def waiter():
+                async with limiter.async_limit(10, max_wait=5):
+                    pass
+
+            holding = asyncio.create_task(holder())
+            await wait_until(lambda: limiter.stats()["in_flight"] == 1)
+            waiting = asyncio.create_task(waiter())
+            await wait_until(lambda: limiter.stats()["queue_depth"] == 1)
+            # Let the waiter start polling for the slot.
+            await asyncio.sleep(0.05)
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+            release.set()
+            await holding
+            await wait_until(lambda: limiter.stats()["in_flight"] == 0)
+
+            async with limiter.async_limit(10, max_wait=0):
+                self.assertEqual(limiter.stats()["in_flight"], 1)
+
+        asyncio.run(scenario())
+        stats = limiter.stats()
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_search_falls_back_without_queueing_when_openai_is_saturated(self):
+        from unittest.mock import patch
+
+        from helpers import FakeOpenAIClient, hip_fracture_catalogue
+        from nunbot_core import OpenAIRateLimiter, OpenAIRateLimitExceeded, search_nun_codes
+
+        df = hip_fracture_catalogue()
+
+        class CountingClient(FakeOpenAIClient):
+            def respond(self, request):
+                raise AssertionError("a saturated limiter must not let requests through")
+
+        saturated = OpenAIRateLimiter(requests_per_minute=1, tokens_per_minute=0, max_concurrency=0, max_queue=0)
+        with saturated.limit(1):
+            pass
+        client = CountingClient()
+        with patch("nunbot_core._openai_rate_limiter", saturated), patch(
+            "nunbot_core.determine_region_locally", return_value=("", 0.0, "")
+        ):
+            result = search_nun_codes(client, "fractura de cadera con reducción", df, coalesce=False)
+
+        self.assertEqual(client.calls, 0)
+        self.assertTrue(result.used_fallback)
+        self.assertEqual(result.reason, OpenAIRateLimitExceeded.reason)
+        self.assertEqual(result.suggestions[0]["codigo"], "PC.10.01")
+        self.assertEqual(saturated.stats()["rejected"], 1)
+
+    def test_circuit_breaker_fails_searches_fast_during_an_outage_and_recovers(self):
+        from unittest.mock import patch
+
+        from helpers import HIP_FRACTURE_SUGGESTION, FakeClock, FakeOpenAIClient, hip_fracture_catalogue
+        from nunbot_core import CircuitBreaker, OpenAICircuitOpen, search_nun_codes
+
+        df = hip_fracture_catalogue()
+
+        class OutageClient(FakeOpenAIClient):
+            down = True
+
+            def respond(self, request):
+                if self.down:
+                    raise ConnectionError("provider unreachable")
+                return super().respond(request)
+
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30, clock=clock)
+        client = OutageClient([HIP_FRACTURE_SUGGESTION])
+        with patch("nunbot_core._openai_circuit_breaker", breaker), patch("nunbot_core._retry_delay", return_value=0), patch(
+            "nunbot_core.determine_region_locally", return_value=("", 0.0, "")
+        ):
+            first = search_nun_codes(client, "fractura de cadera con reducción", df, coalesce=False)
+            self.assertEqual(client.calls, 2)
+            self.assertEqual(breaker.state, "open")
+            self.assertTrue(first.used_fallback)
+            self.assertEqual(first.reason, OpenAICircuitOpen.reason)
+
+            # While open, searches fall back without sending anything.
+            second = search_nun_codes(client, "reducción de fractura de cadera", df, coalesce=False)
+            self.assertEqual(client.calls, 2)
+            self.assertEqual(second.suggestions[0]["codigo"], "PC.10.01")
+
+            clock.advance(29)
+            self.assertEqual(breaker.state, "open")
+            clock.advance(1)
+            self.assertEqual(breaker.state, "half_open")
+            client.down = False
+            third = search_nun_codes(client, "fractura de cadera, reducción cerrada", df, coalesce=False)
+
+        self.assertFalse(third.used_fallback)
+        self.assertEqual(breaker.state, "closed")
+        stats = breaker.stats()
+        self.assertEqual(stats["opened"], 1)
+        self.assertEqual(stats["short_circuited"], 2)
+
+    def test_search_deadline_bounds_latency_and_flags_partial_results(self):
+        import json
+        import tempfile
+        from functools import partial
+        from unittest.mock import patch
+
+        from helpers import HIP_OSTEOSYNTHESIS_ROW, FakeClock, FakeOpenAIClient, hip_fracture_catalogue, stream_chunk
+        from nunbot_core import SearchBudget, SearchDeadlineExceeded, SearchResultCache, search_nun_codes
+
+        df = hip_fracture_catalogue(HIP_OSTEOSYNTHESIS_ROW)
+
+        class HangingClient(FakeOpenAIClient):
+            def respond(self, request):
+                clock.advance(0.3)
+                raise TimeoutError("read timed out")
+
+        # Searches build their budgets on the fake clock; the clients advance it instead of sleeping.
+        clock = FakeClock()
+        fake_budget = patch("nunbot_core.SearchBudget", partial(SearchBudget, clock=clock))
+        client = HangingClient()
+        with fake_budget, patch("nunbot_core.determine_region_locally", return_value=("", 0.0, "")), patch(
+            "nunbot_core.time.sleep", side_effect=AssertionError("no backoff once the budget is spent")
+        ):
+            result = search_nun_codes(client, "fractura de cadera con reducción", df, coalesce=False, deadline_seconds=0.2)
+
+        # One attempt overran the budget: no retry, no backoff and no ranking request afterwards.
+        self.assertEqual(client.calls, 1)
+        self.assertTrue(result.partial)
+        self.assertTrue(result.used_fallback)
+        self.assertEqual(result.reason, SearchDeadlineExceeded.reason)
+        self.assertTrue(result.suggestions)
+
+        content = json.dumps(
+            {
+                "codigos_sugeridos": [
+                    {"codigo": "PC.10.02", "motivo": "Osteosíntesis", "confianza": 0.9},
+                    {"codigo": "PC.10.01", "motivo": "Reducción", "confianza": 0.6},
+                ]
+            }
+        )
+        split = content.index("}") + 1
+
+        class StallingStreamClient(FakeOpenAIClient):
+            closed = False
+
+            def create(self, **kwargs):
+                return self
+
+            def __iter__(self):
+                for piece in (content[:split], content[split:]):
+                    yield stream_chunk(piece)
+                    clock.advance(0.3)
+
+            def close(self):
+                self.closed = True
+
+        stream_client = StallingStreamClient()
+        streamed = []
+        with tempfile.TemporaryDirectory() as tmp, fake_budget:
+            cache = SearchResultCache(Path(tmp) / "cache.sqlite3")
+            result = search_nun_codes(
+                stream_client, "osteosíntesis de fractura de cadera", df,
+                cache=cache, coalesce=False, deadline_seconds=0.2, on_suggestion=streamed.append, local_bypass=False,
+            )
+            self.assertEqual(len(cache), 0)
+
+        self.assertTrue(result.partial)
+        self.assertFalse(result.used_fallback)
+        self.assertTrue(stream_client.closed)
+        self.assertEqual([item["codigo"] for item in result.suggestions], ["PC.10.02"])
+        self.assertEqual(streamed, result.suggestions)
+
+    def test_openai_timeout_gets_only_the_budget_left_after_the_queue_wait(self):
+        from contextlib import contextmanager
+        from unittest.mock import patch
+
+        from helpers import FakeClock, FakeOpenAIClient
+        from nunbot_core import SearchBudget, SearchDeadlineExceeded, _chat_json_with_retry
+
+        clock = FakeClock()
+
+        class QueueingLimiter:
+            def __init__(self, wait_seconds):
+                self.wait_seconds = wait_seconds
+
+            @contextmanager
+            def limit(self, tokens, *, max_wait):
+                clock.advance(self.wait_seconds)
+                yield
+
+        class RecordingClient(FakeOpenAIClient):
+            def with_options(self, **kwargs):
+                timeouts.append(kwargs["timeout"])
+                return self
+
+        timeouts = []
+        client = RecordingClient()
+        options = {"model": "gpt-4o", "messages": [{"role": "user", "content": "cadera"}], "max_tokens": 10, "temperature": 0.0}
+        with patch("nunbot_core._openai_rate_limiter", QueueingLimiter(9)):
+            payload = _chat_json_with_retry(client, budget=SearchBudget(10, clock=clock), **options)
+        self.assertEqual(payload["region"], "PC")
+        self.assertEqual(timeouts, [1])
+
+        budget = SearchBudget(10, clock=clock)
+        with patch("nunbot_core._openai_rate_limiter", QueueingLimiter(11)):
+            with self.assertRaises(SearchDeadlineExceeded):
+                _chat_json_with_retry(client, budget=budget, **options)
+        self.assertTrue(budget.exhausted)
+        self.assertEqual(client.calls, 1)
+
+    def test_decisive_local_match_bypasses_openai_and_samples_agreement(self):
+        from unittest.mock import patch
+
+        from helpers import HIP_OSTEOSYNTHESIS_ROW, FakeOpenAIClient, hip_fracture_catalogue
+        from nunbot_core import LocalBypassMonitor, search_nun_codes
+
+        df = hip_fracture_catalogue(
+            HIP_OSTEOSYNTHESIS_ROW,
+            {"Código": "PC.20.01", "Descripción": "Artroplastia total de cadera", "Región": "PC", "Palabras clave": "cadera, prótesis"},
+        )
+
+        monitor = LocalBypassMonitor(audit_rate=1.0)
+        client = FakeOpenAIClient([{"codigo": "PC.10.02", "confianza": 0.9, "motivo": "osteosíntesis"}])
+        with patch("nunbot_core._local_bypass_monitor", monitor):
+            # Off by default: the model still ranks a decisive match.
+            self.assertEqual(search_nun_codes(client, "osteosíntesis de fractura de cadera", df, coalesce=False).path, "local_region")
+            self.assertEqual(client.calls, 1)
+            decisive = search_nun_codes(client, "osteosíntesis de fractura de cadera", df, coalesce=False, local_bypass=True)
+            self.assertTrue(monitor.wait_for_audits(timeout=5))
+            ambiguous = search_nun_codes(client, "fractura de cadera con reducción", df, coalesce=False, local_bypass=True)
+
+        self.assertEqual(decisive.path, "local_bypass")
+        self.assertFalse(decisive.used_fallback)
+        self.assertEqual([item["codigo"] for item in decisive.suggestions], ["PC.10.02", "PC.10.01", "PC.20.01"])
+        self.assertGreater(decisive.suggestions[0]["confianza"], decisive.suggestions[1]["confianza"])
+        self.assertEqual(ambiguous.path, "local_region")
+        # One sampled audit of the bypass plus the ranking of the ambiguous query.
+        self.assertEqual(client.calls, 3)
+        stats = monitor.stats()
+        self.assertEqual((stats["evaluated"], stats["bypassed"], stats["audited"], stats["agreed"]), (2, 1, 1, 1))
+        self.assertEqual(stats["bypass_rate"], 0.5)
+        self.assertEqual(stats["agreement_rate"], 1.0)
+        self.assertEqual(stats["audit_pending"], 0)
+
+        # Audits beyond the pending limit are dropped instead of piling up.
+        saturated = LocalBypassMonitor(audit_rate=1.0, max_pending_audits=0)
+        with patch("nunbot_core._local_bypass_monitor", saturated):
+            self.assertEqual(
+                search_nun_codes(client, "osteosíntesis de fractura de cadera", df, coalesce=False, local_bypass=True).path, "local_bypass"
+            )
+        self.assertEqual(client.calls, 3)
+        self.assertEqual((saturated.stats()["audited"], saturated.stats()["audit_skipped"]), (0, 1))
+
+    def test_speculative_search_keeps_ranking_when_region_agrees(self):
+        from unittest.mock import patch
+
+        from helpers import WRIST_FRACTURE_ROW, hip_fracture_catalogue
+        from nunbot_core import search_nun_codes
+
+        df = hip_fracture_catalogue(WRIST_FRACTURE_ROW)
+
+        with patch("nunbot_core.determine_region_locally", return_value=("", 0.0, "")), patch(
+            "nunbot_core.infer_region_with_openai", return_value=("PC", 0.9, "cadera")
+        ), patch(
+            "nunbot_core.rank_codes_with_openai",
+            return_value=[
+                {"codigo": "PC.10.01", "confianza": 0.9, "motivo": "ok"},
+                {"codigo": "MS.10.01", "confianza": 0.4, "motivo": "otra región"},
+            ],
+        ) as openai_rank:
+            result = search_nun_codes(object(), "reducción de fractura", df, speculative=True)
+
+        openai_rank.assert_called_once()
+        self.assertEqual(result.path, "speculative")
+        self.assertEqual(result.region, "PC")
+        self.assertEqual([item["codigo"] for item in result.suggestions], ["PC.10.01"])
+        self.assertFalse(result.used_fallback)
+        # The kept ranking saw the cross-region prompt, not the region shortlist.
+        self.assertEqual(result.prompt_count, len(openai_rank.call_args.args[2]))
+        self.assertEqual(result.prompt_count, 2)
+
+    def test_speculative_search_reissues_ranking_when_region_disagrees(self):
+        from unittest.mock import patch
+
+        from helpers import WRIST_FRACTURE_ROW, hip_fracture_catalogue
+        from nunbot_core import search_nun_codes
+
+        df = hip_fracture_catalogue(WRIST_FRACTURE_ROW)
+        responses = [
+            [{"codigo": "MS.10.01", "confianza": 0.8, "motivo": "especulativo"}],
+            [{"codigo": "PC.10.01", "confianza": 0.9, "motivo": "dentro de la región"}],
+        ]
+
+        with patch("nunbot_core.determine_region_locally", return_value=("", 0.0, "")), patch(
+            "nunbot_core.infer_region_with_openai", return_value=("PC", 0.9, "cadera")
+        ), patch("nunbot_core.rank_codes_with_openai", side_effect=responses) as openai_rank:
+            result = search_nun_codes(object(), "reducción de fractura", df, speculative=True)
+
+        self.assertEqual(openai_rank.call_count, 2)
+        reissued_candidates = openai_rank.call_args_list[1].args[2]
+        self.assertEqual([row["Código"] for row in reissued_candidates], ["PC.10.01"])
+        self.assertEqual(result.path, "speculative_reissued")
+        self.assertEqual(result.suggestions[0]["codigo"], "PC.10.01")
+
+    def test_run_batch_writes_results_and_resumes_from_checkpoint(self):
+        import io
+        import json
+        import tempfile
+        from unittest.mock import patch
+
+        from helpers import hip_fracture_catalogue
+        from nunbot_core import read_batch_input, run_batch
+
+        df = hip_fracture_catalogue()
+        suggestion = [{"codigo": "PC.10.01", "confianza": 0.91, "motivo": "Coincidencia exacta"}]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = Path(tmp) / "cirugias.csv"
+            input_path.write_text(
+                "id,descripcion\nA1,fractura de cadera con reducción\nA2,abc\nA3,reducción cerrada de cadera\n",
+                encoding="utf-8",
+            )
+            output_path = Path(tmp) / "salida.jsonl"
+            items = read_batch_input(input_path)
+            # The input is read lazily, one row at a time.
+            self.assertEqual(next(items), ("A1", "fractura de cadera con reducción"))
+
+            # A3 fails in the model and falls back; A2 is rejected before any search.
+            def rank(client, description, *args, **kwargs):
+                return suggestion if "fractura" in description else []
+
+            with patch("nunbot_core.rank_codes_with_openai", side_effect=rank):
+                summary = run_batch(
+                    read_batch_input(input_path), output_path, client=object(), procedures_data=df, concurrency=2, progress=io.StringIO()
+                )
+
+            records = {record["id"]: record for record in map(json.loads, output_path.read_text(encoding="utf-8").splitlines())}
+
+            with patch("nunbot_core.rank_codes_with_openai", return_value=suggestion) as openai_rank:
+                resumed = run_batch(read_batch_input(input_path), output_path, client=object(), procedures_data=df)
+            with patch("nunbot_core.rank_codes_with_openai") as final_rank:
+                finished = run_batch(read_batch_input(input_path), output_path, client=object(), procedures_data=df)
+            lines = output_path.read_text(encoding="utf-8").splitlines()
+
+        self.assertEqual(summary, {"total": 3, "skipped": 0, "retried": 0, "completed": 3, "fallback": 1, "invalid": 1, "errors": 0})
+        self.assertEqual(records["A1"]["codigos"][0]["codigo"], "PC.10.01")
+        self.assertEqual(records["A1"]["codigos"][0]["total"], 150)
+        self.assertEqual([records[item_id]["estado"] for item_id in ("A1", "A2", "A3")], ["ok", "invalida", "fallback"])
+        self.assertIn("error", records["A2"])
+
+        # Only the fallback row is searched again; its new line supersedes the old one.
+        openai_rank.assert_called_once()
+        self.assertEqual(resumed, {"total": 3, "skipped": 2, "retried": 1, "completed": 1, "fallback": 0, "invalid": 0, "errors": 0})
+        self.assertEqual(json.loads(lines[-1])["id"], "A3")
+        self.assertEqual(json.loads(lines[-1])["estado"], "ok")
+        final_rank.assert_not_called()
+        self.assertEqual(finished["skipped"], 3)
+
+    def test_run_batch_rejects_a_missing_description_column_before_searching(self):
+        import tempfile
+        from unittest.mock import patch
+
+        from helpers import hip_fracture_catalogue
+        from nunbot_core import main, read_batch_input, run_batch
+
+        with tempfile.TemporaryDirectory() as tmp:
+            csv_path = Path(tmp) / "cirugias.csv"
+            csv_path.write_text("id,texto\nA1,fractura de cadera con reducción\n", encoding="utf-8")
+            jsonl_path = Path(tmp) / "cirugias.jsonl"
+            jsonl_path.write_text('{"id": "B1", "texto": "fractura de cadera con reducción"}\n', encoding="utf-8")
+            output_path = Path(tmp) / "salida.jsonl"
+
+            with patch("nunbot_core.search_nun_codes") as search:
+                for path, column in ((csv_path, None), (csv_path, "descripcion"), (jsonl_path, None)):
+                    with self.assertRaises(ValueError):
+                        run_batch(read_batch_input(path, column=column), output_path, client=object(), procedures_data=hip_fracture_catalogue())
+                with patch("nunbot_core.check_runtime_health", return_value=[]), patch("openai.OpenAI"), patch("sys.stderr"):
+                    self.assertEqual(main(["batch", str(csv_path), str(output_path), "--column", "descripcion"]), 1)
+            search.assert_not_called()
+            # Nothing was recorded, so a run with the right column codes every row.
+            self.assertEqual(output_path.read_text(encoding="utf-8"), "")
+            self.assertEqual(list(read_batch_input(csv_path, column="texto")), [("A1", "fractura de cadera con reducción")])
+
+    def test_search_nun_codes_streams_validated_suggestions_before_the_response_ends(self):
+        import json
+
+        from helpers import HIP_OSTEOSYNTHESIS_ROW, FakeOpenAIClient, hip_fracture_catalogue, stream_chunk
+        from nunbot_core import JsonArrayStreamParser, search_nun_codes
+
+        df = hip_fracture_catalogue(HIP_OSTEOSYNTHESIS_ROW)
+        content = json.dumps(
+            {
+                "codigos_sugeridos": [
+                    {"codigo": "PC.10.02", "motivo": 'Incluye "osteosíntesis" {placa}', "confianza": 0.9},
+                    {"codigo": "NO.EXISTE", "motivo": "Inventado", "confianza": 0.8},
+                    {"codigo": "PC.10.02", "motivo": "Repetido", "confianza": 0.7},
+                    {"codigo": "PC.10.01", "motivo": "Reducción", "confianza": 0.6},
+                ]
+            },
+            ensure_ascii=False,
+        )
+        events = []
+
+        class StreamingClient(FakeOpenAIClient):
+            def create(self, **kwargs):
+                self.kwargs = kwargs
+                return self._chunks()
+
+            def _chunks(self):
+                for start in range(0, len(content), 7):
+                    events.append("chunk")
+                    yield stream_chunk(content[start : start + 7])
+
+        client = StreamingClient()
+        streamed = []
+
+        def on_suggestion(suggestion):
+            events.append(suggestion["codigo"])
+            streamed.append(suggestion)
+
+        result = search_nun_codes(client, "osteosíntesis de fractura de cadera", df, on_suggestion=on_suggestion, local_bypass=False)
+
+        self.assertTrue(client.kwargs["stream"])
+        self.assertEqual([item["codigo"] for item in streamed], ["PC.10.02", "PC.10.01"])
+        self.assertEqual(streamed[0]["motivo"], 'Incluye "osteosíntesis" {placa}')
+        self.assertEqual(result.suggestions, streamed)
+        self.assertFalse(result.used_fallback)
+        self.assertLess(events.index("PC.10.02"), len(events) // 2)
+
+        # A truncated response still yields the objects that were closed.
+        parser = JsonArrayStreamParser("codigos_sugeridos")
+        items = parser.feed('{"codigos_sugeridos": [{"codigo": "PC.10.01", "confianza": 0.9}, {"codigo": "PC.1')
+        self.assertEqual(items, [{"codigo": "PC.10.01", "confianza": 0.9}])
+        self.assertFalse(parser.done)
+
     def test_build_search_prompt_only_includes_provided_candidates(self):
         from nunbot_core import build_search_prompt
 
@@ -268,7 +1303,8 @@ class TestNunbotCore(unittest.TestCase):
                 },
             ]
         )
-        prompt = build_search_prompt("fractura de cadera", candidates)
+        prompt, listed = build_search_prompt("fractura de cadera", candidates)
+        self.assertEqual(listed, 2)
         user_message = prompt[1]["content"]
         self.assertIn("fractura de cadera", user_message)
         self.assertIn("PC.01.01 | Reducción de fractura de cadera con osteosíntesis", user_message)
@@ -276,3 +1312,151 @@ class TestNunbotCore(unittest.TestCase):
         self.assertIn("PC.01.02 | Osteosíntesis de cadera", user_message)
         self.assertNotIn("Texto duplicado que no debería llegar al prompt", user_message)
         self.assertNotIn("MS.01.01", user_message)
+
+    def test_search_prompt_keeps_a_static_prefix_and_fits_the_token_budget(self):
+        from nunbot_core import build_region_prompt, build_search_prompt, estimate_prompt_tokens, load_procedures
+
+        candidates = list(load_procedures())[:40]
+        hip, _ = build_search_prompt("fractura de cadera", candidates[:3], token_budget=0)
+        knee, _ = build_search_prompt("artroscopia de rodilla", candidates[3:6], token_budget=0)
+        self.assertEqual(hip[0], knee[0])
+        self.assertEqual(build_region_prompt("fractura de cadera")[0], build_region_prompt("artroscopia de rodilla")[0])
+        # The description comes after the candidate list, at the end of the prompt.
+        self.assertGreater(hip[1]["content"].index("fractura de cadera"), hip[1]["content"].index(candidates[2].prompt_line))
+
+        budgeted, count = build_search_prompt("fractura de cadera", candidates, token_budget=800)
+        listed = [line.split(" | ", 1)[0] for line in budgeted[1]["content"].splitlines() if " | " in line]
+        self.assertLessEqual(estimate_prompt_tokens(budgeted), 800)
+        self.assertEqual(listed, [record.code for record in candidates[:count]])
+        self.assertTrue(3 < count < len(candidates))
+
+        # The best candidate is always sent, even over budget.
+        tiny, count = build_search_prompt("fractura de cadera", candidates, token_budget=1)
+        self.assertEqual(count, 1)
+        self.assertEqual([line for line in tiny[1]["content"].splitlines() if " | " in line], [candidates[0].prompt_line])
+
+    def test_prompt_token_meter_reports_estimated_billed_and_cached_tokens(self):
+        from types import SimpleNamespace
+        from unittest.mock import patch
+
+        from helpers import FakeOpenAIClient, chat_completion
+        from nunbot_core import PromptTokenMeter, build_region_prompt, estimate_prompt_tokens, infer_region_with_openai
+
+        class UsageClient(FakeOpenAIClient):
+            def create(self, **kwargs):
+                usage = SimpleNamespace(prompt_tokens=540, prompt_tokens_details=SimpleNamespace(cached_tokens=512))
+                return chat_completion(self.respond(kwargs), usage=usage)
+
+        meter = PromptTokenMeter()
+        with patch("nunbot_core._prompt_token_meter", meter):
+            infer_region_with_openai(UsageClient(), "fractura de cadera")
+            infer_region_with_openai(UsageClient(), "fractura de cadera con reducción")
+
+        stats = meter.stats()
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["prompt_tokens"], 1080)
+        self.assertEqual(stats["cached_prompt_tokens"], 1024)
+        expected = estimate_prompt_tokens(build_region_prompt("fractura de cadera")) + estimate_prompt_tokens(
+            build_region_prompt("fractura de cadera con reducción")
+        )
+        self.assertEqual(stats["estimated_prompt_tokens"], expected)
+
+    def test_prompt_candidate_count_follows_the_local_score_curve(self):
+        from unittest.mock import patch
+
+        import nunbot_core
+        from helpers import FakeOpenAIClient, prompt_of
+        from nunbot_core import _adaptive_prompt_count, load_procedures, search_nun_codes
+
+        self.assertEqual(_adaptive_prompt_count([20, 19, 18, 17, 16, 15, 14, 13, 12, 11, 10, 9, 8, 7], 6, 12), (12, "flat"))
+        # Cuts before the minimum or inside a tie plateau are not candidates.
+        self.assertEqual(_adaptive_prompt_count([20, 19, 5, 4, 4, 3, 3, 3, 2, 2, 2, 1, 1], 6, 12), (8, "drop_off"))
+        self.assertEqual(_adaptive_prompt_count([15] + [11] * 7 + [7.5, 7.5, 7, 7, 7, 7], 6, 12), (8, "drop_off"))
+        self.assertEqual(_adaptive_prompt_count([9] * 14 + [1], 6, 12), (14, "flat"))
+        self.assertEqual(_adaptive_prompt_count([5, 4, 3] + [0.0] * 20, 6, 12), (6, "drop_off"))
+        self.assertEqual(_adaptive_prompt_count([20, 19, 18, 17, 16, 15, 14, 13, 3, 3, 2, 2, 1], 6, 12), (8, "drop_off"))
+        self.assertEqual(_adaptive_prompt_count([9, 8, 7], 6, 12), (3, "short_list"))
+        self.assertEqual(_adaptive_prompt_count([0.0] * 20, 6, 12), (12, "unscored"))
+
+        class RecordingClient(FakeOpenAIClient):
+            def __init__(self):
+                super().__init__()
+                self.listed = []
+
+            def respond(self, request):
+                self.listed.append(sum(" | " in line for line in prompt_of(request).splitlines()))
+                return super().respond(request)
+
+        client = RecordingClient()
+        result = search_nun_codes(client, "osteosintesis de fractura de tibia con clavo endomedular", load_procedures(), coalesce=False)
+        self.assertEqual(result.prompt_reason, "drop_off")
+        self.assertEqual(client.listed, [result.prompt_count])
+        self.assertLess(result.prompt_count, 12)
+        self.assertGreater(len(result.local_candidates), result.prompt_count)
+
+        # When the token budget cuts the shortlist, the count is what the prompt listed.
+        build_search_prompt = nunbot_core.build_search_prompt
+        tight_client = RecordingClient()
+        with patch("nunbot_core.build_search_prompt", side_effect=lambda *args, **kwargs: build_search_prompt(*args, token_budget=1)):
+            tight = search_nun_codes(tight_client, "osteosintesis de fractura de tibia con clavo endomedular", load_procedures(), coalesce=False)
+        self.assertEqual(tight_client.listed, [1])
+        self.assertEqual(tight.prompt_count, 1)
+
+    def test_search_result_traces_each_stage_and_exports_otlp_json(self):
+        import json
+        import tempfile
+        from unittest.mock import patch
+
+        from helpers import HIP_FRACTURE_SUGGESTION, FakeOpenAIClient, hip_fracture_catalogue, is_ranking_prompt
+        from nunbot_core import SearchResultCache, search_nun_codes
+
+        df = hip_fracture_catalogue()
+
+        class FlakyClient(FakeOpenAIClient):
+            ranking_calls = 0
+
+            def respond(self, request):
+                if is_ranking_prompt(request):
+                    self.ranking_calls += 1
+                    if self.ranking_calls == 1:
+                        raise TimeoutError("read timed out")
+                return super().respond(request)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            export_path = Path(tmpdir) / "traces.jsonl"
+            cache = SearchResultCache(Path(tmpdir) / "cache.sqlite3")
+            with patch("nunbot_core._retry_delay", return_value=0), patch(
+                "nunbot_core.determine_region_locally", return_value=("", 0.0, "")
+            ), patch("nunbot_core.DEFAULT_TRACE_EXPORT_PATH", str(export_path)):
+                result = search_nun_codes(FlakyClient([HIP_FRACTURE_SUGGESTION]), "fractura de cadera con reducción", df, cache=cache, local_bypass=False)
+                cached = search_nun_codes(FlakyClient([HIP_FRACTURE_SUGGESTION]), "fractura de cadera con reducción", df, cache=cache, local_bypass=False)
+            exported = [json.loads(line) for line in export_path.read_text(encoding="utf-8").splitlines()]
+
+        spans = result.trace.ordered_spans()
+        names = [span.name for span in spans]
+        for stage in ("search", "normalize", "cache.lookup", "region.local", "region.openai", "ranking.local",
+                      "ranking.openai", "prompt.build", "openai.backoff", "validation"):
+            self.assertIn(stage, names)
+        self.assertEqual(names.count("openai.attempt"), 3)
+        self.assertNotIn("fallback", names)
+        by_id = {span.span_id: span for span in spans}
+        ranking_attempts = [span for span in spans if span.name == "openai.attempt" and by_id[span.parent_id].name == "ranking.openai"]
+        self.assertEqual([span.error for span in ranking_attempts], ["TimeoutError", ""])
+        self.assertEqual(by_id[next(span for span in spans if span.name == "openai.backoff").parent_id].name, "ranking.openai")
+        self.assertGreaterEqual(result.trace.summary()["search"], result.trace.summary()["ranking.openai"])
+        self.assertNotIn("trace", result.to_dict())
+
+        self.assertTrue(cached.cached)
+        self.assertIsNot(cached.trace, result.trace)
+        self.assertEqual([span.name for span in cached.trace.ordered_spans()], ["search", "normalize", "cache.lookup"])
+
+        self.assertEqual(len(exported), 2)
+        otlp_spans = exported[0]["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        self.assertEqual(len(otlp_spans), len(spans))
+        root = next(span for span in otlp_spans if span["name"] == "search")
+        self.assertEqual(root["parentSpanId"], "")
+        self.assertEqual(len(root["traceId"]), 32)
+        self.assertLessEqual(int(root["startTimeUnixNano"]), int(root["endTimeUnixNano"]))
+        self.assertIn({"key": "nunbot.path", "value": {"stringValue": "sequential"}}, root["attributes"])
+        failed = next(span for span in otlp_spans if span.get("status", {}).get("code") == 2)
+        self.assertEqual(failed["status"]["message"], "TimeoutError")